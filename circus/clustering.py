@@ -29,6 +29,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     file_out_suff = params.get('data', 'file_out_suff')
     sign_peaks = params.get('detection', 'peaks')
     alignment = params.getboolean('detection', 'alignment')
+    alignment_engine = params.get('detection', 'alignment_engine').lower()
     isolation = params.getboolean('detection', 'isolation')
     over_factor = float(params.getint('detection', 'oversampling_factor'))
     matched_filter = params.getboolean('detection', 'matched-filter')
@@ -76,6 +77,10 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     _ = map(float, tmp_limits)
     elt_count = 0
     m_ratio = params.getfloat('clustering', 'm_ratio')
+    density_mode = params.get('clustering', 'density_mode').lower()
+    nb_workers = params.getint('clustering', 'nb_workers')
+    use_peak_cache = params.getboolean('clustering', 'peak_cache')
+    selection_engine = params.get('clustering', 'selection_engine').lower()
     sub_output_dim = params.getint('clustering', 'sub_dim')
     inv_nodes = numpy.zeros(n_total, dtype=numpy.int32)
     inv_nodes[nodes] = numpy.arange(len(nodes))
@@ -92,7 +97,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     rejection_threshold = params.getfloat('detection', 'rejection_threshold')
     smoothing_factor = params.getfloat('detection', 'smoothing_factor')
     noise_window = params.getint('detection', 'noise_time')
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if rejection_threshold > 0:
@@ -142,6 +147,8 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         #     weights_pos = smoothing_factor/io.load_data(params, 'weights-pos')
         m_size = (2 * template_shift_2 + 1)
         align_factor = m_size
+        if alignment_engine == 'kernels':
+            search_kernel, shift_kernels = get_alignment_kernels(xdata, cdata, xoff, over_factor, template_shift, n_t)
     else:
         cdata = None  # default assignment (for PyCharm code inspection)
         xdata = None  # default assignment (for PyCharm code inspection)
@@ -258,6 +265,441 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     local_mergings = 0
     cluster_results = {}
 
+    # Neighbors of the electrodes, padded with the electrode itself, for the snippets of the cache and the batched
+    # selection of the peaks.
+    padded_indices = numpy.zeros((n_e, max([len(nodes_indices[elec]) for elec in range(n_e)])), dtype=numpy.int32)
+    are_neighbors = numpy.zeros((n_e, n_e), dtype=bool)
+    for elec in range(n_e):
+        padded_indices[elec] = elec
+        padded_indices[elec, :len(nodes_indices[elec])] = nodes_indices[elec]
+        are_neighbors[elec, nodes_indices[elec]] = True
+    padded_positions = numpy.array([elec_positions[elec][0] for elec in range(n_e)])
+
+    if use_peak_cache:
+        peak_cache = ChunkCache(tmp_path_loc)
+    else:
+        peak_cache = None
+
+    def align_with_splines(sub_mat, elec, negative_peak):
+        # Alignment of one snippet (on the neighbors of elec) with smoothing splines.
+        local_factor = align_factor * ((smoothing_factor * mads[elec]) ** 2)
+
+        if sub_mat.shape[1] == 1:
+            smoothed = True
+            try:
+                f = scipy.interpolate.UnivariateSpline(xdata, sub_mat, s=local_factor, k=3)
+            except Exception:
+                smoothed = False
+                f = scipy.interpolate.UnivariateSpline(xdata, sub_mat, k=3, s=0)
+            if negative_peak:
+                rmin = (numpy.argmin(f(cdata)) - xoff) / over_factor
+            else:
+                rmin = (numpy.argmax(f(cdata)) - xoff) / over_factor
+            if smoothed:
+                f = scipy.interpolate.UnivariateSpline(xdata, sub_mat, s=0, k=3)
+            ddata = numpy.linspace(rmin - template_shift, rmin + template_shift, n_t)
+            sub_mat = f(ddata).astype(numpy.float32).reshape(n_t, 1)
+        else:
+            idx = elec_positions[elec]
+            ydata = elec_ydata[elec]
+            try:
+                f = scipy.interpolate.UnivariateSpline(xdata, sub_mat[:, idx], s=local_factor, k=3)
+            except Exception:
+                f = scipy.interpolate.UnivariateSpline(xdata, sub_mat[:, idx], k=3, s=0)
+            if negative_peak:
+                rmin = (numpy.argmin(f(cdata)) - xoff) / over_factor
+            else:
+                rmin = (numpy.argmax(f(cdata)) - xoff) / over_factor
+            f = scipy.interpolate.RectBivariateSpline(xdata, ydata, sub_mat, s=0, kx=3, ky=1)
+            ddata = numpy.linspace(rmin - template_shift, rmin + template_shift, n_t)
+            sub_mat = f(ddata, ydata).astype(numpy.float32)
+
+        return sub_mat
+
+    def get_chunk_peaks(gidx):
+        # Peaks of a chunk, with all that the selection of the spikes needs: their times, extremum electrodes and
+        # polarities, their amplitudes (for the isolation test), and either the whitened data or, when the chunk is
+        # kept in the cache for the next passes, the snippets around the peaks (on the neighbors of the extremum),
+        # aligned on demand.
+        if peak_cache is not None and gidx in peak_cache:
+            return peak_cache.load(gidx)
+
+        is_first = data_file.is_first_chunk(gidx, nb_chunks)
+        is_last = data_file.is_last_chunk(gidx, nb_chunks)
+
+        if is_last:
+            padding = (-duration, 0)
+        elif is_first:
+            padding = (0, duration)
+        else:
+            padding = (-duration, duration)
+
+        local_chunk, t_offset = data_file.get_data(gidx, chunk_size, padding, nodes=nodes)
+        local_shape = len(local_chunk)
+        if do_spatial_whitening:
+            if use_gpu:
+                local_chunk = cmt.CUDAMatrix(local_chunk, copy_on_host=False)
+                local_chunk = local_chunk.dot(spatial_whitening).asarray()
+            else:
+                local_chunk = numpy.dot(local_chunk, spatial_whitening)
+        if do_temporal_whitening:
+            local_chunk = scipy.ndimage.filters.convolve1d(
+                local_chunk, temporal_whitening, axis=0, mode='constant'
+            )
+
+        # Extracting the peaks.
+        all_peaktimes = [numpy.empty(0, dtype=numpy.uint32)]
+        all_extremas = [numpy.empty(0, dtype=numpy.uint32)]
+
+        if matched_filter:
+
+            if sign_peaks in ['positive', 'both']:
+                filter_chunk = scipy.ndimage.filters.convolve1d(
+                    local_chunk, waveform_pos, axis=0, mode='constant'
+                )
+                for i in range(n_e):
+                    peaktimes = scipy.signal.find_peaks(
+                        filter_chunk[:, i], height=matched_thresholds_pos[i],
+                        width=spike_width, distance=dist_peaks, wlen=n_t
+                    )[0]
+                    peaktimes = peaktimes.astype(numpy.uint32)
+                    all_peaktimes.append(peaktimes)
+                    extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
+                    all_extremas.append(extremas)
+
+            if sign_peaks in ['negative', 'both']:
+                filter_chunk = scipy.ndimage.filters.convolve1d(
+                    local_chunk, waveform_neg, axis=0, mode='constant'
+                )
+                for i in range(n_e):
+                    peaktimes = scipy.signal.find_peaks(
+                        filter_chunk[:, i], height=matched_thresholds_neg[i],
+                        width=spike_width, distance=dist_peaks, wlen=n_t
+                    )[0]
+                    peaktimes = peaktimes.astype(numpy.uint32)
+                    all_peaktimes.append(peaktimes)
+                    extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
+                    all_extremas.append(extremas)
+
+        else:
+
+            for i in range(n_e):
+                x = local_chunk[:, i]
+                height = thresholds[i]
+                if sign_peaks == 'negative':
+                    peaktimes = scipy.signal.find_peaks(
+                        -x, height=height, width=spike_width, distance=dist_peaks, wlen=n_t
+                    )[0]
+                elif sign_peaks == 'positive':
+                    peaktimes = scipy.signal.find_peaks(
+                        +x, height=height, width=spike_width, distance=dist_peaks, wlen=n_t
+                    )[0]
+                elif sign_peaks == 'both':
+                    peaktimes = scipy.signal.find_peaks(
+                        numpy.abs(x), height=height, width=spike_width, distance=dist_peaks, wlen=n_t
+                    )[0]
+                else:
+                    peaktimes = numpy.empty(0, dtype=numpy.uint32)
+                peaktimes.astype(numpy.uint32)
+                all_peaktimes.append(peaktimes)
+                extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
+                all_extremas.append(extremas)
+
+        all_peaktimes = numpy.concatenate(all_peaktimes)  # i.e. concatenate once for efficiency
+        all_extremas = numpy.concatenate(all_extremas)  # i.e. concatenate once for efficiency
+
+        # print "Removing the useless borders..."
+        local_borders = (duration, local_shape - duration)
+
+        idx = (all_peaktimes >= local_borders[0]) & (all_peaktimes < local_borders[1])
+        all_peaktimes = numpy.compress(idx, all_peaktimes)
+        all_extremas = numpy.compress(idx, all_extremas)
+
+        local_peaktimes = numpy.unique(all_peaktimes)
+        local_offset = t_offset + padding[0]
+
+        if ignore_dead_times:
+            is_included = is_in_intervals(local_peaktimes + t_offset, all_dead_times)
+            local_peaktimes = local_peaktimes[~is_included]
+
+        values = local_chunk[local_peaktimes]
+        if sign_peaks == 'negative':
+            elecs = numpy.argmin(values, axis=1)
+            negative_peaks = numpy.ones(len(local_peaktimes), dtype=bool)
+        elif sign_peaks == 'positive':
+            elecs = numpy.argmax(values, axis=1)
+            negative_peaks = numpy.zeros(len(local_peaktimes), dtype=bool)
+        elif n_e == 1:
+            elecs = numpy.zeros(len(local_peaktimes), dtype=numpy.int64)
+            negative_peaks = values[:, 0] < 0
+        else:
+            negative_peaks = numpy.abs(numpy.max(values, axis=1)) <= numpy.abs(numpy.min(values, axis=1))
+            elecs = numpy.where(negative_peaks, numpy.argmin(values, axis=1), numpy.argmax(values, axis=1))
+
+        chunk = {
+            'info': numpy.array([local_offset, local_shape], dtype=numpy.int64),
+            'peaktimes': local_peaktimes,
+            'elecs': elecs,
+            'negative': negative_peaks,
+            'amplitudes': values[numpy.arange(len(local_peaktimes)), elecs],
+            'all_peaktimes': all_peaktimes,
+            'all_extremas': all_extremas,
+            'all_amplitudes': local_chunk[all_peaktimes, all_extremas],
+        }
+
+        if peak_cache is None:
+            chunk['data'] = local_chunk
+            return chunk
+
+        times = local_peaktimes.astype(numpy.int64)[:, numpy.newaxis, numpy.newaxis] - duration
+        chunk['snippets'] = local_chunk[
+            times + numpy.arange(2 * duration + 1)[numpy.newaxis, :, numpy.newaxis],
+            padded_indices[elecs][:, numpy.newaxis, :]
+        ]
+        if alignment:
+            chunk['aligned'] = numpy.zeros((len(local_peaktimes), n_t, padded_indices.shape[1]), dtype=numpy.float32)
+            chunk['is_aligned'] = numpy.zeros(len(local_peaktimes), dtype=bool)
+        peak_cache.save(gidx, chunk)
+
+        return peak_cache.load(gidx)
+
+    def select_peaks(chunk, order, all_times, min_times, max_times, nb_max):
+        # Batched selection of the peaks of a chunk (selection_engine = batch), with the same results as the loop:
+        # all that does not depend on the previously selected peaks (electrodes already full or masked, noise and
+        # isolation tests, alignment, amplitudes) is computed with array operations, such that only the greedy
+        # selection of the non-overlapping peaks, in random order, remains a (cheap) loop. Returns the numbers of
+        # selected, rejected and noisy peaks.
+        elecs = chunk['elecs'][order]
+        negatives = chunk['negative'][order].astype(bool)
+        counts = numpy.zeros((2, n_e), dtype=numpy.int64)  # i.e. positive and negative peaks
+        for p in search_peaks:
+            counts[int(p == 'neg')] = [result['count_%s_' % p + str(elec)] for elec in range(n_e)]
+        if safety_space:
+            rows = padded_indices[elecs]
+        else:
+            rows = elecs[:, numpy.newaxis]
+
+        # Masks can only grow, such that peaks already masked (or of full electrodes) will never be selected.
+        if gpass > 1:
+            cumulated_times = numpy.zeros((n_e, all_times.shape[1] + 1), dtype=numpy.int32)
+            cumulated_times[:, 1:] = numpy.cumsum(all_times, axis=1)
+            starts = numpy.minimum(min_times[order], all_times.shape[1])[:, numpy.newaxis]
+            stops = numpy.minimum(max_times[order], all_times.shape[1])[:, numpy.newaxis]
+            is_masked = numpy.any(cumulated_times[rows, stops] > cumulated_times[rows, starts], axis=1)
+        else:
+            is_masked = numpy.zeros(len(order), dtype=bool)  # i.e. masks are empty at the beginning of the chunk
+        candidates = ~is_masked & (counts[negatives.astype(int), elecs] < loop_max_elts_elec)
+        if gpass <= 1:
+            candidates &= numpy.mod(elecs, comm.size) == comm.rank
+        candidates = numpy.where(candidates)[0]
+        peaks = order[candidates]
+        elecs = elecs[candidates]
+        negatives = negatives[candidates]
+        nb_candidates = len(candidates)
+
+        if 'snippets' in chunk:
+            snippets = numpy.array(chunk['snippets'][peaks])
+        else:
+            times = chunk['peaktimes'][peaks].astype(numpy.int64)[:, numpy.newaxis, numpy.newaxis] - duration
+            snippets = chunk['data'][
+                times + numpy.arange(2 * duration + 1)[numpy.newaxis, :, numpy.newaxis],
+                padded_indices[elecs][:, numpy.newaxis, :]
+            ]
+
+        if reject_noise:
+            slice_window = snippets[:, duration - noise_window: duration + noise_window]
+            values = numpy.linalg.norm(slice_window, axis=1) / (stds[padded_indices[elecs]] * 2 * noise_window)
+            is_noise = numpy.all(values < rejection_threshold, axis=1)
+        else:
+            is_noise = numpy.zeros(nb_candidates, dtype=bool)
+
+        is_isolated = numpy.ones(nb_candidates, dtype=bool)
+        if isolation and gpass == 1:
+            # Peaks detected in the vicinity of each candidate, as in the loop (differences of unsigned times wrap
+            # around, such that only the following peaks are in the vicinity).
+            all_peaktimes = chunk['all_peaktimes']
+            sorting = numpy.argsort(all_peaktimes, kind='mergesort')
+            sorted_times = all_peaktimes[sorting].astype(numpy.int64)
+            peaktimes = chunk['peaktimes'][peaks].astype(numpy.int64)
+            if all_peaktimes.dtype.kind == 'u':
+                lower = numpy.searchsorted(sorted_times, peaktimes, 'left')
+            else:
+                lower = numpy.searchsorted(sorted_times, peaktimes - safety_time, 'right')
+            upper = numpy.searchsorted(sorted_times, peaktimes + safety_time, 'left')
+            nb_nearby = upper - lower
+            pairs = numpy.repeat(numpy.arange(nb_candidates), nb_nearby)
+            shifts = numpy.repeat(numpy.cumsum(nb_nearby) - nb_nearby - lower, nb_nearby)
+            nearby = sorting[numpy.arange(len(pairs)) - shifts]
+            amplitudes = chunk['all_amplitudes'][nearby]
+            references = chunk['amplitudes'][peaks][pairs]
+            is_larger = numpy.where(negatives[pairs], amplitudes < references, amplitudes > references)
+            is_larger &= are_neighbors[elecs[pairs], chunk['all_extremas'][nearby]]
+            is_isolated = numpy.bincount(pairs[is_larger], minlength=nb_candidates) == 0
+
+        to_align = numpy.where(~is_noise & is_isolated)[0]
+        if alignment:
+            aligned = numpy.zeros((nb_candidates, n_t, padded_indices.shape[1]), dtype=numpy.float32)
+            if 'aligned' in chunk:
+                is_cached = chunk['is_aligned'][peaks[to_align]].astype(bool)
+                aligned[to_align[is_cached]] = chunk['aligned'][peaks[to_align[is_cached]]]
+                to_align = to_align[~is_cached]
+            if alignment_engine == 'kernels' and len(to_align) > 0:
+                aligned[to_align] = align_snippets(
+                    snippets[to_align], search_kernel, shift_kernels, padded_positions[elecs[to_align]],
+                    negatives[to_align]
+                )
+            else:
+                for count in to_align:
+                    nb_neighbors = len(nodes_indices[elecs[count]])
+                    aligned[count, :, :nb_neighbors] = align_with_splines(
+                        snippets[count, :, :nb_neighbors], elecs[count], negatives[count]
+                    )
+            if 'aligned' in chunk and len(to_align) > 0:
+                chunk['aligned'][peaks[to_align]] = aligned[to_align]
+                chunk['is_aligned'][peaks[to_align]] = True
+        else:
+            aligned = snippets
+        ext_amps = aligned[numpy.arange(nb_candidates), template_shift, padded_positions[elecs]]
+
+        hists = numpy.zeros(nb_candidates, dtype=numpy.float32)
+        if gpass == 1:
+            for p in search_peaks:
+                for elec in numpy.unique(elecs[negatives == (p == 'neg')]):
+                    if smart_searches[p][elec] > 0:
+                        group = (elecs == elec) & (negatives == (p == 'neg'))
+                        idx = numpy.searchsorted(result['bounds_%s_' % p + str(elec)], ext_amps[group], side='right')
+                        hists[group] = result['hist_%s_' % p + str(elec)][idx - 1]
+
+        # Greedy selection, in random order.
+        selected = []
+        nb_rejected = 0
+        nb_noisy = 0
+        for count in range(nb_candidates):
+            if len(selected) == nb_max:
+                break
+            elec = elecs[count]
+            negative = int(negatives[count])
+            midx = peaks[count]
+            if counts[negative, elec] >= loop_max_elts_elec:
+                continue
+            if safety_space:
+                if all_times[nodes_indices[elec], min_times[midx]:max_times[midx]].any():
+                    continue
+            elif all_times[elec, min_times[midx]:max_times[midx]].any():
+                continue
+            if is_noise[count]:
+                nb_noisy += 1
+                if gpass <= 1:
+                    result['noise_times_' + str(elec)].append([chunk['peaktimes'][midx] + chunk['info'][0]])
+                continue
+            if not is_isolated[count]:
+                continue
+            if gpass == 1 and smart_searches[['pos', 'neg'][negative]][elec] > 0:
+                if not hists[count] < numpy.random.rand():
+                    nb_rejected += 1
+                    continue
+            selected.append(count)
+            counts[negative, elec] += 1
+            if safety_space:
+                all_times[nodes_indices[elec], min_times[midx]:max_times[midx]] = True
+            else:
+                all_times[elec, min_times[midx]:max_times[midx]] = True
+
+        # Waveforms of the selected peaks, by electrode (in the order of the selection).
+        selected = numpy.array(selected, dtype=numpy.int64)
+        for elec in numpy.unique(elecs[selected]):
+            group = selected[elecs[selected] == elec]
+            if gpass >= 1:
+                times = chunk['peaktimes'][peaks[group]] + chunk['info'][0]
+                result['loc_times_' + str(elec)].append(times.astype(numpy.uint32))
+            if gpass == 1:
+                result['peaks_' + str(elec)].append(negatives[group].astype(int))
+            for p in search_peaks:
+                sub_group = group[negatives[group] == (p == 'neg')]
+                if len(sub_group) == 0:
+                    continue
+                result['count_%s_' % p + str(elec)] = counts[int(p == 'neg'), elec]
+                if gpass == 0:
+                    result['tmp_%s_' % p + str(elec)].append(ext_amps[sub_group])
+                    continue
+                sub_mat = aligned[sub_group][:, :, :len(nodes_indices[elec])]
+                if use_hanning:
+                    sub_mat = sub_mat * hanning_filter
+                sub_mat = numpy.matmul(basis['rec_%s' % p], sub_mat).reshape((len(sub_group), -1))
+                if gpass == 1:
+                    result['data_%s_' % p + str(elec)].append(sub_mat)
+                else:
+                    result['tmp_%s_' % p + str(elec)].append(numpy.dot(sub_mat, result['pca_%s_' % p + str(elec)]))
+
+        return len(selected), nb_rejected, nb_noisy
+
+    def get_dist_file(p, ielec):
+        return os.path.join(result['dist_path'], 'dist_%s_' % p + str(ielec) + '.npy')
+
+    def cluster_electrode(ielec):
+        # Heavy computations of the current pass for one electrode (PCA, densities, clustering and merging), which
+        # can be run by local workers (see forked_imap): everything needed afterwards is returned, not stored, apart
+        # from the distance matrix, saved by the worker itself instead of being sent back through a pipe.
+        outputs = {}
+        for p in search_peaks:
+            outputs[p] = {}
+            dist = None
+            if gpass == 1:
+                if len(result['data_%s_' % p + str(ielec)]) >= 1:
+                    pca = result['pca_%s_' % p + str(ielec)]
+                    if pca is None:
+                        if result['data_%s_' % p + str(ielec)].shape[1] > sub_output_dim:
+                            model = PCA(sub_output_dim)
+                            model.fit(result['data_%s_' % p + str(ielec)])
+                            pca = model.components_.T.astype(numpy.float32)
+                            outputs[p]['explained_variance'] = float(numpy.sum(model.explained_variance_ratio_))
+                        else:
+                            dimension = result['data_%s_' % p + str(ielec)].shape[1]
+                            pca = numpy.zeros((dimension, sub_output_dim), dtype=numpy.float32)
+                            pca[numpy.arange(dimension), numpy.arange(dimension)] = 1
+                    outputs[p]['pca'] = pca
+                    outputs[p]['sub'] = numpy.dot(result['data_%s_' % p + str(ielec)], pca)
+                    # In knn mode, no distance matrix is kept, deltas are computed from the data at the last pass.
+                    if density_mode == 'knn':
+                        outputs[p]['rho'], outputs[p]['sdist'] = algo.compute_rho_knn(
+                            outputs[p]['sub'], mratio=m_ratio
+                        )
+                    else:
+                        outputs[p]['rho'], dist, outputs[p]['sdist'] = algo.compute_rho(
+                            outputs[p]['sub'], mratio=m_ratio
+                        )
+                        dist = dist.distances
+                        numpy.save(get_dist_file(p, ielec), dist)
+            elif gpass > 1:
+                if len(result['tmp_%s_' % p + str(ielec)]) > 1:
+                    if density_mode == 'knn':
+                        compute_rho = algo.compute_rho_knn
+                    else:
+                        compute_rho = algo.compute_rho
+                    outputs[p]['rho'], outputs[p]['sdist'] = compute_rho(
+                        result['sub_%s_' % p + str(ielec)],
+                        update=(result['tmp_%s_' % p + str(ielec)], result['sdist_%s_' % p + str(ielec)]),
+                        mratio=m_ratio
+                    )
+
+            if gpass == nb_repeats and len(result['data_%s_' % p + str(ielec)]) > 1:
+                sub = outputs[p].get('sub', result.get('sub_%s_' % p + str(ielec)))
+                rho = outputs[p].get('rho', result.get('rho_%s_' % p + str(ielec)))
+                if density_mode != 'knn' and dist is None:
+                    dist = numpy.load(get_dist_file(p, ielec))
+                groups, r, d, c = algo.clustering_by_density(
+                    -rho + rho.max(), dist, n_min=n_abs_min, alpha=sensitivity,
+                    halo_rejection=halo_rejection, data=sub
+                )
+                outputs[p]['old_allocation'] = numpy.copy(groups)
+                outputs[p]['groups'], outputs[p]['merged'], outputs[p]['merge_history'] = algo.merging(
+                    groups, merging_method, merging_param, sub
+                )
+                outputs[p]['delta'], outputs[p]['labels'] = d, c
+                del dist, r
+
+        return ielec, outputs
+
     while gpass < (nb_repeats + 1):
 
         comm.Barrier()
@@ -304,7 +746,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                     result['loc_times_' + str(i)], comm, dtype='uint32', compress=blosc_compress
                 )
             ))
-            result['loc_times_' + str(i)] = numpy.zeros(0, dtype=numpy.uint32)
+            result['loc_times_' + str(i)] = [numpy.zeros(0, dtype=numpy.uint32)]
 
             if gpass == 1:
                 n_neighb = len(edges[nodes[i]])
@@ -357,6 +799,10 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         elt_count = 0
         nb_noise = 0
 
+        if peak_cache is not None:
+            # Chunks of the cache first (in the same random order), to avoid going back to the raw data.
+            to_explore = sorted(to_explore, key=lambda i: all_chunks[i] not in peak_cache)
+
         if comm.rank == 0:
             to_explore = get_tqdm_progressbar(to_explore)
 
@@ -366,111 +812,14 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         for gcount, gidx in enumerate(to_explore):
 
             gidx = all_chunks[gidx]
-            is_first = data_file.is_first_chunk(gidx, nb_chunks)
-            is_last = data_file.is_last_chunk(gidx, nb_chunks)
-
-            if is_last:
-                padding = (-duration, 0)
-            elif is_first:
-                padding = (0, duration)
-            else:
-                padding = (-duration, duration)
 
             if elt_count < loop_nb_elts:
                 # print "Node", comm.rank, "is analyzing chunk", gidx, "/", nb_chunks, " ..."
-                local_chunk, t_offset = data_file.get_data(gidx, chunk_size, padding, nodes=nodes)
-                local_shape = len(local_chunk)
-                if do_spatial_whitening:
-                    if use_gpu:
-                        local_chunk = cmt.CUDAMatrix(local_chunk, copy_on_host=False)
-                        local_chunk = local_chunk.dot(spatial_whitening).asarray()
-                    else:
-                        local_chunk = numpy.dot(local_chunk, spatial_whitening)
-                if do_temporal_whitening:
-                    local_chunk = scipy.ndimage.filters.convolve1d(
-                        local_chunk, temporal_whitening, axis=0, mode='constant'
-                    )
-
-                # Extracting the peaks.
-                all_peaktimes = [numpy.empty(0, dtype=numpy.uint32)]
-                all_extremas = [numpy.empty(0, dtype=numpy.uint32)]
-
-                if matched_filter:
-
-                    if sign_peaks in ['positive', 'both']:
-                        filter_chunk = scipy.ndimage.filters.convolve1d(
-                            local_chunk, waveform_pos, axis=0, mode='constant'
-                        )
-                        for i in range(n_e):
-                            peaktimes = scipy.signal.find_peaks(
-                                filter_chunk[:, i], height=matched_thresholds_pos[i],
-                                width=spike_width, distance=dist_peaks, wlen=n_t
-                            )[0]
-                            peaktimes = peaktimes.astype(numpy.uint32)
-                            all_peaktimes.append(peaktimes)
-                            extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
-                            all_extremas.append(extremas)
-
-                    if sign_peaks in ['negative', 'both']:
-                        filter_chunk = scipy.ndimage.filters.convolve1d(
-                            local_chunk, waveform_neg, axis=0, mode='constant'
-                        )
-                        for i in range(n_e):
-                            peaktimes = scipy.signal.find_peaks(
-                                filter_chunk[:, i], height=matched_thresholds_neg[i],
-                                width=spike_width, distance=dist_peaks, wlen=n_t
-                            )[0]
-                            peaktimes = peaktimes.astype(numpy.uint32)
-                            all_peaktimes.append(peaktimes)
-                            extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
-                            all_extremas.append(extremas)
-
-                else:
-
-                    for i in range(n_e):
-                        x = local_chunk[:, i]
-                        height = thresholds[i]
-                        if sign_peaks == 'negative':
-                            peaktimes = scipy.signal.find_peaks(
-                                -x, height=height, width=spike_width, distance=dist_peaks, wlen=n_t
-                            )[0]
-                        elif sign_peaks == 'positive':
-                            peaktimes = scipy.signal.find_peaks(
-                                +x, height=height, width=spike_width, distance=dist_peaks, wlen=n_t
-                            )[0]
-                        elif sign_peaks == 'both':
-                            peaktimes = scipy.signal.find_peaks(
-                                numpy.abs(x), height=height, width=spike_width, distance=dist_peaks, wlen=n_t
-                            )[0]
-                        else:
-                            peaktimes = numpy.empty(0, dtype=numpy.uint32)
-                        peaktimes.astype(numpy.uint32)
-                        all_peaktimes.append(peaktimes)
-                        extremas = i * numpy.ones(len(peaktimes), dtype=numpy.uint32)
-                        all_extremas.append(extremas)
-
-                all_peaktimes = numpy.concatenate(all_peaktimes)  # i.e. concatenate once for efficiency
-                all_extremas = numpy.concatenate(all_extremas)  # i.e. concatenate once for efficiency
-
-                # print "Removing the useless borders..."
-                local_borders = (duration, local_shape - duration)
-
-                idx = (all_peaktimes >= local_borders[0]) & (all_peaktimes < local_borders[1])
-                all_peaktimes = numpy.compress(idx, all_peaktimes)
-                all_extremas = numpy.compress(idx, all_extremas)
-
-                local_peaktimes = numpy.unique(all_peaktimes)
-                local_offset = t_offset + padding[0]
-
-                if ignore_dead_times:
-                    dead_indices = numpy.searchsorted(all_dead_times, [t_offset, t_offset + local_shape])
-                    if dead_indices[0] != dead_indices[1]:
-                        is_included = numpy.in1d(
-                            local_peaktimes + t_offset,
-                            all_dead_times[dead_indices[0]:dead_indices[1]]
-                        )
-                        local_peaktimes = local_peaktimes[~is_included]
-                        local_peaktimes = numpy.sort(local_peaktimes)
+                chunk = get_chunk_peaks(gidx)
+                local_peaktimes = chunk['peaktimes']
+                all_peaktimes = chunk['all_peaktimes']
+                all_extremas = chunk['all_extremas']
+                local_offset, local_shape = [int(value) for value in chunk['info']]
 
                 if gpass == 0:
                     for i in range(comm.rank, n_e, comm.size):
@@ -488,6 +837,10 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                     n_times = len(local_peaktimes)
                     argmax_peak = numpy.random.permutation(numpy.arange(n_times))
                     all_idx = numpy.take(local_peaktimes, argmax_peak)
+                    if 'data' in chunk:
+                        snippet_windows = get_snippet_windows(chunk['data'], 2 * duration + 1)
+                    else:
+                        snippet_windows = None  # snippets are in the cache
 
                     if gpass > 1:
                         for elec in range(n_e):
@@ -503,178 +856,155 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                                     all_times[elec, min_times[t]:max_times[t]] = True
 
                     # print "Selection of the peaks with spatio-temporal masks..."
-                    for midx, peak in zip(argmax_peak, all_idx):
-
-                        if elt_count == loop_nb_elts:
-                            break
-
-                        is_isolated = True
-                        to_accept = False
-                        max_test = True
-
-                        negative_peak = None  # default assignment (for PyCharm code inspection)
-                        loc_peak = None  # default assignment (for PyCharm code inspection)
-                        if sign_peaks == 'negative':
-                            elec = numpy.argmin(local_chunk[peak])
-                            negative_peak = True
-                            loc_peak = 'neg'
-                        elif sign_peaks == 'positive':
-                            elec = numpy.argmax(local_chunk[peak])
-                            negative_peak = False
-                            loc_peak = 'pos'
-                        elif sign_peaks == 'both':
-                            if n_e == 1:
-                                elec = 0
-                                if local_chunk[peak] < 0:
-                                    negative_peak = True
-                                    loc_peak = 'neg'
-                                elif local_chunk[peak] > 0:
-                                    negative_peak = False
-                                    loc_peak = 'pos'
+                    if selection_engine == 'batch':
+                        nb_selected, nb_rejected, nb_noisy = select_peaks(
+                            chunk, argmax_peak, all_times, min_times, max_times, loop_nb_elts - elt_count
+                        )
+                        elt_count += nb_selected
+                        rejected += nb_rejected
+                        nb_noise += nb_noisy
+                    else:
+                        for midx, peak in zip(argmax_peak, all_idx):
+
+                            if elt_count == loop_nb_elts:
+                                break
+
+                            is_isolated = True
+                            to_accept = False
+                            max_test = True
+
+                            elec = chunk['elecs'][midx]
+                            negative_peak = bool(chunk['negative'][midx])
+                            if negative_peak:
+                                loc_peak = 'neg'
                             else:
-                                if numpy.abs(numpy.max(local_chunk[peak])) > numpy.abs(numpy.min(local_chunk[peak])):
-                                    elec = numpy.argmax(local_chunk[peak])
-                                    negative_peak = False
-                                    loc_peak = 'pos'
-                                else:
-                                    elec = numpy.argmin(local_chunk[peak])
-                                    negative_peak = True
-                                    loc_peak = 'neg'
-                        else:
-                            raise ValueError("unexpected value %s" % sign_peaks)
+                                loc_peak = 'pos'
 
-                        key = '%s_%s' % (loc_peak, str(elec))
+                            key = '%s_%s' % (loc_peak, str(elec))
 
-                        if (gpass > 1) or (numpy.mod(elec, comm.size) == comm.rank):
+                            if (gpass > 1) or (numpy.mod(elec, comm.size) == comm.rank):
 
-                            if result['count_%s' % key] < loop_max_elts_elec:
+                                if result['count_%s' % key] < loop_max_elts_elec:
 
-                                indices = nodes_indices[elec]
+                                    indices = nodes_indices[elec]
 
-                                if safety_space:
-                                    myslice = all_times[indices, min_times[midx]:max_times[midx]]
-                                else:
-                                    myslice = all_times[elec, min_times[midx]:max_times[midx]]
-
-                                if not myslice.any():
-
-                                    sub_mat = numpy.take(
-                                        local_chunk[peak - duration:peak + duration + 1], indices, axis=1
-                                    )
-
-                                    # # test if the sample is pure Gaussian noise
-                                    if reject_noise:
-                                        slice_window = sub_mat[duration - noise_window: duration + noise_window]
-                                        values = \
-                                            numpy.linalg.norm(slice_window, axis=0) / (stds[indices] * 2 * noise_window)
-                                        is_noise = numpy.all(
-                                            values < rejection_threshold
-                                        )
+                                    if safety_space:
+                                        myslice = all_times[indices, min_times[midx]:max_times[midx]]
                                     else:
-                                        is_noise = False
+                                        myslice = all_times[elec, min_times[midx]:max_times[midx]]
 
-                                    if not is_noise:
+                                    if not myslice.any():
 
-                                        if isolation and gpass == 1:
+                                        if snippet_windows is not None:
+                                            sub_mat = numpy.take(snippet_windows[peak - duration], indices, axis=1)
+                                        else:
+                                            sub_mat = numpy.array(chunk['snippets'][midx, :, :len(indices)])
 
-                                            nearby_peaks = numpy.abs(all_peaktimes - peak) < safety_time
-                                            vicinity_peaks = all_peaktimes[nearby_peaks]
-                                            vicinity_extremas = all_extremas[nearby_peaks]
-                                            extremas = local_chunk[vicinity_peaks, vicinity_extremas]
+                                        # # test if the sample is pure Gaussian noise
+                                        if reject_noise:
+                                            slice_window = sub_mat[duration - noise_window: duration + noise_window]
+                                            norms = numpy.linalg.norm(slice_window, axis=0)
+                                            values = norms / (stds[indices] * 2 * noise_window)
+                                            is_noise = numpy.all(
+                                                values < rejection_threshold
+                                            )
+                                        else:
+                                            is_noise = False
 
-                                            nearby = numpy.in1d(vicinity_extremas, indices)
-                                            to_consider = extremas[nearby]
-
-                                            if len(to_consider) > 0:
-                                                if negative_peak:
-                                                    if numpy.any(to_consider < local_chunk[peak, elec]):
-                                                        is_isolated = False
-                                                else:
-                                                    if numpy.any(to_consider > local_chunk[peak, elec]):
-                                                        is_isolated = False
+                                        if not is_noise:
 
-                                        if is_isolated:
+                                            if isolation and gpass == 1:
 
-                                            if alignment:
+                                                nearby_peaks = numpy.abs(all_peaktimes - peak) < safety_time
+                                                vicinity_extremas = all_extremas[nearby_peaks]
+                                                extremas = chunk['all_amplitudes'][nearby_peaks]
 
-                                                local_factor = align_factor * ((smoothing_factor * mads[elec]) ** 2)
+                                                nearby = numpy.in1d(vicinity_extremas, indices)
+                                                to_consider = extremas[nearby]
 
-                                                if len(indices) == 1:
-                                                    smoothed = True
-                                                    try:
-                                                        f = scipy.interpolate.UnivariateSpline(
-                                                            xdata, sub_mat, s=local_factor, k=3
-                                                        )
-                                                    except Exception:
-                                                        smoothed = False
-                                                        f = scipy.interpolate.UnivariateSpline(xdata, sub_mat, k=3, s=0)
-                                                    if negative_peak:
-                                                        rmin = (numpy.argmin(f(cdata)) - xoff) / over_factor
-                                                    else:
-                                                        rmin = (numpy.argmax(f(cdata)) - xoff) / over_factor
-                                                    if smoothed:
-                                                        f = scipy.interpolate.UnivariateSpline(xdata, sub_mat, s=0, k=3)
-                                                    ddata = numpy.linspace(
-                                                        rmin - template_shift, rmin + template_shift, n_t
-                                                    )
-                                                    sub_mat = f(ddata).astype(numpy.float32).reshape(n_t, 1)
-                                                else:
-                                                    idx = elec_positions[elec]
-                                                    ydata = elec_ydata[elec]
-                                                    try:
-                                                        f = scipy.interpolate.UnivariateSpline(
-                                                            xdata, sub_mat[:, idx], s=local_factor, k=3
-                                                        )
-                                                    except Exception:
-                                                        f = scipy.interpolate.UnivariateSpline(
-                                                            xdata, sub_mat[:, idx], k=3, s=0
-                                                        )
+                                                if len(to_consider) > 0:
                                                     if negative_peak:
-                                                        rmin = (numpy.argmin(f(cdata)) - xoff) / over_factor
+                                                        if numpy.any(to_consider < chunk['amplitudes'][midx]):
+                                                            is_isolated = False
                                                     else:
-                                                        rmin = (numpy.argmax(f(cdata)) - xoff) / over_factor
-                                                    f = scipy.interpolate.RectBivariateSpline(
-                                                        xdata, ydata, sub_mat, s=0, kx=3, ky=1
-                                                    )
-                                                    ddata = numpy.linspace(
-                                                        rmin - template_shift, rmin + template_shift, n_t
-                                                    )
-                                                    sub_mat = f(ddata, ydata).astype(numpy.float32)
-
-                                            # if negative_peak:
-                                            #     max_test = \
-                                            #         numpy.argmin(sub_mat[template_shift]) == elec_positions[elec][0]
-                                            # else:
-                                            #     max_test = \
-                                            #         numpy.argmax(sub_mat[template_shift]) == elec_positions[elec][0]
-
-                                            if max_test:
-                                                if gpass == 0:
-                                                    to_accept = True
-                                                    ext_amp = sub_mat[template_shift, elec_positions[elec]]
-                                                    result['tmp_%s_' % loc_peak + str(elec)].append(ext_amp)
-                                                elif gpass == 1:
-
-                                                    if smart_searches[loc_peak][elec] > 0:
+                                                        if numpy.any(to_consider > chunk['amplitudes'][midx]):
+                                                            is_isolated = False
 
-                                                        ext_amp = sub_mat[template_shift, elec_positions[elec]]
-                                                        idx = numpy.searchsorted(
-                                                            result['bounds_%s_' % loc_peak + str(elec)], ext_amp,
-                                                            side='right'
-                                                        )
-                                                        idx = idx - 1
-                                                        hist = result['hist_%s_' % loc_peak + str(elec)][idx]
-                                                        to_keep = hist < numpy.random.rand()
+                                            if is_isolated:
 
-                                                        if to_keep:
-                                                            to_accept = True
-                                                        else:
-                                                            rejected += 1
+                                                if alignment and 'aligned' in chunk and chunk['is_aligned'][midx]:
+
+                                                    sub_mat = numpy.array(chunk['aligned'][midx, :, :len(indices)])
+
+                                                elif alignment and alignment_engine == 'kernels':
 
+                                                    if len(indices) == 1:
+                                                        channel = 0
                                                     else:
+                                                        channel = elec_positions[elec][0]
+                                                    sub_mat = align_snippets(
+                                                        sub_mat[numpy.newaxis], search_kernel, shift_kernels, channel,
+                                                        negative_peak
+                                                    )[0]
+
+                                                elif alignment:
+
+                                                    sub_mat = align_with_splines(sub_mat, elec, negative_peak)
+
+                                                if alignment and 'aligned' in chunk and not chunk['is_aligned'][midx]:
+                                                    chunk['aligned'][midx, :, :len(indices)] = sub_mat
+                                                    chunk['is_aligned'][midx] = True
+
+                                                # if negative_peak:
+                                                #     max_test = \
+                                                #         numpy.argmin(sub_mat[template_shift]) == \
+                                                #         elec_positions[elec][0]
+                                                # else:
+                                                #     max_test = \
+                                                #         numpy.argmax(sub_mat[template_shift]) == \
+                                                #         elec_positions[elec][0]
+
+                                                if max_test:
+                                                    if gpass == 0:
                                                         to_accept = True
+                                                        ext_amp = sub_mat[template_shift, elec_positions[elec]]
+                                                        result['tmp_%s_' % loc_peak + str(elec)].append(ext_amp)
+                                                    elif gpass == 1:
+
+                                                        if smart_searches[loc_peak][elec] > 0:
 
-                                                    if to_accept:
+                                                            ext_amp = sub_mat[template_shift, elec_positions[elec]]
+                                                            idx = numpy.searchsorted(
+                                                                result['bounds_%s_' % loc_peak + str(elec)], ext_amp,
+                                                                side='right'
+                                                            )
+                                                            idx = idx - 1
+                                                            hist = result['hist_%s_' % loc_peak + str(elec)][idx]
+                                                            to_keep = hist < numpy.random.rand()
+
+                                                            if to_keep:
+                                                                to_accept = True
+                                                            else:
+                                                                rejected += 1
+
+                                                        else:
+                                                            to_accept = True
+
+                                                        if to_accept:
+
+                                                            if use_hanning:
+                                                                sub_mat *= hanning_filter
+
+                                                            sub_mat = numpy.dot(basis['rec_%s' % loc_peak], sub_mat)
+                                                            nx, ny = sub_mat.shape
+                                                            sub_mat = sub_mat.reshape((1, nx * ny))
+                                                            # result['data_%s_' % loc_peak + str(elec)] = numpy.vstack((
+                                                            #     result['data_%s_' % loc_peak + str(elec)],
+                                                            #     sub_mat
+                                                            # ))
+                                                            result['data_%s_' % loc_peak + str(elec)].append(sub_mat)
+
+                                                    else:
 
                                                         if use_hanning:
                                                             sub_mat *= hanning_filter
@@ -682,52 +1012,36 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                                                         sub_mat = numpy.dot(basis['rec_%s' % loc_peak], sub_mat)
                                                         nx, ny = sub_mat.shape
                                                         sub_mat = sub_mat.reshape((1, nx * ny))
-                                                        # result['data_%s_' % loc_peak + str(elec)] = numpy.vstack((
-                                                        #     result['data_%s_' % loc_peak + str(elec)],
+                                                        sub_mat = numpy.dot(
+                                                            sub_mat, result['pca_%s_' % loc_peak + str(elec)]
+                                                        )
+                                                        to_accept = True
+                                                        # result['tmp_%s_' % loc_peak + str(elec)] = numpy.vstack((
+                                                        #     result['tmp_%s_' % loc_peak + str(elec)],
                                                         #     sub_mat
                                                         # ))
-                                                        result['data_%s_' % loc_peak + str(elec)].append(sub_mat)
-
+                                                        result['tmp_%s_' % loc_peak + str(elec)].append(sub_mat)
+
+                                            if to_accept:
+                                                elt_count += 1
+                                                result['count_%s_' % loc_peak + str(elec)] += 1
+                                                if gpass >= 1:
+                                                    to_add = numpy.array([peak + local_offset], dtype=numpy.uint32)
+                                                    result['loc_times_' + str(elec)].append(to_add)
+                                                if gpass == 1:
+                                                    negative_peaks = numpy.array([int(negative_peak)])
+                                                    result['peaks_' + str(elec)].append(negative_peaks)
+                                                if safety_space:
+                                                    all_times[indices, min_times[midx]:max_times[midx]] = True
                                                 else:
-
-                                                    if use_hanning:
-                                                        sub_mat *= hanning_filter
-
-                                                    sub_mat = numpy.dot(basis['rec_%s' % loc_peak], sub_mat)
-                                                    nx, ny = sub_mat.shape
-                                                    sub_mat = sub_mat.reshape((1, nx * ny))
-                                                    sub_mat = numpy.dot(
-                                                        sub_mat, result['pca_%s_' % loc_peak + str(elec)]
-                                                    )
-                                                    to_accept = True
-                                                    # result['tmp_%s_' % loc_peak + str(elec)] = numpy.vstack((
-                                                    #     result['tmp_%s_' % loc_peak + str(elec)],
-                                                    #     sub_mat
-                                                    # ))
-                                                    result['tmp_%s_' % loc_peak + str(elec)].append(sub_mat)
-
-                                        if to_accept:
-                                            elt_count += 1
-                                            result['count_%s_' % loc_peak + str(elec)] += 1
-                                            if gpass >= 1:
-                                                to_add = numpy.array([peak + local_offset], dtype=numpy.uint32)
-                                                result['loc_times_' + str(elec)] = numpy.concatenate((
-                                                    result['loc_times_' + str(elec)],
-                                                    to_add
-                                                ))
-                                            if gpass == 1:
-                                                negative_peaks = numpy.array([int(negative_peak)])
-                                                result['peaks_' + str(elec)].append(negative_peaks)
-                                            if safety_space:
-                                                all_times[indices, min_times[midx]:max_times[midx]] = True
-                                            else:
-                                                all_times[elec, min_times[midx]:max_times[midx]] = True
-                                    else:
-                                        nb_noise += 1
-                                        if gpass <= 1:
-                                            result['noise_times_' + str(elec)].append([peak + local_offset])
+                                                    all_times[elec, min_times[midx]:max_times[midx]] = True
+                                        else:
+                                            nb_noise += 1
+                                            if gpass <= 1:
+                                                result['noise_times_' + str(elec)].append([peak + local_offset])
 
         for elec in range(n_e):
+            result['loc_times_' + str(elec)] = numpy.concatenate(result['loc_times_' + str(elec)])
             if gpass == 1:
                 result['noise_times_' + str(elec)] = numpy.concatenate(result['noise_times_' + str(elec)]).astype(numpy.uint32)
             for p in search_peaks:
@@ -813,25 +1127,27 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 os.makedirs(plot_path)
 
         if gpass == 1:
-            dist_file = tempfile.NamedTemporaryFile()
-            tmp_file = os.path.join(tmp_path_loc, os.path.basename(dist_file.name)) + '.hdf5'
-            dist_file.close()
-            result['dist_file'] = tmp_file
-            tmp_h5py = h5py.File(result['dist_file'], 'w', libver='earliest')
-            print_and_log(["Node %d will use temp file %s" % (comm.rank, tmp_file)], 'debug', logger)
-        elif gpass > 1:
-            tmp_h5py = h5py.File(result['dist_file'], 'r', libver='earliest')
-        else:
-            tmp_h5py = None  # default assignment (for PyCharm code inspection)
+            # The workers only write there, and must not use the HDF5 files opened by this process (see forked_imap).
+            result['dist_path'] = tempfile.mkdtemp(prefix='dist_', dir=tmp_path_loc)
+            print_and_log(["Node %d will use temp folder %s" % (comm.rank, result['dist_path'])], 'debug', logger)
 
         to_explore = range(comm.rank, n_e, comm.size)
+        if gpass >= 1:
+            # Largest electrodes first, so that the longest jobs are not the last ones.
+            to_explore = sorted(to_explore, key=lambda elec: -sum(
+                [len(result['data_%s_' % p + str(elec)]) for p in search_peaks]
+            ))
+            electrodes = forked_imap(cluster_electrode, to_explore, nb_workers)
+        else:
+            electrodes = forked_imap(cluster_electrode, to_explore)  # nothing heavy
+
         sys.stderr.flush()
 
         if (comm.rank == 0) and gpass == nb_repeats:
             print_and_log(["Running density-based clustering..."], 'default', logger)
-            to_explore = get_tqdm_progressbar(to_explore)
+            electrodes = get_tqdm_progressbar(electrodes, total=len(to_explore))
 
-        for ielec in to_explore:
+        for ielec, outputs in electrodes:
 
             for p in search_peaks:
                 cluster_results[p][ielec] = {}
@@ -901,43 +1217,23 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 elif gpass == 1:
                     if len(result['data_%s_' % p + str(ielec)]) >= 1:
 
-                        if result['pca_%s_' % p + str(ielec)] is None:
-
-                            if result['data_%s_' % p + str(ielec)].shape[1] > sub_output_dim:
-                                pca = PCA(sub_output_dim)
-                                pca.fit(result['data_%s_' % p + str(ielec)])
-                                result['pca_%s_' % p + str(ielec)] = pca.components_.T.astype(numpy.float32)
-                                print_and_log([
-                                    "The variance explained by local PCA on electrode %s from %d %s spikes is %g with"
-                                    " %d dimensions" % (
-                                        ielec,
-                                        len(result['data_%s_' % p + str(ielec)]),
-                                        p,
-                                        float(numpy.sum(pca.explained_variance_ratio_)),
-                                        result['pca_%s_' % p + str(ielec)].shape[1]
-                                    )
-                                ], 'debug', logger)
-                            else:
-                                dimension = result['data_%s_' % p + str(ielec)].shape[1]
-                                result['pca_%s_' % p + str(ielec)] = numpy.zeros(
-                                    (dimension, sub_output_dim), dtype=numpy.float32
+                        if 'explained_variance' in outputs[p]:
+                            print_and_log([
+                                "The variance explained by local PCA on electrode %s from %d %s spikes is %g with"
+                                " %d dimensions" % (
+                                    ielec,
+                                    len(result['data_%s_' % p + str(ielec)]),
+                                    p,
+                                    outputs[p]['explained_variance'],
+                                    outputs[p]['pca'].shape[1]
                                 )
-                                result['pca_%s_' % p + str(ielec)][numpy.arange(dimension), numpy.arange(dimension)] = 1
+                            ], 'debug', logger)
 
-                        result['sub_%s_' % p + str(ielec)] = numpy.dot(
-                            result['data_%s_' % p + str(ielec)], result['pca_%s_' % p + str(ielec)]
-                        )
+                        result['pca_%s_' % p + str(ielec)] = outputs[p]['pca']
+                        result['sub_%s_' % p + str(ielec)] = outputs[p]['sub']
+                        result['rho_%s_' % p + str(ielec)] = outputs[p]['rho']
+                        result['sdist_%s_' % p + str(ielec)] = outputs[p]['sdist']
 
-                        rho, dist, sdist = algo.compute_rho(result['sub_%s_' % p + str(ielec)], mratio=m_ratio)
-                        result['rho_%s_' % p + str(ielec)] = rho
-                        result['sdist_%s_' % p + str(ielec)] = sdist
-                        if hdf5_compress:
-                            tmp_h5py.create_dataset(
-                                'dist_%s_' % p + str(ielec), data=dist.distances, chunks=True, compression='gzip'
-                            )
-                        else:
-                            tmp_h5py.create_dataset('dist_%s_' % p + str(ielec), data=dist.distances, chunks=True)
-                        del dist, rho
                     else:
                         if result['pca_%s_' % p + str(ielec)] is None:
                             n_neighb = len(edges[nodes[ielec]])
@@ -952,15 +1248,8 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         result['sdist_%s_' % p + str(ielec)] = numpy.zeros(0, dtype=numpy.float32)
                 else:
                     if len(result['tmp_%s_' % p + str(ielec)]) > 1:
-
-                        rho, sdist = algo.compute_rho(
-                            result['sub_%s_' % p + str(ielec)],
-                            update=(result['tmp_%s_' % p + str(ielec)], result['sdist_%s_' % p + str(ielec)]),
-                            mratio=m_ratio
-                        )
-                        result['rho_%s_' % p + str(ielec)] = rho
-                        result['sdist_%s_' % p + str(ielec)] = sdist
-                        del rho
+                        result['rho_%s_' % p + str(ielec)] = outputs[p]['rho']
+                        result['sdist_%s_' % p + str(ielec)] = outputs[p]['sdist']
 
                 if gpass == nb_repeats:  # i.e. last pass (during which clustering is done)
 
@@ -977,24 +1266,16 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         raise ValueError("Unexpected value %s" % p)
 
                     if n_data > 1:
-                        dist = tmp_h5py.get('dist_%s_' % p + str(ielec))[:]
                         result['rho_%s_' % p + str(ielec)] = \
                             -result['rho_%s_' % p + str(ielec)] + result['rho_%s_' % p + str(ielec)].max()
 
-                        # Now we perform the clustering.
-                        cluster_results[p][ielec]['groups'], r, d, c = algo.clustering_by_density(
-                            result['rho_%s_' % p + str(ielec)], dist, n_min=n_min, alpha=sensitivity,
-                            halo_rejection=halo_rejection
-                        )
-
+                        # The clustering, and the merging step for clusters that look too similar, were performed by
+                        # cluster_electrode.
+                        d, c = outputs[p]['delta'], outputs[p]['labels']
                         result['delta_%s_' % p + str(ielec)] = d  # i.e. save delta values
-
-                        # Now we perform a merging step, for clusters that look too similar.
-                        old_allocation = np.copy(cluster_results[p][ielec]['groups'])
-                        cluster_results[p][ielec]['groups'], merged, merge_history = algo.merging(
-                            cluster_results[p][ielec]['groups'], merging_method,
-                            merging_param, result['sub_%s_' % p + str(ielec)]
-                        )
+                        old_allocation = outputs[p]['old_allocation']
+                        cluster_results[p][ielec]['groups'] = outputs[p]['groups']
+                        merged, merge_history = outputs[p]['merged'], outputs[p]['merge_history']
 
                         # Remove clusters without a sufficient number of points.
                         idx_clusters, counts = numpy.unique(cluster_results[p][ielec]['groups'], return_counts=True)
@@ -1086,7 +1367,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         ]
                         print_and_log(line, 'debug', logger)
                         local_mergings += merged[1]
-                        del dist, d, c
+                        del d, c
                     else:
                         cluster_results[p][ielec]['groups'] = numpy.zeros(0, dtype=numpy.int32)
                         cluster_results[p][ielec]['n_clus'] = 0
@@ -1097,8 +1378,6 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
                     local_nb_clusters += cluster_results[p][ielec]['n_clus']
 
-        if gpass >= 1:
-            tmp_h5py.close()
         gpass += 1
 
     # Final concatenations (for efficiency).
@@ -1106,10 +1385,10 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         result['peaks_' + str(elec)] = numpy.concatenate(result['peaks_' + str(elec)])
 
     sys.stderr.flush()
-    try:
-        os.remove(result['dist_file'])
-    except OSError:
-        pass
+    if 'dist_path' in result:
+        shutil.rmtree(result['dist_path'], ignore_errors=True)
+    if peak_cache is not None:
+        peak_cache.close()
 
     comm.Barrier()
 
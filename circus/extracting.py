@@ -27,6 +27,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     nodes, edges = get_nodes_and_edges(params)
     safety_time = params.getint('extracting', 'safety_time')
     max_elts_temp = params.getint('extracting', 'max_elts')
+    prefetch = params.getint('data', 'prefetch')
     output_dim = params.getfloat('extracting', 'output_dim')
     noise_thr = params.getfloat('extracting', 'noise_thr')
     hdf5_compress = params.getboolean('data', 'hdf5_compress')
@@ -36,7 +37,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     elt_count = 0
     inv_nodes = numpy.zeros(N_total, dtype=numpy.int32)
     inv_nodes[nodes] = numpy.arange(len(nodes))
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if comm.rank == 0:
@@ -89,72 +90,87 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     if comm.rank == 0:
         to_explore = get_tqdm_progressbar(to_explore)
 
-    for gidx in all_chunks:
-
-        if elt_count < nb_elts:
-            # print "Node", comm.rank, "is analyzing chunk", gidx, "/", nb_chunks, " ..."
-            local_chunk, t_offset = data_file.get_data(gidx, chunk_size, nodes=nodes)
-            local_shape = len(local_chunk)
-
-            if do_spatial_whitening:
-                if use_gpu:
-                    local_chunk = cmt.CUDAMatrix(local_chunk, copy_on_host=False)
-                    local_chunk = local_chunk.dot(spatial_whitening).asarray()
-                else:
-                    local_chunk = numpy.dot(local_chunk, spatial_whitening)
-            if do_temporal_whitening:
-                local_chunk = scipy.ndimage.filters.convolve1d(local_chunk, temporal_whitening, axis=0, mode='constant')
-
-            # print "Extracting the peaks..."
-            idx = numpy.where((spiketimes >= gidx*chunk_size) & (spiketimes < (gidx+1)*chunk_size))[0]
-            local_offset = t_offset
-            local_peaktimes = spiketimes[idx] - local_offset
-
-            # print "Removing the useless borders..."
-            local_borders = (template_shift, chunk_size - template_shift)
-            idx = (local_peaktimes >= local_borders[0]) & (local_peaktimes < local_borders[1])
-            local_peaktimes = local_peaktimes[idx]
-            local_clusters = inv_clusters[clusters[idx]]
-
-            if len(local_peaktimes) > 0:
-                all_times = numpy.zeros((N_e, local_peaktimes[-1] - local_peaktimes[0] + 1), dtype=numpy.bool)
-                min_times = numpy.maximum(
-                    local_peaktimes - local_peaktimes[0] - safety_time, 0
-                )
-                max_times = numpy.minimum(
-                    local_peaktimes - local_peaktimes[0] + safety_time + 1, local_peaktimes[-1] - local_peaktimes[0]
-                )
-
-                n_times = len(local_peaktimes)
-                argmax_peak = numpy.random.permutation(numpy.arange(n_times))
-                clusters_id = local_clusters[argmax_peak]
-                local_peaktimes = local_peaktimes[argmax_peak]
-
-                # print "Selection of the peaks with spatio-temporal masks..."
-                for idx in range(len(local_peaktimes)):
-
-                    if elt_count == nb_elts:
-                        break
-
-                    temp = clusters_id[idx]
-
-                    if numpy.mod(temp, comm.size) == comm.rank:
-
-                        elec = numpy.argmin(local_chunk[local_peaktimes[idx]])
-                        indices = inv_nodes[edges[nodes[elec]]]
-                        myslice = all_times[indices, min_times[idx]:max_times[idx]]
-                        peak = local_peaktimes[idx]
-                        if not myslice.any():
-                            if len(result['data_tmp_' + str(temp)]) < max_elts_temp:
-                                elt_count += 1
-                                sub_mat = local_chunk[peak-template_shift:peak+template_shift+1, :]
-                                sub_mat = numpy.dot(basis_rec, sub_mat)
-                                nx, ny = sub_mat.shape
-                                sub_mat = sub_mat.reshape((1, nx * ny))
-                                result['data_tmp_' + str(temp)] = numpy.vstack((result['data_tmp_' + str(temp)], sub_mat))
-                                to_add = numpy.array([peak + local_offset], dtype=numpy.int32)
-                                result['times_' + str(temp)] = numpy.concatenate((result['times_' + str(temp)], to_add))
-                            all_times[indices, min_times[idx]:max_times[idx]] = True
+    # The next chunks are read while the current one is processed.
+    for gidx, (local_chunk, t_offset) in data_file.prefetch(all_chunks, chunk_size, nodes=nodes, depth=prefetch):
+
+        if elt_count >= nb_elts:
+            break
+
+        # print "Node", comm.rank, "is analyzing chunk", gidx, "/", nb_chunks, " ..."
+        local_shape = len(local_chunk)
+
+        if do_spatial_whitening:
+            if use_gpu:
+                local_chunk = cmt.CUDAMatrix(local_chunk, copy_on_host=False)
+                local_chunk = local_chunk.dot(spatial_whitening).asarray()
+            else:
+                local_chunk = numpy.dot(local_chunk, spatial_whitening)
+        if do_temporal_whitening:
+            local_chunk = scipy.ndimage.filters.convolve1d(local_chunk, temporal_whitening, axis=0, mode='constant')
+
+        # print "Extracting the peaks..."
+        idx = numpy.where((spiketimes >= gidx*chunk_size) & (spiketimes < (gidx+1)*chunk_size))[0]
+        local_offset = t_offset
+        local_peaktimes = spiketimes[idx] - local_offset
+
+        # print "Removing the useless borders..."
+        local_borders = (template_shift, chunk_size - template_shift)
+        idx = (local_peaktimes >= local_borders[0]) & (local_peaktimes < local_borders[1])
+        local_peaktimes = local_peaktimes[idx]
+        local_clusters = inv_clusters[clusters[idx]]
+
+        if len(local_peaktimes) > 0:
+            all_times = numpy.zeros((N_e, local_peaktimes[-1] - local_peaktimes[0] + 1), dtype=numpy.bool)
+            min_times = numpy.maximum(
+                local_peaktimes - local_peaktimes[0] - safety_time, 0
+            )
+            max_times = numpy.minimum(
+                local_peaktimes - local_peaktimes[0] + safety_time + 1, local_peaktimes[-1] - local_peaktimes[0]
+            )
+
+            n_times = len(local_peaktimes)
+            argmax_peak = numpy.random.permutation(numpy.arange(n_times))
+            clusters_id = local_clusters[argmax_peak]
+            local_peaktimes = local_peaktimes[argmax_peak]
+
+            accepted_peaks = []
+            accepted_temps = []
+            nb_accepted = numpy.zeros(N_clusters, dtype=numpy.int32)
+
+            # print "Selection of the peaks with spatio-temporal masks..."
+            for idx in range(len(local_peaktimes)):
+
+                if elt_count == nb_elts:
+                    break
+
+                temp = clusters_id[idx]
+
+                if numpy.mod(temp, comm.size) == comm.rank:
+
+                    elec = numpy.argmin(local_chunk[local_peaktimes[idx]])
+                    indices = inv_nodes[edges[nodes[elec]]]
+                    myslice = all_times[indices, min_times[idx]:max_times[idx]]
+                    peak = local_peaktimes[idx]
+                    if not myslice.any():
+                        if len(result['data_tmp_' + str(temp)]) + nb_accepted[temp] < max_elts_temp:
+                            elt_count += 1
+                            nb_accepted[temp] += 1
+                            accepted_peaks.append(peak)
+                            accepted_temps.append(temp)
+                        all_times[indices, min_times[idx]:max_times[idx]] = True
+
+            if len(accepted_peaks) > 0:
+                # All the accepted snippets are gathered and projected at once.
+                accepted_peaks = numpy.array(accepted_peaks)
+                accepted_temps = numpy.array(accepted_temps)
+                snippets = gather_snippets(local_chunk, accepted_peaks, N_t, offset=-template_shift)
+                snippets = numpy.tensordot(basis_rec, snippets, axes=(1, 1)).transpose(1, 0, 2)
+                snippets = snippets.reshape(len(accepted_peaks), -1)
+                for temp in numpy.unique(accepted_temps):
+                    idx = numpy.where(accepted_temps == temp)[0]
+                    result['data_tmp_' + str(temp)] = numpy.vstack((result['data_tmp_' + str(temp)], snippets[idx]))
+                    to_add = (accepted_peaks[idx] + local_offset).astype(numpy.int32)
+                    result['times_' + str(temp)] = numpy.concatenate((result['times_' + str(temp)], to_add))
 
     total_nb_elts = 0
     for temp in range(N_clusters):
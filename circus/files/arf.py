@@ -97,7 +97,7 @@ class ARFFile(H5File):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -110,7 +110,7 @@ class ARFFile(H5File):
         for count, i in enumerate(nodes):
             local_chunk[:, count] = self.data[i][t_start:t_stop]
         
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def write_chunk(self, time, data):
 
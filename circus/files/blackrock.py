@@ -27,7 +27,7 @@ class BlackRockFile(DataFile):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -40,9 +40,14 @@ class BlackRockFile(DataFile):
         else:
             nodes = list(nodes)
 
-        self._open()
+        self._acquire()
         local_chunk = self.data.getdata(nodes, t_start, local_shape)['data'].T
-        self._close()
+        self._release()
+
+        if out is not None:
+            out = out[:len(local_chunk)]
+            out[:] = local_chunk
+            return out
 
         return local_chunk
 
@@ -47,7 +47,7 @@ class BRWFile(H5File):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -60,7 +60,7 @@ class BRWFile(H5File):
         if do_slice:
             local_chunk = numpy.take(local_chunk, nodes, axis=1)
 
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def write_chunk(self, time, data):
 
@@ -1,8 +1,11 @@
 import numpy
+import mmap
 import re
 import sys
 import os
 import logging
+import threading
+from six.moves import queue
 from circus.shared.messages import print_and_log
 from circus.shared.mpi import comm
 
@@ -64,6 +67,17 @@ def get_offset(data_dtype, dtype_offset):
     return dtype_offset
 
 
+def is_memory_map(data):
+    """
+    Returns True if the array is a view of a memory map, i.e. if writing in it would write in the mapped file.
+    """
+    while data is not None:
+        if isinstance(data, mmap.mmap):
+            return True
+        data = getattr(data, 'base', None)
+    return False
+
+
 class DataFile(object):
     """
     A generic class that will represent how the program interacts with the data. Such an abstraction
@@ -80,6 +94,7 @@ class DataFile(object):
     _shape = None  # The total shape of the data (nb time steps, nb channels) accross streams if any
     _t_start = None  # The global t_start of the data
     _t_stop = None  # The final t_stop of the data, accross all streams if any
+    _snippets_block = 2**22  # Maximal number of values read at once by read_snippets, to gather close snippets
 
     # This is a dictionary of values that need to be provided to the constructor, with the corresponding type
     _required_fields = {}
@@ -109,6 +124,8 @@ class DataFile(object):
 
         self.params = {}
         self.params.update(self._params)
+        self._lock = threading.RLock()  # reads and writes can be issued from a prefetching thread
+        self._persistent = None  # mode of the handle kept open between reads, see open()
 
         if not is_empty:
             self._check_filename(file_name)
@@ -187,7 +204,7 @@ class DataFile(object):
         """
         raise NotImplementedError('The close method needs to be implemented for file format %s' % self.description)
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         """
         Assuming the analyze function has been called before, this is the main function
         used by the code, in all steps, to get data chunks. More precisely, assuming your
@@ -198,10 +215,43 @@ class DataFile(object):
             - if the data loaded are data[idx:idx+1], padding should add some offsets,
                 in time steps, such that we can load data[idx+padding[0]:idx+padding[1]]
             - nodes is a list of nodes, between 0 and nb_channels
+            - out is an optional float32 buffer (see _scale_data_to_float32) where the data should be written.
+                It is only given if not None, such that wrappers without this argument are still valid
         """
 
         raise NotImplementedError('The get_data method needs to be implemented for file format %s' % self.description)
 
+    def read_snippets(self, times, length, nodes=None):
+        """
+        This function returns the snippets of size length starting at the given times, as an array of
+        shape (len(times), length, nb_nodes). It does not need to be overwritten, but wrappers can give faster
+        versions (for example by gathering the snippets directly from a memory map)
+
+            - times is a sorted array of local times (in time steps), such that all snippets are in the file
+            - length is the duration of the snippets, in time steps
+            - nodes is a list of nodes, between 0 and nb_channels
+
+        By default, snippets closer than _snippets_block values are read together, with a single call to read_chunk.
+        """
+        if nodes is None:
+            nb_nodes = self.nb_channels
+        else:
+            nb_nodes = len(nodes)
+
+        snippets = numpy.empty((len(times), length, nb_nodes), dtype=numpy.float32)
+        max_block = max(length, self._snippets_block // max(1, nb_nodes))
+        window = numpy.arange(length)
+        start = 0
+
+        while start < len(times):
+            stop = numpy.searchsorted(times, times[start] + max_block - length, 'right')
+            t_start, t_stop = times[start], times[stop - 1] + length
+            local_chunk = self.read_chunk(0, t_stop - t_start, padding=(t_start, t_start), nodes=nodes)
+            snippets[start:stop] = local_chunk[(times[start:stop] - t_start)[:, numpy.newaxis] + window]
+            start = stop
+
+        return snippets
+
     def write_chunk(self, time, data):
         """
         This function writes data at a given time.
@@ -360,32 +410,54 @@ class DataFile(object):
             else:
                 print_and_log(['You do not need to specify anything for file format %s' % self.description.upper()], 'info', logger)
 
-    def _scale_data_to_float32(self, data):
+    def _scale_data_to_float32(self, data, out=None):
         """
         This function will convert data from local data dtype into float32, the default format of the algorithm
+        - out is an optional float32 buffer, with at least as many rows as data, where the result is written
+
+        The conversion and the removal of the offset are done in a single pass, and without any new allocation
+        if out is given (or if data is already in float32, and either needs no scaling or is a private copy). Views
+        of a memory map are never scaled in place, since this would write in the file itself.
         """
-        if self.data_dtype != numpy.float32:
-            data = data.astype(numpy.float32)
+        needs_scaling = self.dtype_offset != 0 or numpy.any(self.gain != 1)
+        if out is not None:
+            if out.dtype != numpy.float32 or out.ndim != 2 or len(out) < len(data) or out.shape[1] != data.shape[1]:
+                raise ValueError('The output buffer should be a float32 array of shape at least %s' % str(data.shape))
+            out = out[:len(data)]
+        elif data.dtype == numpy.float32 and not (needs_scaling and is_memory_map(data)):
+            out = data
+        else:
+            out = numpy.empty(data.shape, dtype=numpy.float32)
 
         if self.dtype_offset != 0:
-            data -= self.dtype_offset
+            numpy.subtract(data, self.dtype_offset, out=out, dtype=numpy.float32)
+        elif out is not data:
+            numpy.copyto(out, data, casting='unsafe')
 
         if numpy.any(self.gain != 1):
-            data *= self.gain
+            out *= self.gain
 
-        if not data.flags['C_CONTIGUOUS']:
-            data = numpy.ascontiguousarray(data)
+        if not out.flags['C_CONTIGUOUS']:
+            out = numpy.ascontiguousarray(out)
 
-        return data
+        return out
 
-    def _unscale_data_from_float32(self, data):
+    def _unscale_data_from_float32(self, data, out=None):
         """
         This function will convert data from float32 back to the original format of the file
+        - out is an optional buffer, in the dtype of the file and of the shape of data, where the result is written
         """
 
         if numpy.any(self.gain != 1):
             data /= self.gain
 
+        if out is not None:
+            if self.dtype_offset != 0:
+                numpy.add(data, self.dtype_offset, out=out, casting='unsafe')
+            else:
+                numpy.copyto(out, data, casting='unsafe')
+            return out
+
         if self.dtype_offset != 0:
             data += self.dtype_offset
 
@@ -453,38 +525,150 @@ class DataFile(object):
                 return True
         return False
 
-    def get_snippet(self, global_time, length, nodes=None):
+    def get_snippet(self, global_time, length, nodes=None, out=None):
         """
         This function should return a time snippet of size length x nodes
         - time is in timestep
         - length is in timestep
         - nodes is a list of nodes, between 0 and nb_channels
+        - out is an optional float32 buffer of shape (length, nodes), reused to store the snippet
         """
         if self.is_stream:
             cidx = self._get_streams_index_by_time(global_time)
-            return self._sources[cidx].get_snippet(global_time, length, nodes)
+            return self._sources[cidx].get_snippet(global_time, length, nodes, out)
         else:
             local_time = global_time - self.t_start
-            return self.get_data(0, chunk_size=length, padding=(local_time, local_time), nodes=nodes)[0]
+            return self.get_data(0, chunk_size=length, padding=(local_time, local_time), nodes=nodes, out=out)[0]
+
+    def get_snippets(self, global_times, length, nodes=None):
+        """
+        This function returns the snippets of size length starting at global_times, as an array of shape
+        (len(global_times), length, nodes), with a few reads instead of one per snippet (see read_snippets)
+        - global_times are in timestep, and all the snippets should be within the data
+        - length is in timestep
+        - nodes is a list of nodes, between 0 and nb_channels
+        """
+        global_times = numpy.asarray(global_times, dtype=numpy.int64)
+        if nodes is None:
+            nb_nodes = self.nb_channels
+        else:
+            nb_nodes = len(nodes)
+
+        if len(global_times) == 0:
+            return numpy.empty((0, length, nb_nodes), dtype=numpy.float32)
 
-    def get_data(self, idx, chunk_size, padding=(0, 0), nodes=None):
+        order = None
+        if numpy.any(global_times[1:] < global_times[:-1]):
+            order = numpy.argsort(global_times, kind='mergesort')
+            global_times = global_times[order]
 
         if self.is_stream:
-            cidx = numpy.searchsorted(self._chunks_in_sources, idx, 'right') - 1
-            idx -= self._chunks_in_sources[cidx]
-            return self._sources[cidx].read_chunk(idx, chunk_size, padding, nodes), self._sources[cidx].t_start + idx * chunk_size
+            cidx = self._get_streams_index_by_time(global_times)
+            bounds = numpy.concatenate(([0], numpy.where(numpy.diff(cidx) != 0)[0] + 1, [len(cidx)]))
+            snippets = numpy.concatenate([
+                self._sources[cidx[start]].get_snippets(global_times[start:stop], length, nodes)
+                for start, stop in zip(bounds[:-1], bounds[1:])
+            ])
+        else:
+            local_times = global_times - self.t_start
+            if local_times[0] < 0 or local_times[-1] + length > self.duration:
+                raise ValueError('Snippets should be within the data, between 0 and %d' % self.duration)
+            with self._lock:
+                snippets = self.read_snippets(local_times, length, nodes)
+
+        if order is not None:
+            snippets[order] = snippets.copy()
+
+        return snippets
+
+    def _read_chunk(self, idx, chunk_size, padding, nodes, out):
+
+        if out is None:
+            return self.read_chunk(idx, chunk_size, padding, nodes)
         else:
-            return self.read_chunk(idx, chunk_size, padding, nodes), self.t_start + idx*chunk_size
+            return self.read_chunk(idx, chunk_size, padding, nodes, out=out)
+
+    def get_data(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
+        """
+        This function returns the chunk idx (see read_chunk), and its starting time
+        - out is an optional float32 buffer, with at least as many rows as the chunk, reused to store it
+        """
+
+        with self._lock:
+            if self.is_stream:
+                cidx = numpy.searchsorted(self._chunks_in_sources, idx, 'right') - 1
+                idx -= self._chunks_in_sources[cidx]
+                return self._sources[cidx]._read_chunk(idx, chunk_size, padding, nodes, out), self._sources[cidx].t_start + idx * chunk_size
+            else:
+                return self._read_chunk(idx, chunk_size, padding, nodes, out), self.t_start + idx*chunk_size
 
     def set_data(self, global_time, data):
 
-        if self.is_stream:
-            cidx = self._get_streams_index_by_time(global_time)
-            local_time = global_time - self._sources[cidx].t_start
-            return self._sources[cidx].write_chunk(local_time, data)
+        with self._lock:
+            if self.is_stream:
+                cidx = self._get_streams_index_by_time(global_time)
+                local_time = global_time - self._sources[cidx].t_start
+                return self._sources[cidx].write_chunk(local_time, data)
+            else:
+                local_time = global_time - self.t_start
+                return self.write_chunk(local_time, data)
+
+    def prefetch(self, indices, chunk_size, padding=(0, 0), nodes=None, depth=1):
+        """
+        This function iterates over the chunks given by indices, and yields (idx, get_data(idx, ...)) for
+        each of them. While a chunk is processed by the caller, the next ones are read in a background
+        thread, such that reading the data and computing on them are overlapped.
+        - indices is an iterable of chunk indices (only consumed as the chunks are needed)
+        - padding can either be a tuple, or a function returning the padding of a given chunk index
+        - depth is the maximal number of chunks read in advance (0 to read them synchronously)
+        """
+
+        if callable(padding):
+            get_padding = padding
         else:
-            local_time = global_time - self.t_start
-            return self.write_chunk(local_time, data)
+            get_padding = lambda idx: padding
+
+        if depth < 1:
+            for idx in indices:
+                yield idx, self.get_data(idx, chunk_size, get_padding(idx), nodes)
+            return
+
+        requests = queue.Queue()
+        results = queue.Queue()
+
+        def reader():
+            while True:
+                idx = requests.get()
+                if idx is None:
+                    break
+                try:
+                    results.put((idx, self.get_data(idx, chunk_size, get_padding(idx), nodes), None))
+                except Exception as ex:
+                    results.put((idx, None, ex))
+
+        def get_result():
+            idx, data, error = results.get()
+            if error is not None:
+                raise error
+            return idx, data
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+
+        nb_pending = 0
+        try:
+            for idx in indices:
+                requests.put(idx)
+                if nb_pending < depth:
+                    nb_pending += 1
+                else:
+                    yield get_result()
+            for count in range(nb_pending):
+                yield get_result()
+        finally:
+            requests.put(None)
+            thread.join()
 
     def analyze(self, chunk_size, strict=False):
         """
@@ -561,16 +745,49 @@ class DataFile(object):
         else:
             return 1
 
-    def open(self, mode='r'):
-        if self.is_stream:
-            for source in self._sources:
-                source._open(mode)
-        else:
+    def _acquire(self, mode='r'):
+        """
+        This function should be called by the wrappers opening the file in each read_chunk (or write_chunk), instead
+        of _open. If a persistent handle is held (see open), it is reused, and only reopened once if a write needs it.
+        """
+        if self._persistent is None:
+            self._open(mode)
+        elif mode != 'r' and self._persistent == 'r':
+            self._close()
             self._open(mode)
+            self._persistent = mode
 
-    def close(self):
-        if self.is_stream:
-            for source in self._sources:
-                source._close()
-        else:
+    def _release(self):
+        """
+        This function should be called by the wrappers instead of _close, at the end of read_chunk (or write_chunk)
+        """
+        if self._persistent is None:
             self._close()
+
+    def open(self, mode='r', persistent=False):
+        """
+        This function opens the file. If persistent is True, the handle (memory mapping, HDF5 dataset, ...) is kept
+        until close is called, and reused by all the reads instead of opening the file for each of them. Since reads
+        and writes are serialized by a lock, a persistent handle can be shared by the threads of a process.
+        """
+        with self._lock:
+            if self.is_stream:
+                for source in self._sources:
+                    source.open(mode, persistent)
+            else:
+                if self._persistent is not None:
+                    self._close()
+                self._open(mode)
+                if persistent:
+                    self._persistent = mode
+                else:
+                    self._persistent = None
+
+    def close(self):
+        with self._lock:
+            if self.is_stream:
+                for source in self._sources:
+                    source.close()
+            else:
+                self._persistent = None
+                self._close()
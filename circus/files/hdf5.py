@@ -82,7 +82,7 @@ class H5File(DataFile):
         self._close()
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
 
@@ -111,7 +111,7 @@ class H5File(DataFile):
                 else:
                     local_chunk = self.data[:, :, t_start:t_stop].reshape(self.nb_channels, t_stop-t_start)[nodes, :].T
 
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def write_chunk(self, time, data):
 
@@ -28,7 +28,7 @@ class MCDFile(DataFile):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -42,6 +42,11 @@ class MCDFile(DataFile):
             if not numpy.all(nodes == numpy.arange(self.nb_channels)):
                 local_chunk = numpy.take(local_chunk, nodes, axis=1)
 
+        if out is not None:
+            out = out[:len(local_chunk)]
+            out[:] = local_chunk
+            return out
+
         return local_chunk.astype(numpy.float32)
 
     def _open(self, mode='r'):
@@ -281,7 +281,7 @@ class NeuraLynxFile(DataFile):
                     data_slice += numpy.arange(g_offset, g_offset + self.SAMPLES_PER_RECORD, dtype=numpy.int64).tolist()
         return data_slice
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -292,12 +292,12 @@ class NeuraLynxFile(DataFile):
         local_chunk = numpy.zeros((local_shape, len(nodes)), dtype=self.data_dtype)
         data_slice = self._get_slice_(t_start, t_stop)
 
-        self._open()
+        self._acquire()
         for count, i in enumerate(nodes):
             local_chunk[:, count] = self.data[i][data_slice]
-        self._close()
+        self._release()
 
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def write_chunk(self, time, data):
 
@@ -310,10 +310,10 @@ class NeuraLynxFile(DataFile):
         data_slice = self._get_slice_(t_start, t_stop)
         data = self._unscale_data_from_float32(data)
 
-        self._open(mode='r+')
+        self._acquire(mode='r+')
         for i in range(self.nb_channels):
             self.data[i][data_slice] = data[:, i]
-        self._close()
+        self._release()
 
     def _open(self, mode='r'):
         self.data = [
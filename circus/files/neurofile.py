@@ -30,7 +30,7 @@ class NeuroShareFile(DataFile):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -43,7 +43,7 @@ class NeuroShareFile(DataFile):
         for count, i in enumerate(nodes):
             local_chunk[:, count] = self.data.get_entity(numpy.int64(i)).get_data(t_start, numpy.int64(local_shape))[0]
         
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def _open(self, mode='r'):
         self.data = ns.File(self.file_name)
@@ -1,6 +1,7 @@
 import numpy
 import re
 import sys
+from .datafile import DataFile
 from .raw_binary import RawBinaryFile
 from numpy.lib.format import open_memmap
 
@@ -53,9 +54,9 @@ class NumpyFile(RawBinaryFile):
 
         return header
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         
-        self._open()
+        self._acquire()
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         do_slice = nodes is not None and not numpy.all(nodes == numpy.arange(self.nb_channels))
@@ -80,12 +81,31 @@ class NumpyFile(RawBinaryFile):
                 local_chunk = self.data[:, :, t_start:t_stop].copy().reshape(self.nb_channels, t_stop-t_start).T
                 if do_slice:
                     local_chunk = numpy.take(local_chunk, nodes, axis=1)
-        self._close()
+        self._release()
+
+        return self._scale_data_to_float32(local_chunk, out)
+
+    def read_snippets(self, times, length, nodes=None):
+
+        if self.time_axis != 0 or self.grid_ids:
+            return DataFile.read_snippets(self, times, length, nodes)
 
-        return self._scale_data_to_float32(local_chunk)
+        self._acquire()
+
+        indices = times[:, numpy.newaxis] + numpy.arange(length)
+        if nodes is None:
+            snippets = self.data[indices]
+        else:
+            snippets = self.data[indices[:, :, numpy.newaxis], nodes]
+
+        snippets = self._scale_data_to_float32(snippets)
+
+        self._release()
+
+        return snippets
 
     def write_chunk(self, time, data):
-        self._open(mode='r+')
+        self._acquire(mode='r+')
         data = self._unscale_data_from_float32(data)
         if self.time_axis == 0:
             if not self.grid_ids:
@@ -97,7 +117,7 @@ class NumpyFile(RawBinaryFile):
                 self.data[:, time:time+len(data)] = data.T
             else:
                 self.data[:, :, time:time+len(data)] = data.reshape(len(data), self._shape[1], self._shape[2]).T
-        self._close()
+        self._release()
 
     def _open(self, mode='r'):
         self.data = open_memmap(self.file_name, mode=mode)
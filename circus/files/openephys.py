@@ -152,7 +152,7 @@ class OpenEphysFile(DataFile):
         return data_slice
 
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -163,12 +163,12 @@ class OpenEphysFile(DataFile):
         local_chunk = numpy.zeros((local_shape, len(nodes)), dtype=self.data_dtype)
         data_slice = self._get_slice_(t_start, t_stop)
 
-        self._open()
+        self._acquire()
         for count, i in enumerate(nodes):
             local_chunk[:, count] = self.data[i][data_slice]
-        self._close()
+        self._release()
 
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
 
     def write_chunk(self, time, data):
@@ -182,10 +182,10 @@ class OpenEphysFile(DataFile):
         data_slice = self._get_slice_(t_start, t_stop)
         data = self._unscale_data_from_float32(data)
 
-        self._open(mode='r+')
+        self._acquire(mode='r+')
         for i in range(self.nb_channels):
             self.data[i][data_slice] = data[:, i]
-        self._close()
+        self._release()
 
     def _open(self, mode='r'):
         self.data = [
@@ -5,6 +5,21 @@ import numpy
 from .datafile import DataFile, comm
 
 
+def get_nodes_slice(nodes):
+    """
+    Returns a slice selecting the given channels if they are evenly spaced, and the channels themselves otherwise
+    """
+    nodes = numpy.asarray(nodes)
+    if len(nodes) == 1:
+        return slice(nodes[0], nodes[0] + 1)
+
+    steps = numpy.diff(nodes)
+    if steps[0] > 0 and numpy.all(steps == steps[0]):
+        return slice(nodes[0], nodes[-1] + 1, steps[0])
+    else:
+        return nodes
+
+
 class RawBinaryFile(DataFile):
 
     description = "raw_binary"
@@ -42,39 +57,62 @@ class RawBinaryFile(DataFile):
         self._read_from_header()
         del self.data
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
 
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
 
-        self._open()
+        self._acquire()
 
-        do_slice = nodes is not None and not numpy.all(nodes == numpy.arange(self.nb_channels))
+        do_slice = nodes is not None and not (len(nodes) == self.nb_channels and numpy.all(nodes == numpy.arange(self.nb_channels)))
 
-        # if do_slice:
-        #     myslice = numpy.zeros(0, dtype=numpy.int64)
-        #     for i in range(local_shape):
-        #         myslice = numpy.concatenate((myslice, (t_start + i)*self.nb_channels + nodes))
-        #     local_chunk  = self.data[myslice]
-        #     local_chunk  = local_chunk.reshape(local_shape, len(nodes))
-        # else:
         local_chunk = self.data[t_start*self.nb_channels:t_stop*self.nb_channels]
         local_chunk = local_chunk.reshape(local_shape, self.nb_channels)
 
         if do_slice:
-            local_chunk = numpy.take(local_chunk, nodes, axis=1)
+            # Evenly spaced channels are a strided view of the file, other subsets are only copied in the file dtype.
+            nodes_slice = get_nodes_slice(nodes)
+            if isinstance(nodes_slice, slice):
+                local_chunk = local_chunk[:, nodes_slice]
+            else:
+                local_chunk = numpy.take(local_chunk, nodes_slice, axis=1)
 
-        self._close()
+        local_chunk = self._scale_data_to_float32(local_chunk, out)
+
+        self._release()
+
+        return local_chunk
 
-        return self._scale_data_to_float32(local_chunk)
+    def read_snippets(self, times, length, nodes=None):
+
+        self._acquire()
+
+        # All the snippets are gathered from the memory map at once, and only then converted to float32.
+        local_data = self.data[:self.duration*self.nb_channels].reshape(self.duration, self.nb_channels)
+        indices = times[:, numpy.newaxis] + numpy.arange(length)
+
+        if nodes is None:
+            snippets = local_data[indices]
+        else:
+            nodes_slice = get_nodes_slice(nodes)
+            if isinstance(nodes_slice, slice):
+                snippets = local_data[:, nodes_slice][indices]
+            else:
+                snippets = local_data[indices[:, :, numpy.newaxis], nodes_slice]
+
+        snippets = self._scale_data_to_float32(snippets)
+
+        self._release()
+
+        return snippets
 
     def write_chunk(self, time, data):
-        self._open(mode='r+')
+        self._acquire(mode='r+')
 
-        data = self._unscale_data_from_float32(data)
-        data = data.ravel()
-        self.data[self.nb_channels*time:self.nb_channels*time+len(data)] = data
-        self._close()
+        # The data are converted back to the file dtype directly in the file.
+        local_chunk = self.data[self.nb_channels*time:self.nb_channels*time+data.size]
+        self._unscale_data_from_float32(data, out=local_chunk.reshape(data.shape))
+        self._release()
 
     def _open(self, mode='r'):
         self.data = numpy.memmap(self.file_name, offset=self.data_offset, dtype=self.data_dtype, mode=mode)
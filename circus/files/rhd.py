@@ -289,7 +289,7 @@ class RHDFile(DataFile):
 
                 yield data_slice
 
-    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None):
+    def read_chunk(self, idx, chunk_size, padding=(0, 0), nodes=None, out=None):
         
         t_start, t_stop = self._get_t_start_t_stop(idx, chunk_size, padding)
         local_shape = t_stop - t_start
@@ -298,7 +298,7 @@ class RHDFile(DataFile):
         local_chunk = numpy.zeros((self.nb_channels, local_shape), dtype=self.data_dtype)
         data_slice = self._get_slice_(t_start, t_stop)
 
-        self._open()
+        self._acquire()
         count = 0
 
         for s in data_slice:
@@ -307,12 +307,12 @@ class RHDFile(DataFile):
             count += t_slice
 
         local_chunk = local_chunk.T
-        self._close()
+        self._release()
 
         if do_slice:
             local_chunk = numpy.take(local_chunk, nodes, axis=1)
 
-        return self._scale_data_to_float32(local_chunk)
+        return self._scale_data_to_float32(local_chunk, out)
 
     def write_chunk(self, time, data):
 
@@ -325,14 +325,14 @@ class RHDFile(DataFile):
         data = self._unscale_data_from_float32(data)
         data_slice = self._get_slice_(t_start, t_stop)
 
-        self._open(mode='r+')
+        self._acquire(mode='r+')
         count = 0
         for s in data_slice:
             t_slice = len(s)//self.nb_channels
             self.data[s] = data[count:count + t_slice, :].T.ravel()
             count += t_slice
 
-        self._close()
+        self._release()
 
     def _open(self, mode='r'):
         self.data = numpy.memmap(self.file_name, offset=self.data_offset, dtype=self.data_dtype, mode=mode)
@@ -12,7 +12,7 @@ from circus.shared.utils import *
 from circus.shared.probes import get_nodes_and_edges
 from circus.shared.messages import print_and_log, init_logging
 from circus.shared.files import get_artefact
-from circus.shared.mpi import detect_memory
+from circus.shared.mpi import detect_memory, ChunkScheduler
 
 
 def check_if_done(params, flag, logger):
@@ -62,6 +62,31 @@ def check_if_done(params, flag, logger):
     return
 
 
+def sos_filter_chunk(sos, sos_zi, local_chunk, left, len_chunk, zi=None, causal=False):
+    """
+    Filters local_chunk[left:left + len_chunk] with the second-order sections sos, the rest of local_chunk being the
+    left and right paddings. zi is the state of the filter at the end of the previous chunk, if the chunk follows it,
+    otherwise the filter is started from its steady state (sos_zi) and warmed up on the left padding. Returns the
+    filtered chunk, and the state of the filter at its end. If causal, only the forward pass is done.
+    """
+    if zi is None:
+        zi = sos_zi * local_chunk[0]
+        if left > 0:
+            _, zi = signal.sosfilt(sos, local_chunk[:left], axis=0, zi=zi)
+
+    forward, zi = signal.sosfilt(sos, local_chunk[left:left + len_chunk], axis=0, zi=zi)
+
+    if causal:
+        return forward, zi
+
+    # The backward pass is started from the steady state at the end of the right padding.
+    if len(local_chunk) > left + len_chunk:
+        padded, _ = signal.sosfilt(sos, local_chunk[left + len_chunk:], axis=0, zi=zi)
+        forward = numpy.concatenate((forward, padded))
+    backward, _ = signal.sosfilt(sos, forward[::-1], axis=0, zi=sos_zi * forward[-1])
+    return backward[::-1][:len_chunk], zi
+
+
 def main(params, nb_cpu, nb_gpu, use_gpu):
 
     logger = init_logging(params.logfile)
@@ -123,20 +148,28 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
         chunk_size = detect_memory(params, filtering=True)
         butter_order = params.getint('filtering', 'butter_order')
+        engine = params.get('filtering', 'engine').lower()
         nb_chunks, _ = data_file_in.analyze(chunk_size)
 
-        b, a = signal.butter(butter_order, np.array(cut_off)/(params.rate/2.), 'pass')
+        if engine == 'filtfilt':
+            b, a = signal.butter(butter_order, np.array(cut_off)/(params.rate/2.), 'pass')
+        else:
+            sos = signal.butter(butter_order, np.array(cut_off)/(params.rate/2.), 'pass', output='sos')
+            sos_zi = signal.sosfilt_zi(sos)[:, :, numpy.newaxis]
         all_chunks = numpy.arange(nb_chunks, dtype=numpy.int64)
         to_process = all_chunks[comm.rank::comm.size]
         loc_nb_chunks = len(to_process)
         N_total = params.nb_channels
         process_all_channels = numpy.all(nodes == numpy.arange(N_total))
         duration = int(0.1*params.rate)
+        offset_block = 4096  # Number of time steps from which the offsets are removed at once
 
         if comm.rank == 0:
             to_write = []
             if do_filtering:
                 to_write += ["Filtering with a Butterworth filter (order %d) in [%g, %g] Hz" % (butter_order, cut_off[0], cut_off[1])]
+                if engine == 'causal':
+                    to_write += ["The filter is causal, so the phase of the signals is not preserved"]
             if do_remove_median:
                 to_write += ["Median over all channels is subtracted to each channels"]
             if do_remove_ground:
@@ -144,14 +177,17 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
             print_and_log(to_write, 'default', logger)
 
-        to_explore = range(comm.rank, nb_chunks, comm.size)
+        # The streaming engines carry the state of the filter from one chunk to the next one.
+        to_explore = ChunkScheduler(
+            nb_chunks, dynamic=params.getboolean('data', 'dynamic_scheduling'), contiguous=(engine != 'filtfilt')
+        )
 
         data_file_in.open(mode='r+')
 
         if comm.rank == 0:
             to_explore = get_tqdm_progressbar(to_explore)
 
-        for count, gidx in enumerate(to_explore):
+        def get_padding(gidx):
 
             is_first = data_file_in.is_first_chunk(gidx, nb_chunks)
             is_last = data_file_in.is_last_chunk(gidx, nb_chunks)
@@ -163,24 +199,69 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
             else:
                 padding = (-duration, duration)
 
-            local_chunk, t_offset =  data_file_in.get_data(gidx, chunk_size, padding)
+            if engine == 'causal':
+                padding = (padding[0], 0)
 
-            if do_filtering:
+            return padding
+
+        # The next chunks are read while the current one is filtered. When filtering in place, the padding of a chunk
+        # must be read once the previous chunk has been written, thus chunks are read synchronously.
+        if data_file_in == data_file_out:
+            prefetch = 0
+        else:
+            prefetch = params.getint('data', 'prefetch')
+        to_explore = data_file_in.prefetch(to_explore, chunk_size, get_padding, depth=prefetch)
+
+        zi = None  # State of the filter at the end of the last chunk, for the streaming engines
+        last_gidx = None
+
+        for count, (gidx, (local_chunk, t_offset)) in enumerate(to_explore):
+
+            # The padding at the end of the data can be shorter than requested.
+            padding = get_padding(gidx)
+            left = numpy.abs(padding[0])
+            len_chunk = min(chunk_size, len(local_chunk) - left)
+
+            if not do_filtering:
+                local_chunk = local_chunk[left:left + len_chunk]
+            elif engine == 'filtfilt':
                 local_chunk = signal.filtfilt(b, a, local_chunk, axis=0)
-                local_chunk = local_chunk[numpy.abs(padding[0]):-numpy.abs(padding[1])]
-                local_chunk -= numpy.median(local_chunk, 0)
+                local_chunk = local_chunk[left:left + len_chunk]
+            else:
+                is_contiguous = zi is not None and gidx == last_gidx + 1 and not data_file_in.is_first_chunk(gidx, nb_chunks)
+                if not is_contiguous:
+                    zi = None
+                local_chunk, zi = sos_filter_chunk(sos, sos_zi, local_chunk, left, len_chunk, zi, causal=(engine == 'causal'))
+                last_gidx = gidx
+
+            # The offsets of the channels (median after filtering) and of the time steps (median over the channels,
+            # common ground) are removed together, by blocks of time steps, such that the data are only read once.
+            if do_filtering:
+                channel_offsets = numpy.median(local_chunk, 0)
+            else:
+                channel_offsets = numpy.zeros(local_chunk.shape[1], dtype=local_chunk.dtype)
 
+            time_offsets = None
             if do_remove_median:
                 if not process_all_channels:
-                    global_median = numpy.median(numpy.take(local_chunk, nodes, axis=1), 1)
+                    centered = numpy.take(local_chunk, nodes, axis=1) - channel_offsets[nodes]
                 else:
-                    global_median = numpy.median(local_chunk, 1)
-
-                local_chunk -= global_median[:, numpy.newaxis]
+                    centered = local_chunk - channel_offsets
+                time_offsets = numpy.median(centered, 1, overwrite_input=True)
 
             if common_ground > -1:
-                ground = local_chunk[:, common_ground]
-                local_chunk -= ground[:, numpy.newaxis]
+                # Once the ground is subtracted, the median over the channels cancels out.
+                time_offsets = local_chunk[:, common_ground] - channel_offsets[common_ground]
+
+            if not local_chunk.flags['WRITEABLE']:
+                local_chunk = local_chunk.copy()
+
+            for t_start in range(0, len(local_chunk), offset_block):
+                block = local_chunk[t_start:t_start + offset_block]
+                if do_filtering:
+                    block -= channel_offsets
+                if time_offsets is not None:
+                    block -= time_offsets[t_start:t_start + offset_block, numpy.newaxis]
 
             if data_file_in != data_file_out and data_file_in.is_first_chunk(gidx, nb_chunks):
                 if data_file_in.is_stream:
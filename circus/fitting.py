@@ -1,9 +1,76 @@
 from circus.shared.utils import *
+import zlib
 import circus.shared.files as io
 from circus.shared.files import get_dead_times
 from circus.shared.probes import get_nodes_and_edges
 from circus.shared.messages import print_and_log, init_logging
-from circus.shared.mpi import detect_memory
+from circus.shared.mpi import detect_memory, calibrate_chunk_size, ChunkScheduler
+from circus.shared.algorithms import MatchingTree
+
+
+DEBUG_FIELDS = [
+    'chunk_nbs',
+    'iteration_nbs',
+    'peak_nbs',
+    'peak_local_time_steps',
+    'peak_time_steps',
+    'peak_scalar_products',
+    'peak_solved_flags',
+    'template_nbs',
+    'success_flags',
+]
+
+
+def get_output_names(file_out_suff, rank, collect_all=False, debug=False):
+    """Names of the files written by one node during the fitting (in the order of the journal)."""
+
+    names = [file_out_suff + '.%s-%d.data' % (key, rank) for key in ['spiketimes', 'amplitudes', 'templates']]
+    if collect_all:
+        names += [file_out_suff + '.%s-%d.data' % (key, rank) for key in ['gspiketimes', 'gtemplates']]
+    if debug:
+        names += [file_out_suff + '.%s_debug_%d.data' % (key, rank) for key in DEBUG_FIELDS]
+
+    return names
+
+
+def restore_journal(file_out_suff, rank, collect_all=False, debug=False):
+    """Restore the files written by one node to the last chunk recorded in its journal.
+
+    Each record of the journal is the index of a chunk followed by the sizes of all the output files once
+    this chunk has been written. Records pointing beyond the actual end of the files are dropped, and the
+    files are truncated to the last valid record, such that partially written chunks are discarded.
+
+    Returns the indices of the chunks that have been completely written.
+    """
+
+    names = get_output_names(file_out_suff, rank, collect_all, debug)
+    journal_name = file_out_suff + '.journal-%d.data' % rank
+    nb_fields = 1 + len(names)
+
+    if os.path.exists(journal_name):
+        records = numpy.fromfile(journal_name, dtype=numpy.int64)
+    else:
+        records = numpy.zeros(0, dtype=numpy.int64)
+    records = records[:(len(records) // nb_fields) * nb_fields].reshape(-1, nb_fields)
+
+    sizes = numpy.array([os.path.getsize(name) if os.path.exists(name) else 0 for name in names], dtype=numpy.int64)
+    is_valid = numpy.all(records[:, 1:] <= sizes, 1)
+    if not numpy.all(is_valid):
+        records = records[:numpy.argmin(is_valid)]
+
+    if len(records) > 0:
+        offsets = records[-1, 1:]
+    else:
+        offsets = numpy.zeros(len(names), dtype=numpy.int64)
+
+    for name, offset in zip(names + [journal_name], list(offsets) + [records.nbytes]):
+        if os.path.exists(name):
+            with open(name, 'r+b') as f:
+                f.truncate(offset)
+        else:
+            open(name, 'wb').close()
+
+    return records[:, 0]
 
 
 def main(params, nb_cpu, nb_gpu, use_gpu):
@@ -49,9 +116,16 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     collect_all = params.getboolean('fitting', 'collect_all')
     debug = params.getboolean('fitting', 'debug')
     ignore_dead_times = params.getboolean('triggers', 'ignore_times')
+    engine = params.get('fitting', 'engine').lower()
+    auto_chunk = params.getboolean('fitting', 'auto_chunk')
+    dynamic_scheduling = params.getboolean('data', 'dynamic_scheduling')
+    resume = params.getboolean('fitting', 'resume')
+    prefetch = params.getint('data', 'prefetch')
+    overlaps_mode = params.get('fitting', 'overlaps').lower()
+    overlaps_cache = params.getfloat('fitting', 'overlaps_cache')
     inv_nodes = numpy.zeros(n_total, dtype=numpy.int32)
     inv_nodes[nodes] = numpy.arange(len(nodes))
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if use_gpu:
@@ -78,7 +152,6 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     n_tm = N_tm // 2
     n_scalar = n_e * n_t
 
-    temp_window = numpy.arange(-template_shift, template_shift + 1)
     size_window = n_e * (2 * template_shift + 1)
 
     if not amp_auto:
@@ -130,6 +203,11 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 tmp = tmp * norm_templates[i]
             neighbors[i] = numpy.where(numpy.sum(tmp, axis=1) != 0.0)[0]
 
+    # Checksum of the templates, for the signature of the run (see below).
+    templates_checksum = 0
+    for array in [templates.data, templates.indices, templates.indptr]:
+        templates_checksum = zlib.crc32(numpy.ascontiguousarray(array).tobytes(), templates_checksum)
+
     if use_gpu:
         templates = cmt.SparseCUDAMatrix(templates, copy_on_host=False)
 
@@ -143,23 +221,53 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
     comm.Barrier()
 
-    c_overlap = io.get_overlaps(params, nb_cpu=nb_cpu, nb_gpu=nb_gpu, use_gpu=use_gpu)
-    over_shape = c_overlap.get('over_shape')[:]
-    n_over = int(numpy.sqrt(over_shape[0]))
-    s_over = over_shape[1]
-    # # If the number of overlaps is different from templates, we need to recompute them.
-    if n_over != N_tm:
-        if comm.rank == 0:
-            print_and_log(['Templates have been modified, recomputing the overlaps...'], 'default', logger)
-        c_overlap = io.get_overlaps(params, erase=True, nb_cpu=nb_cpu, nb_gpu=nb_gpu, use_gpu=use_gpu)
+    use_lazy = (overlaps_mode == 'lazy') and not full_gpu
+    if use_lazy:
+        # Overlaps of a template with all the others are only computed when it is first fitted, and cached.
+        n_over = N_tm
+        s_over = 2 * n_t - 1
+        n_over_values = 0  # i.e. not precomputed
+    else:
+        c_overlap = io.get_overlaps(params, nb_cpu=nb_cpu, nb_gpu=nb_gpu, use_gpu=use_gpu)
         over_shape = c_overlap.get('over_shape')[:]
         n_over = int(numpy.sqrt(over_shape[0]))
         s_over = over_shape[1]
-
-    if SHARED_MEMORY:
-        c_overs = io.load_data_memshared(params, 'overlaps')
+        # # If the number of overlaps is different from templates, we need to recompute them.
+        if n_over != N_tm:
+            if comm.rank == 0:
+                print_and_log(['Templates have been modified, updating the overlaps...'], 'default', logger)
+            c_overlap.close()
+            c_overlap = io.update_overlaps_file(params, nb_cpu=nb_cpu, nb_gpu=nb_gpu, use_gpu=use_gpu)
+            over_shape = c_overlap.get('over_shape')[:]
+            n_over = int(numpy.sqrt(over_shape[0]))
+            s_over = over_shape[1]
+        n_over_values = c_overlap.get('over_data').shape[0]
+
+    use_lags = (overlaps_mode == 'lags') and not full_gpu
+    if use_lazy:
+        over_lags = None  # default assignment (for PyCharm code inspection)
+        over_templates = templates.T.tocsc()
+        over_supports = io.get_templates_supports(over_templates, n_t)
+        is_computed = numpy.zeros(over_templates.shape[1], dtype=numpy.bool)  # templates whose overlaps were needed
+
+        def compute_overlaps(index):
+            is_computed[index] = True
+            return io.get_template_overlaps(over_templates, over_supports, index, n_t)
+
+        c_overs = LRUCache(
+            compute_overlaps, overlaps_cache * 1024 ** 2,
+            lambda value: value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+        )
+    elif use_lags:
+        # Overlaps are memory mapped and indexed by (template, lag), no need to load them.
+        over_lags = io.get_overlaps_lags(params)
+        c_overs = {}
     else:
-        c_overs = io.load_data(params, 'overlaps')
+        over_lags = None  # default assignment (for PyCharm code inspection)
+        if SHARED_MEMORY:
+            c_overs = io.load_data_memshared(params, 'overlaps')
+        else:
+            c_overs = io.load_data(params, 'overlaps')
 
     comm.Barrier()
 
@@ -169,9 +277,47 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
         sys.exit(0)
 
+    # A previous run can be resumed if it was fitting the same templates, with the same parameters.
+    journal_header_name = file_out_suff + '.journal.data'
+    # The signature covers the settings of the preprocessing as well, and the templates themselves.
+    fitting_params = str(
+        [item for item in sorted(params.parser.items('fitting')) if item[0] != 'resume']
+        + sorted(params.parser.items('detection')) + sorted(params.parser.items('filtering'))
+        + sorted(params.parser.items('whitening'))
+    )
+    signature = numpy.array([
+        N_tm, data_file.duration, numpy.sum(norm_templates), zlib.crc32(fitting_params.encode('utf-8')) & 0xffffffff,
+        templates_checksum & 0xffffffff
+    ], dtype=numpy.float64)
+    resumed = False
+    nb_writers = comm.size
+
+    if resume and os.path.exists(journal_header_name):
+        header = numpy.fromfile(journal_header_name, dtype=numpy.float64)
+        if len(header) == len(signature) + 2 and numpy.all(header[2:] == signature):
+            resumed = True
+            chunk_size = int(header[0])
+            nb_writers = max(comm.size, int(header[1]))
+
+    comm.Barrier()
+
     if comm.rank == 0:
         print_and_log(["Here comes the SpyKING CIRCUS %s and %d templates..." % (info_string, n_tm)], 'default', logger)
-        purge(file_out_suff, '.data')
+        if not resumed:
+            purge(file_out_suff, '.data')
+
+    if resumed:
+        # Nodes also restore the files left by the nodes of the previous run that are now missing.
+        done_chunks = [numpy.zeros(0, dtype=numpy.int64)]
+        for rank in range(comm.rank, nb_writers, comm.size):
+            done_chunks.append(restore_journal(file_out_suff, rank, collect_all, debug))
+        done_chunks = all_gather_array(numpy.concatenate(done_chunks), comm, dtype='int64')
+        if comm.rank == 0:
+            print_and_log(["Resuming the fitting: %d chunks already done" % len(done_chunks)], 'info', logger)
+    else:
+        done_chunks = numpy.zeros(0, dtype=numpy.int64)
+
+    file_mode = 'ab' if resumed else 'wb'
 
     if do_spatial_whitening:
         spatial_whitening = io.load_data(params, 'spatial_whitening')
@@ -195,21 +341,24 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                     del c_overs[i]
             full_gpu = False
 
-    nb_chunks, last_chunk_len = data_file.analyze(chunk_size)
-    processed_chunks = int(min(nb_chunks, max_chunk))
+    use_tree = engine == 'tree'
+    if use_tree and full_gpu:
+        if comm.rank == 0:
+            print_and_log(["The tree engine is not available with gpu_only, using the dense one"], 'info', logger)
+        use_tree = False
 
     comm.Barrier()
-    spiketimes_file = open(file_out_suff + '.spiketimes-%d.data' % comm.rank, 'wb')
+    spiketimes_file = open(file_out_suff + '.spiketimes-%d.data' % comm.rank, file_mode)
     comm.Barrier()
-    amplitudes_file = open(file_out_suff + '.amplitudes-%d.data' % comm.rank, 'wb')
+    amplitudes_file = open(file_out_suff + '.amplitudes-%d.data' % comm.rank, file_mode)
     comm.Barrier()
-    templates_file = open(file_out_suff + '.templates-%d.data' % comm.rank, 'wb')
+    templates_file = open(file_out_suff + '.templates-%d.data' % comm.rank, file_mode)
     comm.Barrier()
 
     if collect_all:
-        garbage_times_file = open(file_out_suff + '.gspiketimes-%d.data' % comm.rank, 'wb')
+        garbage_times_file = open(file_out_suff + '.gspiketimes-%d.data' % comm.rank, file_mode)
         comm.Barrier()
-        garbage_temp_file = open(file_out_suff + '.gtemplates-%d.data' % comm.rank, 'wb')
+        garbage_temp_file = open(file_out_suff + '.gtemplates-%d.data' % comm.rank, file_mode)
         comm.Barrier()
     else:
         garbage_times_file = None  # default assignment (for PyCharm code inspection)
@@ -217,27 +366,27 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
     if debug:
         # Open debug files.
-        chunk_nbs_debug_file = open(file_out_suff + '.chunk_nbs_debug_%d.data' % comm.rank, mode='wb')
+        chunk_nbs_debug_file = open(file_out_suff + '.chunk_nbs_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
-        iteration_nbs_debug_file = open(file_out_suff + '.iteration_nbs_debug_%d.data' % comm.rank, mode='wb')
+        iteration_nbs_debug_file = open(file_out_suff + '.iteration_nbs_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
-        peak_nbs_debug_file = open(file_out_suff + '.peak_nbs_debug_%d.data' % comm.rank, mode='wb')
+        peak_nbs_debug_file = open(file_out_suff + '.peak_nbs_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
         peak_local_time_steps_debug_file = open(
-            file_out_suff + '.peak_local_time_steps_debug_%d.data' % comm.rank, mode='wb'
+            file_out_suff + '.peak_local_time_steps_debug_%d.data' % comm.rank, mode=file_mode
         )
         comm.Barrier()
-        peak_time_steps_debug_file = open(file_out_suff + '.peak_time_steps_debug_%d.data' % comm.rank, mode='wb')
+        peak_time_steps_debug_file = open(file_out_suff + '.peak_time_steps_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
         peak_scalar_products_debug_file = open(
-            file_out_suff + '.peak_scalar_products_debug_%d.data' % comm.rank, mode='wb'
+            file_out_suff + '.peak_scalar_products_debug_%d.data' % comm.rank, mode=file_mode
         )
         comm.Barrier()
-        peak_solved_flags_debug_file = open(file_out_suff + '.peak_solved_flags_debug_%d.data' % comm.rank, mode='wb')
+        peak_solved_flags_debug_file = open(file_out_suff + '.peak_solved_flags_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
-        template_nbs_debug_file = open(file_out_suff + '.template_nbs_debug_%d.data' % comm.rank, mode='wb')
+        template_nbs_debug_file = open(file_out_suff + '.template_nbs_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
-        success_flags_debug_file = open(file_out_suff + '.success_flags_debug_%d.data' % comm.rank, mode='wb')
+        success_flags_debug_file = open(file_out_suff + '.success_flags_debug_%d.data' % comm.rank, mode=file_mode)
         comm.Barrier()
     else:
         chunk_nbs_debug_file = None  # default assignment (for PyCharm code inspection)
@@ -250,19 +399,29 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         template_nbs_debug_file = None  # default assignment (for PyCharm code inspection)
         success_flags_debug_file = None  # default assignment (for PyCharm code inspection)
 
+    output_files = [spiketimes_file, amplitudes_file, templates_file]
+    if collect_all:
+        output_files += [garbage_times_file, garbage_temp_file]
+    if debug:
+        output_files += [
+            chunk_nbs_debug_file,
+            iteration_nbs_debug_file,
+            peak_nbs_debug_file,
+            peak_local_time_steps_debug_file,
+            peak_time_steps_debug_file,
+            peak_scalar_products_debug_file,
+            peak_solved_flags_debug_file,
+            template_nbs_debug_file,
+            success_flags_debug_file,
+        ]
+    journal_file = open(file_out_suff + '.journal-%d.data' % comm.rank, file_mode)
+    for output_file in output_files + [journal_file]:
+        output_file.seek(0, os.SEEK_END)
+
     if use_gpu and do_spatial_whitening:
         spatial_whitening = cmt.CUDAMatrix(spatial_whitening, copy_on_host=False)
 
-    last_chunk_size = 0
-    slice_indices = numpy.zeros(0, dtype=numpy.int32)
-
-    to_explore = range(comm.rank, processed_chunks, comm.size)
-
-    if comm.rank == 0:
-        to_explore = get_tqdm_progressbar(to_explore)
-
-    for gcount, gidx in enumerate(to_explore):
-        # print "Node", comm.rank, "is analyzing chunk", gidx, "/", nb_chunks, " ..."
+    def get_padding(gidx, nb_chunks):
         # # We need to deal with the borders by taking chunks of size [0, chunck_size + template_shift].
 
         is_first = data_file.is_first_chunk(gidx, nb_chunks)
@@ -275,10 +434,24 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         else:
             padding = (-temp_3_shift, temp_3_shift)
 
+        return padding
+
+    def fit_chunk(gidx, chunk_size, nb_chunks, local_data=None):
+        """Fit the templates on one chunk of the data.
+
+        The chunk is read from the data file, unless it has already been read (local_data, as returned by
+        get_data). Returns the spike times, amplitudes and templates found in the chunk (and the garbage
+        spikes if collect_all), the debug data and the number of peaks detected in the chunk.
+        """
+
+        padding = get_padding(gidx, nb_chunks)
+
         result = {
             'spiketimes': [],
             'amplitudes': [],
             'templates': [],
+            'gspiketimes': [],
+            'gtemplates': [],
         }
         result_debug = {
             'chunk_nbs': [],
@@ -292,7 +465,9 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
             'success_flags': [],
         }
 
-        local_chunk, t_offset = data_file.get_data(gidx, chunk_size, padding, nodes=nodes)           
+        if local_data is None:
+            local_data = data_file.get_data(gidx, chunk_size, padding, nodes=nodes)
+        local_chunk, t_offset = local_data
         len_chunk = len(local_chunk)
 
         if do_spatial_whitening:
@@ -349,13 +524,8 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         g_offset = t_offset + padding[0]
 
         if ignore_dead_times:
-            dead_indices = numpy.searchsorted(all_dead_times, [t_offset, t_offset + chunk_size])
-            if dead_indices[0] != dead_indices[1]:
-                is_included = numpy.in1d(local_peaktimes + g_offset, all_dead_times[dead_indices[0]:dead_indices[1]])
-                local_peaktimes = local_peaktimes[~is_included]
-                local_peaktimes = numpy.sort(local_peaktimes)
-        else:
-            dead_indices = None  # default assignment (for PyCharm code inspection)
+            is_included = is_in_intervals(local_peaktimes + g_offset, all_dead_times)
+            local_peaktimes = local_peaktimes[~is_included]
 
         # print "Removing the useless borders..."
         local_borders = (template_shift, len_chunk - template_shift)
@@ -367,12 +537,8 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 all_found_spikes[i] = numpy.array(all_found_spikes[i], dtype=numpy.uint32)
 
                 if ignore_dead_times:
-                    if dead_indices[0] != dead_indices[1]:
-                        is_included = numpy.in1d(
-                            all_found_spikes[i] + g_offset, all_dead_times[dead_indices[0]:dead_indices[1]]
-                        )
-                        all_found_spikes[i] = all_found_spikes[i][~is_included]
-                        all_found_spikes[i] = numpy.sort(all_found_spikes[i])
+                    is_included = is_in_intervals(all_found_spikes[i] + g_offset, all_dead_times)
+                    all_found_spikes[i] = numpy.sort(all_found_spikes[i][~is_included])
 
                 idx = (all_found_spikes[i] >= local_borders[0]) & (all_found_spikes[i] < local_borders[1])
                 all_found_spikes[i] = numpy.compress(idx, all_found_spikes[i])
@@ -392,18 +558,12 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
             else:
                 c_local_chunk = None  # default assignment (for PyCharm code inspection)
 
-            local_chunk = local_chunk.T.ravel()
-            sub_mat = numpy.zeros((size_window, nb_local_peak_times), dtype=numpy.float32)
-
-            if len_chunk != last_chunk_size:
-                slice_indices = [numpy.zeros(0, dtype=numpy.int32)]
-                for idx in range(0, n_e):
-                    slice_indices.append(len_chunk * idx + temp_window)
-                slice_indices = numpy.concatenate(slice_indices)
-                last_chunk_size = len_chunk
-
-            for count, idx in enumerate(local_peaktimes):
-                sub_mat[:, count] = numpy.take(local_chunk, slice_indices + idx)
+            # All the snippets are gathered at once, and ordered by electrodes then time steps.
+            sub_mat = numpy.empty((size_window, nb_local_peak_times), dtype=numpy.float32)
+            gather_snippets(
+                local_chunk.astype(numpy.float32, copy=False), local_peaktimes, n_t, offset=-template_shift,
+                channels_first=True, out=sub_mat.reshape(n_e, n_t, nb_local_peak_times)
+            )
 
             del local_chunk
 
@@ -446,8 +606,17 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 c_min_times = None  # default assignment (for PyCharm code inspection)
                 c_max_times = None  # default assignment (for PyCharm code inspection)
 
+            if use_tree:
+                # The best matching of every peak is kept in a segment tree, such that only the peaks
+                # touched by a subtraction (or a rejection) need to be rescored at each iteration.
+                matching_tree = MatchingTree(b[:n_tm, :] * mask)
+                nb_failures = 0
+            else:
+                matching_tree = None  # default assignment (for PyCharm code inspection)
+                nb_failures = None  # default assignment (for PyCharm code inspection)
+
             iteration_nb = 0
-            while numpy.mean(failure) < total_nb_chances:
+            while (nb_failures / float(nb_local_peak_times) if use_tree else numpy.mean(failure)) < total_nb_chances:
 
                 # Is there a way to update sub_b * mask at the same time?
                 if full_gpu:
@@ -455,9 +624,12 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                 else:
                     b_array = None
 
-                data = b[:n_tm, :] * mask
-                best_template_index, peak_index = numpy.unravel_index(data.argmax(), data.shape)
-                peak_scalar_product = data[best_template_index, peak_index]
+                if use_tree:
+                    best_template_index, peak_index, peak_scalar_product = matching_tree.best()
+                else:
+                    data = b[:n_tm, :] * mask
+                    best_template_index, peak_index = numpy.unravel_index(data.argmax(), data.shape)
+                    peak_scalar_product = data[best_template_index, peak_index]
                 best_template2_index = best_template_index + n_tm
 
                 if templates_normalization:
@@ -505,8 +677,12 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                     is_neighbor = np.where(np.abs(peak_data) <= temp_2_shift)[0]
                     idx_neighbor = peak_data[is_neighbor] + temp_2_shift
                     nb_neighbors = len(is_neighbor)
-                    indices = np.zeros((s_over, nb_neighbors), dtype=np.int32)
-                    indices[idx_neighbor, np.arange(nb_neighbors)] = 1
+
+                    if use_lags:
+                        indices = None  # default assignment (for PyCharm code inspection)
+                    else:
+                        indices = np.zeros((s_over, nb_neighbors), dtype=np.int32)
+                        indices[idx_neighbor, np.arange(nb_neighbors)] = 1
 
                     if full_gpu:
                         indices = cmt.CUDAMatrix(indices, copy_on_host=False)
@@ -518,6 +694,11 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         tmp2 = cmt.sparse_dot(c_overs[best_template2_index], indices, mult=-best_amp2)
                         b_lines.add(tmp1.add(tmp2))
                         del tmp1, tmp2
+                    elif use_lags:
+                        for template_index, amp in [(best_template_index, best_amp), (best_template2_index, best_amp2)]:
+                            if amp != 0:
+                                rows, positions, values = io.get_overlaps_block(over_lags, template_index, idx_neighbor)
+                                b[rows, is_neighbor[positions]] -= amp * values
                     else:
                         tmp1 = c_overs[best_template_index].multiply(-best_amp)
                         tmp2 = c_overs[best_template2_index].multiply(-best_amp2)
@@ -543,10 +724,14 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         result_debug['peak_solved_flags'] += [mask[best_template_index, peak_index]]
                         result_debug['template_nbs'] += [best_template_index]
                         result_debug['success_flags'] += [True]
+                    if use_tree:
+                        matching_tree.update(is_neighbor, b[:n_tm, is_neighbor] * mask[:, is_neighbor])
                 else:
                     # Reject the matching.
                     # Update failure counter of the peak.
                     failure[peak_index] += 1
+                    if use_tree:
+                        nb_failures += 1
                     # If the maximal number of failures is reached then mark peak as solved (i.e. not fitted).
                     if failure[peak_index] >= total_nb_chances:
                         # Mark all the matching associated to the current peak as tried.
@@ -565,20 +750,20 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
                         result_debug['peak_solved_flags'] += [mask[best_template_index, peak_index]]
                         result_debug['template_nbs'] += [best_template_index]
                         result_debug['success_flags'] += [False]
+                    if use_tree:
+                        matching_tree.update(
+                            numpy.array([peak_index]), b[:n_tm, peak_index:peak_index + 1] * mask[:, peak_index:peak_index + 1]
+                        )
 
                 iteration_nb += 1
 
-            spikes_to_write = numpy.array(result['spiketimes'], dtype=numpy.uint32)
-            amplitudes_to_write = numpy.array(result['amplitudes'], dtype=numpy.float32)
-            templates_to_write = numpy.array(result['templates'], dtype=numpy.uint32)
-
-            spiketimes_file.write(spikes_to_write.tostring())
-            amplitudes_file.write(amplitudes_to_write.tostring())
-            templates_file.write(templates_to_write.tostring())
+            result['spiketimes'] = numpy.array(result['spiketimes'], dtype=numpy.uint32)
+            result['amplitudes'] = numpy.array(result['amplitudes'], dtype=numpy.float32)
+            result['templates'] = numpy.array(result['templates'], dtype=numpy.uint32)
 
             if collect_all:
 
-                for temp, spike in zip(templates_to_write, spikes_to_write - g_offset):
+                for temp, spike in zip(result['templates'], result['spiketimes'] - g_offset):
                     c_all_times[c_min_times[spike]:c_max_times[spike], neighbors[temp]] = False
 
                 gspikes = numpy.where(numpy.sum(c_all_times, 1) > 0)[0]
@@ -612,31 +797,80 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
                 gspikes = numpy.take(gspikes, idx)
                 bestlecs = numpy.take(bestlecs, idx)
-                gspikes_to_write = numpy.array(gspikes + g_offset, dtype=numpy.uint32)
-                gtemplates_to_write = numpy.array(bestlecs, dtype=numpy.uint32)
-
-                garbage_times_file.write(gspikes_to_write.tostring())
-                garbage_temp_file.write(gtemplates_to_write.tostring())
-
-            if debug:
-                # Write debug data to debug files.
-                for field_label, field_dtype, field_file in [
-                    ('chunk_nbs', numpy.uint32, chunk_nbs_debug_file),
-                    ('iteration_nbs', numpy.uint32, iteration_nbs_debug_file),
-                    ('peak_nbs', numpy.uint32, peak_nbs_debug_file),
-                    ('peak_local_time_steps', numpy.uint32, peak_local_time_steps_debug_file),
-                    ('peak_time_steps', numpy.uint32, peak_time_steps_debug_file),
-                    ('peak_scalar_products', numpy.float32, peak_scalar_products_debug_file),
-                    ('peak_solved_flags', numpy.float32, peak_solved_flags_debug_file),
-                    ('template_nbs', numpy.uint32, template_nbs_debug_file),
-                    ('success_flags', numpy.bool, success_flags_debug_file),
-                ]:
-                    field_to_write = numpy.array(result_debug[field_label], dtype=field_dtype)
-                    field_file.write(field_to_write.tostring())
+                result['gspiketimes'] = numpy.array(gspikes + g_offset, dtype=numpy.uint32)
+                result['gtemplates'] = numpy.array(bestlecs, dtype=numpy.uint32)
 
             if full_gpu:
                 del b, data
 
+        return result, result_debug, nb_local_peak_times
+
+    if auto_chunk and not resumed:
+        if comm.rank == 0:
+            lines = [
+                "Calibrating the chunk size with %d templates and %d overlaps..." % (n_tm, n_over_values)
+            ]
+            print_and_log(lines, 'debug', logger)
+        # Each peak needs its scalar products with all the templates, its mask and its snippet.
+        bytes_per_peak = 4 * 2 * n_tm + n_tm + 4 * size_window
+        chunk_size = calibrate_chunk_size(
+            params, lambda gidx, size, nb: fit_chunk(gidx, size, nb)[2], chunk_size, bytes_per_peak
+        )
+
+    nb_chunks, last_chunk_len = data_file.analyze(chunk_size)
+    processed_chunks = int(min(nb_chunks, max_chunk))
+
+    if comm.rank == 0:
+        header = numpy.concatenate(([chunk_size, nb_writers], signature)).astype(numpy.float64)
+        header.tofile(journal_header_name)
+
+    all_chunks = numpy.setdiff1d(numpy.arange(processed_chunks), done_chunks)
+    to_explore = ChunkScheduler(len(all_chunks), dynamic=dynamic_scheduling)
+
+    if comm.rank == 0:
+        to_explore = get_tqdm_progressbar(to_explore)
+
+    # The next chunks are read while the current one is fitted.
+    to_explore = data_file.prefetch(
+        (all_chunks[count] for count in to_explore), chunk_size, lambda gidx: get_padding(gidx, nb_chunks),
+        nodes=nodes, depth=prefetch
+    )
+
+    for gcount, (gidx, local_data) in enumerate(to_explore):
+
+        result, result_debug, _ = fit_chunk(gidx, chunk_size, nb_chunks, local_data)
+
+        spiketimes_file.write(numpy.array(result['spiketimes'], dtype=numpy.uint32).tostring())
+        amplitudes_file.write(numpy.array(result['amplitudes'], dtype=numpy.float32).tostring())
+        templates_file.write(numpy.array(result['templates'], dtype=numpy.uint32).tostring())
+
+        if collect_all:
+            garbage_times_file.write(numpy.array(result['gspiketimes'], dtype=numpy.uint32).tostring())
+            garbage_temp_file.write(numpy.array(result['gtemplates'], dtype=numpy.uint32).tostring())
+
+        if debug:
+            # Write debug data to debug files.
+            for field_label, field_dtype, field_file in [
+                ('chunk_nbs', numpy.uint32, chunk_nbs_debug_file),
+                ('iteration_nbs', numpy.uint32, iteration_nbs_debug_file),
+                ('peak_nbs', numpy.uint32, peak_nbs_debug_file),
+                ('peak_local_time_steps', numpy.uint32, peak_local_time_steps_debug_file),
+                ('peak_time_steps', numpy.uint32, peak_time_steps_debug_file),
+                ('peak_scalar_products', numpy.float32, peak_scalar_products_debug_file),
+                ('peak_solved_flags', numpy.float32, peak_solved_flags_debug_file),
+                ('template_nbs', numpy.uint32, template_nbs_debug_file),
+                ('success_flags', numpy.bool, success_flags_debug_file),
+            ]:
+                field_to_write = numpy.array(result_debug[field_label], dtype=field_dtype)
+                field_file.write(field_to_write.tostring())
+
+        # The chunk is recorded in the journal once all its results have been written.
+        for output_file in output_files:
+            output_file.flush()
+        record = numpy.array([gidx] + [output_file.tell() for output_file in output_files], dtype=numpy.int64)
+        journal_file.write(record.tostring())
+        journal_file.flush()
+
     sys.stderr.flush()
 
     spiketimes_file.flush()
@@ -678,9 +912,29 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
             os.fsync(field_file.fileno())
             field_file.close()
 
+    journal_file.flush()
+    os.fsync(journal_file.fileno())
+    journal_file.close()
+
+    if use_lazy:
+        stats = gather_array(c_overs.get_stats(), comm, dtype='int64')
+        # Overlaps of a template can be computed several times (after an eviction, or by several nodes).
+        computed_templates = gather_array(numpy.where(is_computed)[0].astype(numpy.int64), comm, dtype='int64')
+        if comm.rank == 0:
+            hits, misses, evictions = numpy.sum(stats.reshape(-1, 3), 0)
+            lines = [
+                "Overlaps computed on demand for %d templates (%d computations, %d evictions)"
+                % (len(numpy.unique(computed_templates)), misses, evictions),
+                "Overlaps cache: %d hits, %d misses (hit rate %.1f%%)"
+                % (hits, misses, 100 * hits / float(max(1, hits + misses)))
+            ]
+            print_and_log(lines, 'info', logger)
+
     comm.Barrier()
 
     if comm.rank == 0:
-        io.collect_data(comm.size, params, erase=True)
+        io.collect_data(nb_writers, params, erase=True, nb_cpu=nb_cpu)
+        # The run is complete, so it should never be resumed.
+        purge(file_out_suff, '.journal')
 
     data_file.close()
@@ -7,4 +7,4 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
 
     _ = init_logging(params.logfile)
     logger = logging.getLogger('circus.gathering')
-    io.collect_data(nb_cpu, params, erase=False)
+    io.collect_data(nb_cpu, params, erase=False, nb_cpu=nb_cpu)
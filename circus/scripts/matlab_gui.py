@@ -104,6 +104,15 @@ def main(argv=None):
     if extension != '':
         extension = '-' + extension
 
+    # The MATLAB GUI reads the results per template, which are not saved with result_layout = columnar.
+    result_file = file_out_suff + '.result%s.hdf5' % extension
+    if os.path.exists(result_file):
+        with h5py.File(result_file, 'r') as myfile:
+            columnar = 'spike_times' in myfile
+        if columnar:
+            print_and_log(["The MATLAB GUI can not read columnar results: fit again with result_layout = groups"], 'error', logger)
+            sys.exit(0)
+
     def generate_matlab_mapping(probe):
         p = {}
         positions = []
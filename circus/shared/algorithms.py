@@ -4,6 +4,7 @@ import sys
 import scipy.optimize
 import numpy
 # import pylab
+import scipy.spatial
 import scipy.spatial.distance
 import scipy.stats
 import shutil
@@ -11,7 +12,8 @@ import h5py
 import scipy.linalg
 import scipy.sparse
 
-from circus.shared.files import load_data, write_datasets, get_overlaps, load_data_memshared, get_stas
+from circus.shared.files import load_data, write_datasets, get_overlaps, load_data_memshared, get_stas, get_overlaps_range
+from circus.shared.files import update_overlaps_file
 from circus.shared.utils import get_tqdm_progressbar, get_shared_memory_flag, dip, dip_threshold, \
     batch_folding_test_with_MPA, bhatta_dist, nd_bhatta_dist, test_if_support, test_if_purity
 from circus.shared.messages import print_and_log
@@ -21,6 +23,7 @@ from circus.shared.mpi import all_gather_array, comm, gather_array
 import scipy.linalg
 import scipy.sparse
 import statsmodels.api as sm
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger(__name__)
 
@@ -98,11 +101,20 @@ class DistanceMatrix(object):
 
         return result
 
-    def get_deltas_and_neighbors(self, rho):
+    def get_deltas_and_neighbors(self, rho, nb_threads=1, block_size=2**20):
         """Find the distance to and the index of the nearest point with a higher density.
 
+        Points are processed by blocks of consecutive points in decreasing rho order: the distances between the
+        points of a block and all the points with a higher density are gathered at once (from the condensed or the
+        dense matrix), and the nearest one is found with a single masked argmin. Blocks are independent, and can be
+        processed by several threads.
+
         Argument:
             rho
+            nb_threads
+                Number of threads processing the blocks.
+            block_size
+                Maximal number of distances gathered for a block.
         Returns:
             nearest_higher_rho_distances
                 For each point, distance to the nearest point with a higher density (i.e. delta).
@@ -113,13 +125,39 @@ class DistanceMatrix(object):
         indices = numpy.argsort(-rho)  # sort indices by decreasing rho values
         nearest_higher_rho_indices = numpy.zeros(self.size, dtype=numpy.int)  # i.e. neighbors
         nearest_higher_rho_distances = numpy.zeros(self.size, dtype=numpy.float32)  # i.e. deltas
-        for k, index in enumerate(indices):
-            higher_rho_indices = indices[0:k + 1]
-            higher_rho_distances = self.get_row(index)[higher_rho_indices]
-            higher_rho_distances[higher_rho_distances == 0.0] = float('inf')
-            nearest_index = numpy.argmin(higher_rho_distances)
-            nearest_higher_rho_indices[index] = higher_rho_indices[nearest_index]
-            nearest_higher_rho_distances[index] = higher_rho_distances[nearest_index]
+        nb_rows = max(1, block_size // max(1, self.size))
+        offsets = self.didx(numpy.arange(self.size), 0)  # such that didx(i, j) is offsets[i] + j
+
+        def process_block(start):
+            # Points start to stop (in rho order) are only compared to the points before them, and not to themselves.
+            stop = min(start + nb_rows, self.size)
+            rows = indices[start:stop, numpy.newaxis]
+            higher_rho_indices = indices[numpy.newaxis, :stop]
+            if self.distances.ndim == 2:
+                higher_rho_distances = self.distances[rows, higher_rho_indices]
+            else:
+                pairs = offsets[numpy.minimum(rows, higher_rho_indices)] + numpy.maximum(rows, higher_rho_indices)
+                pairs[rows == higher_rho_indices] = 0  # not in the condensed matrix, and masked below
+                higher_rho_distances = numpy.zeros(pairs.shape, dtype=numpy.float32)
+                if len(self.distances) > 0:
+                    higher_rho_distances[:] = self.distances[pairs]
+            is_lower = numpy.arange(stop)[numpy.newaxis, :] >= numpy.arange(start, stop)[:, numpy.newaxis]
+            higher_rho_distances[is_lower | (higher_rho_distances == 0.0)] = float('inf')
+            nearest_index = numpy.argmin(higher_rho_distances, axis=1)
+            nearest_higher_rho_indices[indices[start:stop]] = indices[nearest_index]
+            nearest_higher_rho_distances[indices[start:stop]] = \
+                higher_rho_distances[numpy.arange(stop - start), nearest_index]
+
+        blocks = range(0, self.size, nb_rows)
+        if nb_threads > 1:
+            pool = ThreadPool(nb_threads)
+            pool.map(process_block, blocks)
+            pool.close()
+            pool.join()
+        else:
+            for start in blocks:
+                process_block(start)
+
         if len(indices) > 1:
             nearest_higher_rho_distances[indices[0]] = numpy.max(nearest_higher_rho_distances[indices[1:]])
 
@@ -135,6 +173,84 @@ class DistanceMatrix(object):
         del self.distances
 
 
+class MatchingTree(object):
+    """Max segment tree over the peaks of a chunk, used by the greedy template matching.
+
+    Each leaf stores, for one peak, the best masked scalar product over all the templates (and the
+    index of that template). Internal nodes keep the best of their two children, with ties broken
+    exactly as numpy.argmax would break them on the dense (templates, peaks) matrix: lowest template
+    index first, then lowest peak index. The global best matching is thus found in O(1), and only the
+    peaks touched by a subtraction need to be rescored, in O(n_templates * nb_touched * log(n_peaks)).
+
+    Arguments:
+        scores
+            Masked scalar products, of shape (n_templates, n_peaks).
+    """
+
+    def __init__(self, scores):
+
+        self.nb_peaks = scores.shape[1]
+        self.size = 1
+        while self.size < self.nb_peaks:
+            self.size *= 2
+
+        self.values = numpy.empty(2 * self.size, dtype=numpy.float64)
+        self.values.fill(-numpy.inf)
+        self.templates = numpy.empty(2 * self.size, dtype=numpy.int64)
+        self.templates.fill(numpy.iinfo(numpy.int64).max)
+        self.peaks = numpy.zeros(2 * self.size, dtype=numpy.int64)
+        self.peaks[self.size:] = numpy.arange(self.size)
+
+        self._set_leaves(numpy.arange(self.nb_peaks), scores)
+
+        # Build all the internal nodes, level by level.
+        nodes = numpy.arange(self.size // 2, self.size)
+        while len(nodes) > 0 and nodes[0] > 0:
+            self._merge(nodes)
+            nodes = numpy.arange(nodes[0] // 2, nodes[0])
+
+    def _set_leaves(self, peaks, scores):
+
+        best_templates = numpy.argmax(scores, 0)
+        leaves = peaks + self.size
+        self.values[leaves] = scores[best_templates, numpy.arange(len(peaks))]
+        self.templates[leaves] = best_templates
+
+    def _merge(self, nodes):
+
+        left = 2 * nodes
+        right = left + 1
+        left_values = self.values[left]
+        right_values = self.values[right]
+        use_right = (right_values > left_values) | \
+                    ((right_values == left_values) & (self.templates[right] < self.templates[left]))
+        children = numpy.where(use_right, right, left)
+        self.values[nodes] = self.values[children]
+        self.templates[nodes] = self.templates[children]
+        self.peaks[nodes] = self.peaks[children]
+
+    def update(self, peaks, scores):
+        """Rescore some peaks.
+
+        Arguments:
+            peaks
+                Sorted indices of the peaks to update.
+            scores
+                New masked scalar products for these peaks, of shape (n_templates, len(peaks)).
+        """
+
+        self._set_leaves(peaks, scores)
+        nodes = numpy.unique((peaks + self.size) // 2)
+        while nodes[0] > 0:
+            self._merge(nodes)
+            nodes = numpy.unique(nodes // 2)
+
+    def best(self):
+        """Return the (template index, peak index, scalar product) of the best matching."""
+
+        return self.templates[1], self.peaks[1], self.values[1]
+
+
 def fit_rho_delta(xdata, ydata, alpha=3):
 
     if xdata.min() == xdata.max():
@@ -186,11 +302,109 @@ def compute_rho(data, update=None, mratio=0.01):
     return answer
 
 
-def clustering_by_density(rho, dist, n_min, alpha=3, halo_rejection=3):
+def compute_rho_knn(data, update=None, mratio=0.01):
+    """Same densities as compute_rho, with k-nearest neighbors queries in a KD-tree.
+
+    Only the distances to the nb_selec nearest neighbors of each point are computed, and returned as an array of
+    shape (nb_points, nb_selec), such that the memory is O(nb_points * nb_selec) instead of O(nb_points ** 2).
+    """
+
+    nb_points = len(data)
+    nb_selec = max(5, int(mratio * nb_points))
+
+    if nb_points == 0:
+        return numpy.zeros(0, dtype=numpy.float32), numpy.zeros((0, nb_selec), dtype=numpy.float32)
+
+    if update is None:
+        # The nearest neighbor of each point is itself, hence the extra neighbor.
+        nb_neighbors = min(nb_selec + 1, nb_points)
+        dist_sorted, _ = scipy.spatial.cKDTree(data).query(data, k=nb_neighbors)
+        dist_sorted = numpy.asarray(dist_sorted, dtype=numpy.float32).reshape(nb_points, nb_neighbors)[:, 1:]
+    else:
+        nb_neighbors = min(nb_selec, len(update[0]))
+        dist_sorted, _ = scipy.spatial.cKDTree(update[0]).query(data, k=nb_neighbors)
+        dist_sorted = numpy.asarray(dist_sorted, dtype=numpy.float32).reshape(nb_points, nb_neighbors)
+        dist_sorted = numpy.concatenate((update[1], dist_sorted), axis=1)
+        if dist_sorted.shape[1] > nb_selec:
+            dist_sorted = numpy.partition(dist_sorted, nb_selec, axis=1)[:, :nb_selec]
+
+    rho = numpy.mean(dist_sorted, axis=1).astype(numpy.float32)
+
+    return rho, dist_sorted
+
+
+def get_deltas_and_neighbors_knn(data, rho, nb_neighbors=32, max_neighbors=512):
+    """Same as DistanceMatrix.get_deltas_and_neighbors, with incremental k-nearest neighbors queries in a KD-tree.
+
+    The nearest point with a higher density is searched among the nb_neighbors nearest neighbors of each point,
+    and this number is doubled for the points where none is found, up to max_neighbors. Only the few remaining
+    points (e.g. the densest point of each cluster) are compared to all the points with a higher density. Ties
+    are broken as in get_deltas_and_neighbors, in favor of the point with the highest density.
+
+    Arguments:
+        data
+            Array of shape (nb_points, nb_dimensions).
+        rho
+    Returns:
+        nearest_higher_rho_distances
+        nearest_higher_rho_indices
+    """
 
     nb_points = len(rho)
-    distances = DistanceMatrix(nb_points, distances=dist)
-    deltas, neighbors = distances.get_deltas_and_neighbors(rho)
+    indices = numpy.argsort(-rho)  # sort indices by decreasing rho values
+    ranks = numpy.empty(nb_points, dtype=numpy.int64)
+    ranks[indices] = numpy.arange(nb_points)
+    nearest_higher_rho_indices = numpy.zeros(nb_points, dtype=numpy.int64)  # i.e. neighbors
+    nearest_higher_rho_distances = numpy.zeros(nb_points, dtype=numpy.float32)  # i.e. deltas
+
+    tree = scipy.spatial.cKDTree(data)
+    to_search = numpy.arange(nb_points)
+    nb_neighbors = min(nb_neighbors, nb_points)
+
+    while len(to_search) > 0 and nb_neighbors <= max_neighbors:
+        distances, neighbors = tree.query(data[to_search], k=nb_neighbors)
+        distances = numpy.asarray(distances, dtype=numpy.float32).reshape(len(to_search), nb_neighbors)
+        neighbors = neighbors.reshape(len(to_search), nb_neighbors)
+        neighbor_ranks = ranks[neighbors]
+        is_higher = (neighbor_ranks < ranks[to_search, numpy.newaxis]) & (distances > 0)
+        distances[~is_higher] = float('inf')
+        best_distances = numpy.min(distances, axis=1)
+        neighbor_ranks[distances > best_distances[:, numpy.newaxis]] = nb_points
+        best_neighbors = indices[numpy.min(neighbor_ranks, axis=1) % nb_points]
+        found = numpy.isfinite(best_distances)
+        nearest_higher_rho_distances[to_search[found]] = best_distances[found]
+        nearest_higher_rho_indices[to_search[found]] = best_neighbors[found]
+        to_search = to_search[~found]
+        if nb_neighbors == nb_points:
+            break
+        nb_neighbors = min(2 * nb_neighbors, nb_points)
+
+    for index in to_search:
+        higher_rho_indices = indices[0:ranks[index] + 1]
+        higher_rho_distances = scipy.spatial.distance.cdist(
+            data[index:index + 1], data[higher_rho_indices], 'euclidean'
+        ).astype(numpy.float32)[0]
+        higher_rho_distances[higher_rho_distances == 0.0] = float('inf')
+        nearest_index = numpy.argmin(higher_rho_distances)
+        nearest_higher_rho_indices[index] = higher_rho_indices[nearest_index]
+        nearest_higher_rho_distances[index] = higher_rho_distances[nearest_index]
+
+    if nb_points > 1:
+        nearest_higher_rho_distances[indices[0]] = numpy.max(nearest_higher_rho_distances[indices[1:]])
+
+    return nearest_higher_rho_distances, nearest_higher_rho_indices
+
+
+def clustering_by_density(rho, dist, n_min, alpha=3, halo_rejection=3, data=None):
+
+    nb_points = len(rho)
+    if dist is None:
+        # Nearest points with a higher density are found from the data with a KD-tree (see compute_rho_knn).
+        distances = None
+        deltas, neighbors = get_deltas_and_neighbors_knn(data, rho)
+    else:
+        distances = DistanceMatrix(nb_points, distances=dist)
+        deltas, neighbors = distances.get_deltas_and_neighbors(rho)
     nb_clusters, labels, centers = find_centroids_and_clusters(distances, rho, deltas, neighbors, alpha)
     halolabels = halo_assign(labels, rho, n_min, halo_rejection) - 1
     centers = numpy.where(centers - 1 >= 0)[0]
@@ -738,7 +952,6 @@ def merging_cc(params, nb_cpu, nb_gpu, use_gpu):
             use_gpu=use_gpu, nb_cpu=nb_cpu, nb_gpu=nb_gpu, decimation=decimation
         )
         overlap.close()
-        filename = params.get('data', 'file_out_suff') + '.overlap-merging.hdf5'
 
         SHARED_MEMORY = get_shared_memory_flag(params)
 
@@ -757,7 +970,7 @@ def merging_cc(params, nb_cpu, nb_gpu, use_gpu):
 
         for i in to_explore:
 
-            idx = numpy.where((over_x >= i * nb_temp + i + 1) & (over_x < ((i + 1) * nb_temp)))[0]
+            idx = get_overlaps_range(over_x, i * nb_temp + i + 1, (i + 1) * nb_temp)
             local_x = over_x[idx] - (i * nb_temp + i + 1)
             data = numpy.zeros((nb_temp - (i + 1), over_shape[1]), dtype=numpy.float32)
             data[local_x, over_y[idx]] = over_data[idx]
@@ -785,8 +998,9 @@ def merging_cc(params, nb_cpu, nb_gpu, use_gpu):
 
         del result, over_x, over_y, over_data
 
-        if comm.rank == 0:
-            os.remove(filename)
+        # The overlaps are kept only if they are to be updated by delete_mixtures.
+        if comm.rank == 0 and not params.getboolean('clustering', 'remove_mixture'):
+            os.remove(params.get('data', 'file_out_suff') + '.overlap-merging.hdf5')
 
     return [nb_temp, len(to_merge)]
 
@@ -1179,6 +1393,7 @@ def delete_mixtures(params, nb_cpu, nb_gpu, use_gpu):
     # to_remove = []  # TODO remove (not used)?
 
     filename = params.get('data', 'file_out_suff') + '.overlap-mixtures.hdf5'
+    merging_filename = params.get('data', 'file_out_suff') + '.overlap-merging.hdf5'
     norm_templates = load_data(params, 'norm-templates')
     best_elec = load_data(params, 'electrodes')
     limits = load_data(params, 'limits')
@@ -1188,9 +1403,10 @@ def delete_mixtures(params, nb_cpu, nb_gpu, use_gpu):
     decimation = params.getboolean('clustering', 'decimation')
     has_support = test_if_support(params, '')
 
-    overlap = get_overlaps(
-        params, extension='-mixtures', erase=True, normalize=True, maxoverlap=False, verbose=False, half=True,
-        use_gpu=use_gpu, nb_cpu=nb_cpu, nb_gpu=nb_gpu, decimation=decimation
+    # The overlaps computed by merging_cc, if any, only need to be updated for the merged templates.
+    overlap = update_overlaps_file(
+        params, extension='-mixtures', input_extension='-merging', normalize=True, maxoverlap=False, verbose=False,
+        half=True, use_gpu=use_gpu, nb_cpu=nb_cpu, nb_gpu=nb_gpu, decimation=decimation
     )
     overlap.close()
 
@@ -1305,5 +1521,8 @@ def delete_mixtures(params, nb_cpu, nb_gpu, use_gpu):
 
     if comm.rank == 0:
         os.remove(filename)
+        # The overlaps computed by merging_cc are no longer needed.
+        if os.path.exists(merging_filename):
+            os.remove(merging_filename)
 
     return [nb_temp, len(to_remove)]
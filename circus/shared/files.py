@@ -3,11 +3,13 @@ from __future__ import division
 from circus.shared.utils import get_tqdm_progressbar
 import numpy
 import os
+import hashlib
 import platform
 import re
 import scipy
 import logging
 import sys
+from multiprocessing.pool import ThreadPool
 
 import warnings
 with warnings.catch_warnings():
@@ -18,12 +20,15 @@ from colorama import Fore
 from circus.shared.mpi import all_gather_array, gather_array, comm, get_local_ring, MPI
 from circus.shared.probes import get_nodes_and_edges, get_central_electrode
 from circus.shared.messages import print_and_log
-from circus.shared.utils import purge, get_parallel_hdf5_flag, indices_for_dead_times, get_shared_memory_flag
+from circus.shared.utils import purge, get_parallel_hdf5_flag, merge_intervals, get_shared_memory_flag
+from circus.shared.utils import get_alignment_kernels, align_snippets
 import circus
 
 
 logger = logging.getLogger(__name__)
 
+SNIPPETS_BATCH_SIZE = 2**24  # Maximal number of values in the batches of snippets read by iter_snippets
+
 
 def data_stats(params, show=True, export_times=False):
 
@@ -75,13 +80,42 @@ def data_stats(params, show=True, export_times=False):
         return times
 
 
+def iter_snippets(
+        data_file, times, length, nodes=None, spatial_whitening=None, temporal_whitening=None, neighs=None,
+        aligner=None
+):
+    """
+    Iterates over the snippets of size length starting at the given times, optionally whitened, restricted to the
+    neighs channels and aligned by aligner (a function of a batch of snippets, see align_snippets). Snippets are
+    read by batches with get_snippets, and whitened and aligned by batches as well.
+    """
+    if nodes is None:
+        nb_nodes = data_file.nb_channels
+    else:
+        nb_nodes = len(nodes)
+    batch_size = max(1, SNIPPETS_BATCH_SIZE // (length * nb_nodes))
+
+    for start in range(0, len(times), batch_size):
+        snippets = data_file.get_snippets(times[start:start + batch_size], length, nodes=nodes)
+        if spatial_whitening is not None:
+            snippets = numpy.dot(snippets, spatial_whitening)
+        if temporal_whitening is not None:
+            snippets = scipy.ndimage.filters.convolve1d(snippets, temporal_whitening, axis=1, mode='constant')
+        if neighs is not None:
+            snippets = numpy.take(snippets, neighs, axis=2)
+        if aligner is not None:
+            snippets = aligner(snippets)
+        for snippet in snippets:
+            yield snippet
+
+
 def get_stas(
         params, times_i, labels_i, src, neighs, nodes=None,
         mean_mode=False, all_labels=False, pos='neg', auto_align=True
 ):
 
     data_file = params.data_file
-    data_file.open()
+    data_file.open(persistent=True)
     N_t = params.getint('detection', 'N_t')
     if not all_labels:
         if not mean_mode:
@@ -103,6 +137,8 @@ def get_stas(
     template_shift_2 = template_shift + jitter_range
     mads = load_data(params, 'mads')
 
+    spatial_whitening = None
+    temporal_whitening = None
     if do_spatial_whitening:
         spatial_whitening = load_data(params, 'spatial_whitening')
     if do_temporal_whitening:
@@ -126,17 +162,23 @@ def get_stas(
     idx = numpy.where(neighs == src)[0]
     ydata = numpy.arange(len(neighs))
 
-    count = 0
-    for lb, time in zip(labels_i, times_i):
-
-        local_chunk = data_file.get_snippet(time - offset, duration, nodes=nodes)
-
-        if do_spatial_whitening:
-            local_chunk = numpy.dot(local_chunk, spatial_whitening)
-        if do_temporal_whitening:
-            local_chunk = scipy.ndimage.filters.convolve1d(local_chunk, temporal_whitening, axis=0, mode='constant')
+    aligner = None
+    if alignment and params.get('detection', 'alignment_engine').lower() == 'kernels':
+        # All the snippets are aligned by batches, with the same (unsmoothed) cubic interpolation.
+        search_kernel, shift_kernels = get_alignment_kernels(xdata, cdata, xoff, over_factor, template_shift, N_t)
+        if len(ydata) == 1:
+            channel = 0
+        else:
+            channel = idx[0]
+        aligner = lambda snippets: align_snippets(snippets, search_kernel, shift_kernels, channel, pos == 'neg')
+        alignment = False
 
-        local_chunk = numpy.take(local_chunk, neighs, axis=1)
+    count = 0
+    snippets = iter_snippets(
+        data_file, numpy.asarray(times_i, dtype=numpy.int64) - offset, duration, nodes=nodes,
+        spatial_whitening=spatial_whitening, temporal_whitening=temporal_whitening, neighs=neighs, aligner=aligner
+    )
+    for lb, local_chunk in zip(labels_i, snippets):
 
         if alignment:
             local_factor = align_factor*((smoothing_factor*mads[src])**2)
@@ -196,7 +238,8 @@ def get_dead_times(params):
     Returns
     -------
     A 2D NumPy array containing the start and stop sampling points 
-    (or times) to be excluded from the data. 
+    (or times) to be excluded from the data. Intervals are merged and
+    sorted, such that times can be tested with is_in_intervals.
     """
 
     def _get_dead_times(params):
@@ -208,8 +251,7 @@ def get_dead_times(params):
         if dead_in_ms:
             dead_times *= numpy.int64(data_file.sampling_rate*1e-3)
         dead_times = dead_times.astype(numpy.int64)
-        all_dead_times = indices_for_dead_times(dead_times[:, 0], dead_times[:, 1])
-        return all_dead_times
+        return merge_intervals(dead_times)
 
     if not get_shared_memory_flag(params):
         return _get_dead_times(params)
@@ -222,7 +264,7 @@ def get_dead_times(params):
         nb_dead_times = 0
 
         if sub_comm.rank == 0:
-            dead_times = _get_dead_times(params)
+            dead_times = _get_dead_times(params).ravel()
             nb_dead_times = len(dead_times)
 
         sub_comm.Barrier()
@@ -245,7 +287,7 @@ def get_dead_times(params):
             data[:] = dead_times
 
         sub_comm.Free()
-        return data
+        return data.reshape(-1, 2)
 
 
 def get_stas_memshared(
@@ -260,7 +302,7 @@ def get_stas_memshared(
 
     # Load parameters.
     data_file = params.data_file
-    data_file.open()
+    data_file.open(persistent=True)
     N_t = params.getint('detection', 'N_t')
     N_total = params.nb_channels
     alignment = params.getboolean('detection', 'alignment') and auto_align
@@ -321,22 +363,37 @@ def get_stas_memshared(
             xdata = numpy.arange(-template_shift_2, template_shift_2 + 1)
             xoff = len(cdata) / 2.0
 
-        count = 0
-        for lb, time in zip(labels_i, times_i):
-
-            if alignment:
-                local_chunk = data_file.get_snippet(time - template_shift_2, duration, nodes=nodes)
+        if not do_spatial_whitening:
+            spatial_whitening = None
+        if not do_temporal_whitening:
+            temporal_whitening = None
+
+        aligner = None
+        if alignment and params.get('detection', 'alignment_engine').lower() == 'kernels':
+            # All the snippets are aligned by batches, with the same cubic interpolation.
+            search_kernel, shift_kernels = get_alignment_kernels(xdata, cdata, xoff, over_factor, template_shift, N_t)
+            if len(neighs) == 1:
+                channel = 0
             else:
-                local_chunk = data_file.get_snippet(time - template_shift, N_t, nodes=nodes)
+                channel = numpy.where(neighs == src)[0][0]
+            aligner = lambda snippets: align_snippets(snippets, search_kernel, shift_kernels, channel, True)
 
-            if do_spatial_whitening:
-                local_chunk = numpy.dot(local_chunk, spatial_whitening)
-            if do_temporal_whitening:
-                local_chunk = scipy.ndimage.filters.convolve1d(local_chunk, temporal_whitening, axis=0, mode='constant')
+        times_i = numpy.asarray(times_i, dtype=numpy.int64)
+        if alignment:
+            snippets = iter_snippets(
+                data_file, times_i - template_shift_2, duration, nodes=nodes, spatial_whitening=spatial_whitening,
+                temporal_whitening=temporal_whitening, neighs=neighs, aligner=aligner
+            )
+        else:
+            snippets = iter_snippets(
+                data_file, times_i - template_shift, N_t, nodes=nodes,
+                spatial_whitening=spatial_whitening, temporal_whitening=temporal_whitening, neighs=neighs
+            )
 
-            local_chunk = numpy.take(local_chunk, neighs, axis=1)
+        count = 0
+        for lb, local_chunk in zip(labels_i, snippets):
 
-            if alignment:
+            if alignment and aligner is None:
                 idx = numpy.where(neighs == src)[0]
                 ydata = numpy.arange(len(neighs))
                 if len(ydata) == 1:
@@ -377,15 +434,10 @@ def get_stas_memshared(
 def get_artefact(params, times_i, tau, nodes):
 
     data_file = params.data_file
-    data_file.open()
+    data_file.open(persistent=True)
 
-    dx, dy = len(nodes), int(tau)
-    artefact = numpy.zeros((0, dx, dy), dtype=numpy.float32)
-    for time in times_i:
-        snippet = data_file.get_snippet(int(time), int(tau), nodes).T.reshape(1, dx, dy)
-        artefact = numpy.vstack((artefact, snippet))
-
-    artefact = numpy.median(artefact, 0)
+    artefact = data_file.get_snippets(numpy.asarray(times_i, dtype=numpy.int64), int(tau), nodes)
+    artefact = numpy.median(artefact, 0).T
 
     data_file.close()
 
@@ -499,6 +551,7 @@ def load_data_memshared(
                     over_x = c_overlap.get('over_x')[:]
                     over_y = c_overlap.get('over_y')[:]
                     over_data = c_overlap.get('over_data')[:]
+                    over_x, over_y, over_data = sort_overlaps(over_x, over_y, over_data)
                     nb_data = len(over_x)
 
                 c_overlap.close()
@@ -528,10 +581,7 @@ def load_data_memshared(
                 for i in range(N_over):
 
                     if local_rank == 0:
-                        idx = numpy.where((over_x >= i * N_over) & (over_x < ((i + 1) * N_over)))[0]
-                        local_x = over_x[idx] - i * N_over
-
-                        sparse_mat = scipy.sparse.csr_matrix((over_data[idx], (local_x, over_y[idx])), shape=(N_over, over_shape[1]))
+                        sparse_mat = get_overlaps_csr(over_x, over_y, over_data, i * N_over, N_over, over_shape[1])
                         local_nb_data = len(sparse_mat.data)
                         local_nb_ptr = len(sparse_mat.indptr)
 
@@ -599,6 +649,7 @@ def load_data_memshared(
                 c_overlap.close()
 
                 if local_rank == 0:
+                    over_x, over_y, over_data = sort_overlaps(over_x, over_y, over_data)
                     nb_data = len(over_x)
 
                 long_size = numpy.int64(sub_comm.bcast(numpy.array([nb_data], dtype=numpy.int32), root=0)[0])
@@ -985,11 +1036,10 @@ def load_data(params, data, extension=''):
 
             c_overs = {}
             N_over = int(numpy.sqrt(over_shape[0]))
+            over_x, over_y, over_data = sort_overlaps(over_x, over_y, over_data)
 
             for i in range(N_over):
-                idx = numpy.where((over_x >= i*N_over) & (over_x < ((i+1)*N_over)))[0]
-                local_x = over_x[idx] - i*N_over
-                c_overs[i] = scipy.sparse.csr_matrix((over_data[idx], (local_x, over_y[idx])), shape=(N_over, over_shape[1]))
+                c_overs[i] = get_overlaps_csr(over_x, over_y, over_data, i*N_over, N_over, over_shape[1])
 
             del over_x, over_y, over_data, over_shape
 
@@ -998,6 +1048,26 @@ def load_data(params, data, extension=''):
             if comm.rank == 0:
                 print_and_log(["No overlaps found! Check suffix?"], 'error', logger)
             sys.exit(0)
+    elif data == 'overlaps-lags':
+        filename = file_out_suff + '.overlap-lags%s.hdf5' % extension
+        if os.path.exists(filename):
+            myfile = h5py.File(filename, 'r', libver='earliest')
+            over_lags = []
+            for key in ['indptr', 'rows', 'data']:
+                dataset = myfile.get(key)
+                offset = dataset.id.get_offset()
+                # Contiguous datasets are memory mapped, such that all the nodes share the same pages.
+                if offset is None:
+                    over_lags.append(dataset[:])
+                else:
+                    over_lags.append(numpy.memmap(filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape))
+            over_lags.append(myfile.get('over_shape')[:])
+            myfile.close()
+            return tuple(over_lags)
+        else:
+            if comm.rank == 0:
+                print_and_log(["No overlaps found! Check suffix?"], 'error', logger)
+            sys.exit(0)
     elif data == 'overlaps-raw':
         filename = file_out_suff + '.overlap%s.hdf5' % extension
         if os.path.exists(filename):
@@ -1007,6 +1077,7 @@ def load_data(params, data, extension=''):
             over_data = myfile.get('over_data')[:].ravel()
             over_shape = myfile.get('over_shape')[:].ravel()
             myfile.close()
+            over_x, over_y, over_data = sort_overlaps(over_x, over_y, over_data)
             return over_x, over_y, over_data, over_shape
         else:
             if comm.rank == 0:
@@ -1196,8 +1267,8 @@ def load_data(params, data, extension=''):
             template_shift = params.getint('detection', 'template_shift')
 
             spikes = numpy.zeros((N_t, N_total, N_tr))
-            for (count, idx) in enumerate(triggers):
-                spikes[:, :, count] = data_file.get_snippet(idx - template_shift, N_t)
+            for (count, snippet) in enumerate(iter_snippets(data_file, triggers.astype(numpy.int64) - template_shift, N_t)):
+                spikes[:, :, count] = snippet
             data_file.close()
             return triggers, spikes
         else:
@@ -1427,7 +1498,18 @@ def write_datasets(h5file, to_write, result, electrode=None, compression=False):
             h5file.create_dataset(mykey, data=result[mykey], chunks=True)
 
 
-def collect_data(nb_threads, params, erase=False, with_real_amps=False, with_voltages=False, benchmark=False):
+def group_by_index(indices, nb_groups):
+    """
+    Group elements by index with a single stable sort, instead of one scan per index. Returns the permutation
+    putting the elements in index order (keeping their order within each group), and the bounds of the groups, such
+    that the elements of group i are order[bounds[i]:bounds[i + 1]].
+    """
+    order = numpy.argsort(indices, kind='mergesort')
+    counts = numpy.bincount(indices, minlength=nb_groups)
+    return order, numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64)
+
+
+def collect_data(nb_threads, params, erase=False, with_real_amps=False, with_voltages=False, benchmark=False, nb_cpu=1):
 
     # Retrieve the key parameters.
     data_file = params.data_file
@@ -1443,74 +1525,38 @@ def collect_data(nb_threads, params, erase=False, with_real_amps=False, with_vol
     N_tm = len(templates)
     collect_all = params.getboolean('fitting', 'collect_all')
     debug = params.getboolean('fitting', 'debug')
+    # Ground truth files of the benchmarks are always read per template.
+    columnar = params.get('fitting', 'result_layout').lower() == 'columnar' and not benchmark
 
     print_and_log(["Gathering spikes from %d nodes..." % nb_threads], 'default', logger)
 
-    # Initialize data collection.
-    result = {
-        'spiketimes': {},
-        'amplitudes': {},
-        'info': {
-            'duration': numpy.array([duration], dtype=numpy.uint64)
-        }
-    }
-    if with_real_amps:
-        result['real_amps'] = {}
-    if with_voltages:
-        result['voltages'] = {}
-    if collect_all:
-        result['gspikes'] = {}
-        result['gtemps'] = {}
+    debug_fields = [
+        ('chunk_nbs', '.chunk_nbs_debug_%d.data', numpy.uint32),
+        ('iteration_nbs', '.iteration_nbs_debug_%d.data', numpy.uint32),
+        ('peak_nbs', '.peak_nbs_debug_%d.data', numpy.uint32),
+        ('peak_local_time_steps', '.peak_local_time_steps_debug_%d.data', numpy.uint32),
+        ('peak_time_steps', '.peak_time_steps_debug_%d.data', numpy.uint32),
+        ('peak_scalar_products', '.peak_scalar_products_debug_%d.data', numpy.float32),
+        ('peak_solved_flags', '.peak_solved_flags_debug_%d.data', numpy.float32),
+        ('template_nbs', '.template_nbs_debug_%d.data', numpy.uint32),
+        ('success_flags', '.success_flags_debug_%d.data', numpy.bool),
+    ]
 
-    for i in range(N_tm // 2):
-        result['spiketimes']['temp_' + str(i)] = [numpy.empty(shape=0, dtype=numpy.uint32)]
-        result['amplitudes']['temp_' + str(i)] = [numpy.empty(shape=(0, 2), dtype=numpy.float32)]
+    def load_node(node):
+        # Read the spikes of one node, grouped by template (and by electrode for the garbage) with a single stable
+        # sort, so that they keep their order within each group.
+        local_data = {
+            'spiketimes': numpy.empty(shape=0, dtype=numpy.uint32),
+            'amplitudes': numpy.empty(shape=(0, 2), dtype=numpy.float32),
+            'templates': numpy.zeros(N_tm // 2 + 1, dtype=numpy.int64)
+        }
         if with_real_amps:
-            result['real_amps']['temp_' + str(i)] = [numpy.empty(shape=0, dtype=numpy.float32)]
+            local_data['real_amps'] = numpy.empty(shape=0, dtype=numpy.float32)
         if with_voltages:
-            result['voltages']['temp_' + str(i)] = [numpy.empty(shape=0, dtype=numpy.float32)]
-
-    if collect_all:
-        for i in range(N_e):
-            result['gspikes']['elec_' + str(i)] = [numpy.empty(shape=0, dtype=numpy.uint32)]
-
-    if debug:
-        result_debug = {
-            'chunk_nbs': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'iteration_nbs': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'peak_nbs': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'peak_local_time_steps': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'peak_time_steps': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'peak_scalar_products': [numpy.empty(shape=0, dtype=numpy.float32)],
-            'peak_solved_flags': [numpy.empty(shape=0, dtype=numpy.float32)],
-            'template_nbs': [numpy.empty(shape=0, dtype=numpy.uint32)],
-            'success_flags': [numpy.empty(shape=0, dtype=numpy.bool)],
-        }
-    else:
-        result_debug = None
-
-    to_explore = range(nb_threads)
-
-    if comm.rank == 0:
-        to_explore = get_tqdm_progressbar(to_explore)
-
-    # For each thread/process collect data.
-    for count, node in enumerate(to_explore):
+            local_data['voltages'] = numpy.empty(shape=0, dtype=numpy.float32)
         spiketimes_file = file_out_suff + '.spiketimes-%d.data' % node
         amplitudes_file = file_out_suff + '.amplitudes-%d.data' % node
         templates_file = file_out_suff + '.templates-%d.data' % node
-        if with_real_amps:
-            real_amps_file = file_out_suff + '.real_amps-%d.data' % node
-            real_amps = numpy.fromfile(real_amps_file, dtype=numpy.float32)
-        if with_voltages:
-            voltages_file = file_out_suff + '.voltages-%d.data' % node
-            voltages = numpy.fromfile(voltages_file, dtype=numpy.float32)
-
-        if collect_all:
-            gspikes_file = file_out_suff + '.gspiketimes-%d.data' % node
-            gspikes = numpy.fromfile(gspikes_file, dtype=numpy.uint32)
-            gtemps_file = file_out_suff + '.gtemplates-%d.data' % node
-            gtemps = numpy.fromfile(gtemps_file, dtype=numpy.uint32)
 
         if os.path.exists(amplitudes_file):
 
@@ -1520,127 +1566,142 @@ def collect_data(nb_threads, params, erase=False, with_real_amps=False, with_vol
             N = len(amplitudes)
             amplitudes = amplitudes.reshape(N // 2, 2)
             min_size = min([amplitudes.shape[0], spiketimes.shape[0], templates.shape[0]])
-            amplitudes = amplitudes[:min_size]
-            spiketimes = spiketimes[:min_size]
-            templates = templates[:min_size]
+
+            order, local_data['templates'] = group_by_index(templates[:min_size], N_tm // 2)
+            local_data['spiketimes'] = spiketimes[order]
+            local_data['amplitudes'] = amplitudes[order]
             if with_real_amps:
-                real_amps = real_amps[:min_size]
+                real_amps = numpy.fromfile(file_out_suff + '.real_amps-%d.data' % node, dtype=numpy.float32)
+                local_data['real_amps'] = real_amps[order]
             if with_voltages:
-                voltages = voltages[:min_size]
-
-            local_temp = numpy.unique(templates)
-
-            for j in local_temp:
-                idx = numpy.where(templates == j)[0]
-                result['amplitudes']['temp_' + str(j)].append(amplitudes[idx])
-                result['spiketimes']['temp_' + str(j)].append(spiketimes[idx])
-                if with_real_amps:
-                    result['real_amps']['temp_' + str(j)].append(real_amps[idx])
-                if with_voltages:
-                    result['voltages']['temp_' + str(j)].append(voltages[idx])
+                voltages = numpy.fromfile(file_out_suff + '.voltages-%d.data' % node, dtype=numpy.float32)
+                local_data['voltages'] = voltages[order]
 
             if collect_all:
-                for j in range(N_e):
-                    idx = numpy.where(gtemps == j)[0]
-                    result['gspikes']['elec_' + str(j)].append(gspikes[idx])
+                gspikes = numpy.fromfile(file_out_suff + '.gspiketimes-%d.data' % node, dtype=numpy.uint32)
+                gtemps = numpy.fromfile(file_out_suff + '.gtemplates-%d.data' % node, dtype=numpy.uint32)
+                order, local_data['gtemps'] = group_by_index(gtemps, N_e)
+                local_data['gspikes'] = gspikes[order]
 
         if debug:
-            for (key, filename_formatter, dtype) in [
-                ('chunk_nbs', '.chunk_nbs_debug_%d.data', numpy.uint32),
-                ('iteration_nbs', '.iteration_nbs_debug_%d.data', numpy.uint32),
-                ('peak_nbs', '.peak_nbs_debug_%d.data', numpy.uint32),
-                ('peak_local_time_steps', '.peak_local_time_steps_debug_%d.data', numpy.uint32),
-                ('peak_time_steps', '.peak_time_steps_debug_%d.data', numpy.uint32),
-                ('peak_scalar_products', '.peak_scalar_products_debug_%d.data', numpy.float32),
-                ('peak_solved_flags', '.peak_solved_flags_debug_%d.data', numpy.float32),
-                ('template_nbs', '.template_nbs_debug_%d.data', numpy.uint32),
-                ('success_flags', '.success_flags_debug_%d.data', numpy.bool),
-            ]:
+            for (key, filename_formatter, dtype) in debug_fields:
                 filename = file_out_suff + filename_formatter % node
-                data = numpy.fromfile(filename, dtype=dtype)
-                result_debug[key].append(data)
-                # TODO avoid multiple concatenations (i.e. copies)?
+                local_data[key] = numpy.fromfile(filename, dtype=dtype)
 
-    sys.stderr.flush()
+        return local_data
 
-    for key in result['spiketimes']:
-        result['spiketimes'][key] = numpy.concatenate(result['spiketimes'][key]).astype(numpy.uint32)
-        result['amplitudes'][key] = numpy.concatenate(result['amplitudes'][key]).astype(numpy.float32)
+    # Nodes are read and grouped by a pool of threads (the sorts and the reads release the GIL), in order to keep
+    # a single copy of the spikes in memory, since they are then written template by template.
+    if nb_cpu > 1:
+        pool = ThreadPool(min(nb_cpu, nb_threads))
+        nodes = pool.imap(load_node, range(nb_threads))
+    else:
+        pool = None
+        nodes = map(load_node, range(nb_threads))
 
-        idx = numpy.argsort(result['spiketimes'][key])
-        result['spiketimes'][key] = result['spiketimes'][key][idx]
-        result['amplitudes'][key] = result['amplitudes'][key][idx]
-        if with_real_amps:
-            result['real_amps'][key] = numpy.concatenate(result['real_amps'][key]).astype(numpy.float32)
-            result['real_amps'][key] = result['real_amps'][key][idx]
-        if with_voltages:
-            result['voltages'][key] = numpy.concatenate(result['voltages'][key]).astype(numpy.float32)
-            result['voltages'][key] = result['voltages'][key][idx]
+    if comm.rank == 0:
+        nodes = get_tqdm_progressbar(nodes)
 
-        if refractory > 0:
-            violations = numpy.where(numpy.diff(result['spiketimes'][key]) <= refractory)[0] + 1
-            result['spiketimes'][key] = numpy.delete(result['spiketimes'][key], violations)
-            result['amplitudes'][key] = numpy.delete(result['amplitudes'][key], violations, axis=0)
-            if with_real_amps:
-                result['real_amps'][key] = numpy.delete(result['real_amps'][key], violations)
-            if with_voltages:
-                result['voltages'][key] = numpy.delete(result['voltages'][key], violations)
+    nodes = list(nodes)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    if collect_all:
-        for key in result['gspikes']:
-            result['gspikes'][key] = numpy.concatenate(result['gspikes'][key]).astype(numpy.uint32)
-            idx = numpy.argsort(result['gspikes'][key])
-            result['gspikes'][key] = result['gspikes'][key][idx]
+    sys.stderr.flush()
 
-    keys = ['spiketimes', 'amplitudes', 'info']
+    if debug:
+        result_debug = {}
+        for (key, filename_formatter, dtype) in debug_fields:
+            result_debug[key] = numpy.concatenate([numpy.empty(shape=0, dtype=dtype)] + [node[key] for node in nodes])
+    else:
+        result_debug = None
+
+    keys = ['spiketimes', 'amplitudes']
     if with_real_amps:
         keys += ['real_amps']
     if with_voltages:
         keys += ['voltages']
-    if collect_all:
-        keys += ['gspikes']
 
-    # Save results into `<dataset>/<dataset>.result.hdf5`.
+    # Save results into `<dataset>/<dataset>.result.hdf5`, as soon as the spikes of a template are merged.
     mydata = h5py.File(file_out_suff + '.result.hdf5', mode='w', libver='earliest')
-    for key in keys:
-        mydata.create_group(key)
-        for temp in result[key].keys():
-            tmp_path = '%s/%s' % (key, temp)
-            if hdf5_compress:
-                mydata.create_dataset(tmp_path, data=result[key][temp], compression='gzip')
-            else:
-                mydata.create_dataset(tmp_path, data=result[key][temp])
+    if hdf5_compress:
+        compression = 'gzip'
+    else:
+        compression = None
+
+    mydata.create_dataset('info/duration', data=numpy.array([duration], dtype=numpy.uint64), compression=compression)
+    if columnar:
+        # Only the spike times, grouped by template, are kept in memory to build the index of the columns. The other
+        # values are written template by template in a temporary file, and then sorted by time one column at a time.
+        nb_spikes = sum([len(node['spiketimes']) for node in nodes])
+        grouped_times = numpy.empty(nb_spikes, dtype=numpy.uint32)
+        counts = numpy.zeros(N_tm // 2, dtype=numpy.int64)
+        grouped_file = h5py.File(file_out_suff + '.result-grouped.hdf5', mode='w', libver='earliest')
+        grouped = {}
+        for name in keys[1:]:
+            shape = (nb_spikes,) + nodes[0][name].shape[1:]
+            grouped[name] = grouped_file.create_dataset(name, shape=shape, dtype=numpy.float32)
+    dtypes = dict([(key, numpy.float32) for key in keys])
+    dtypes['spiketimes'] = numpy.uint32
+
+    count = 0
+    for i in range(N_tm // 2):
+        key = 'temp_' + str(i)
+        local_result = {}
+        for name in keys:
+            local_result[name] = [node[name][node['templates'][i]:node['templates'][i + 1]] for node in nodes]
+            local_result[name] = numpy.concatenate(local_result[name]).astype(dtypes[name])
+
+        idx = numpy.argsort(local_result['spiketimes'])
+        for name in keys:
+            local_result[name] = local_result[name][idx]
+
+        if refractory > 0:
+            violations = numpy.where(numpy.diff(local_result['spiketimes']) <= refractory)[0] + 1
+            for name in keys:
+                local_result[name] = numpy.delete(local_result[name], violations, axis=0)
+
+        nb_local = len(local_result['spiketimes'])
+        if not columnar:
+            for name in keys:
+                mydata.create_dataset('%s/%s' % (name, key), data=local_result[name], compression=compression)
+        elif nb_local > 0:
+            grouped_times[count:count + nb_local] = local_result['spiketimes']
+            for name in keys[1:]:
+                grouped[name][count:count + nb_local] = local_result[name]
+            counts[i] = nb_local
+        count += nb_local
+
+    # The spikes of the nodes are no longer needed (the garbage is kept for collect_all).
+    for node in nodes:
+        for name in keys + ['templates']:
+            node.pop(name, None)
+
+    # The columnar layout replaces the datasets per template (see get_columnar_results for the format of the columns).
+    if columnar:
+        save_columnar_results(mydata, grouped_times[:count], counts, grouped, hdf5_compress=hdf5_compress)
+        grouped_file.close()
+        os.remove(file_out_suff + '.result-grouped.hdf5')
+        del grouped_times
+
+    if collect_all:
+        gcount = 0
+        for i in range(N_e):
+            gspikes = [node['gspikes'][node['gtemps'][i]:node['gtemps'][i + 1]] for node in nodes if 'gspikes' in node]
+            gspikes = numpy.concatenate([numpy.empty(shape=0, dtype=numpy.uint32)] + gspikes).astype(numpy.uint32)
+            gspikes = gspikes[numpy.argsort(gspikes)]
+            gcount += len(gspikes)
+            mydata.create_dataset('gspikes/elec_%d' % i, data=gspikes, compression=compression)
     mydata.close()
+    del nodes
 
     if debug:
         # Save debug data to debug HDF5 files.
         file = h5py.File(file_out_suff + '.result_debug.hdf5', mode='w', libver='earliest')
-        names = [
-            'chunk_nbs',
-            'iteration_nbs',
-            'peak_nbs',
-            'peak_local_time_steps',
-            'peak_time_steps',
-            'peak_scalar_products',
-            'peak_solved_flags',
-            'template_nbs',
-            'success_flags',
-        ]
-        for name in names:
-            data = numpy.concatenate(result_debug[name])
-            compression = 'gzip' if hdf5_compress else None
-            file.create_dataset(name, data=data, compression=compression)
+        for (name, filename_formatter, dtype) in debug_fields:
+            file.create_dataset(name, data=result_debug[name], compression=compression)
         file.close()
 
-    # Count the number of spikes.
-    count = 0
-    for item in result['spiketimes'].keys():
-        count += len(result['spiketimes'][item])
-    if collect_all:
-        gcount = 0
-        for item in result['gspikes'].keys():
-            gcount += len(result['gspikes'][item])
-
     # Print log message.
     if benchmark:
         to_print = "injected"
@@ -1775,10 +1836,144 @@ def collect_mua(nb_threads, params, erase=False):
         purge(file_out_suff, '.data')
 
 
+COLUMNAR_KEYS = ['amplitudes', 'real_amps', 'voltages']
+
+
+def get_columnar_index(grouped_times, counts):
+    """
+    Index of a columnar result (see get_columnar_results), from the spike times grouped by template, with counts[i]
+    spikes for template i, sorted by time. Returns the columns spike_times, spike_templates, template_offsets and
+    template_order, and the order of the grouped spikes by time, to sort the other columns.
+    """
+    nb_templates = len(counts)
+    # A stable sort keeps spikes occurring at the same time in template order.
+    order = numpy.argsort(grouped_times, kind='mergesort')
+    columns = {
+        'spike_times': grouped_times[order].astype(numpy.uint32),
+        'spike_templates': numpy.repeat(numpy.arange(nb_templates, dtype=numpy.uint32), counts)[order],
+        'template_offsets': numpy.concatenate(([0], numpy.cumsum(counts))).astype(numpy.int64),
+    }
+
+    # The spikes are grouped by template and sorted by time within each template, so their positions in the time
+    # sorted arrays (the inverse of order) list the spikes of each template in time order.
+    columns['template_order'] = numpy.empty(len(order), dtype=numpy.int64)
+    columns['template_order'][order] = numpy.arange(len(order))
+    return columns, order
+
+
+def get_columnar_results(result, nb_templates, keys=('amplitudes',)):
+    """
+    Flatten per template results (dictionaries of 'temp_%d' arrays, as gathered by collect_data) into single arrays
+    spike_times, spike_templates and keys, all sorted by time. The spikes of template i, sorted by time, are then
+    template_order[template_offsets[i]:template_offsets[i + 1]] (see get_template_spikes).
+
+    With result_layout = columnar, these columns are saved at the root of the result file:
+    - spike_times (uint32, n_spikes) and spike_templates (uint32, n_spikes), sorted by time, and then by template;
+    - amplitudes (float32, n_spikes x 2), and real_amps and voltages (float32, n_spikes) if collected, in that order;
+    - template_offsets (int64, nb_templates + 1) and template_order (int64, n_spikes), the per-template index.
+    They replace the spiketimes/temp_%d and amplitudes/temp_%d datasets of the default layout (result_layout =
+    groups): get_results splits the columns by template, but the MATLAB GUI can only read the default layout.
+    """
+    names = ['temp_' + str(i) for i in range(nb_templates)]
+    counts = numpy.array([len(result['spiketimes'][name]) for name in names], dtype=numpy.int64)
+    grouped_times = numpy.concatenate([numpy.empty(0, dtype=numpy.uint32)] + [result['spiketimes'][name] for name in names])
+    columns, order = get_columnar_index(grouped_times, counts)
+    for key in keys:
+        data = numpy.concatenate([result[key][name] for name in names])
+        columns[key] = data[order].astype(numpy.float32)
+    return columns
+
+
+def save_columnar_results(mydata, grouped_times, counts, grouped, hdf5_compress=False):
+    """
+    Save the columns of a columnar result (see get_columnar_results) into the opened result file mydata, from the
+    spike times grouped by template (counts[i] spikes for template i, sorted by time) and grouped, a dictionary of
+    the other values (arrays or HDF5 datasets with at least as many rows), grouped in the same way. Only the index
+    and one column are in memory at once.
+    """
+    def create_dataset(key, data):
+        if hdf5_compress and len(data) > 0:
+            mydata.create_dataset(key, data=data, chunks=True, compression='gzip')
+        else:
+            mydata.create_dataset(key, data=data)
+
+    columns, order = get_columnar_index(grouped_times, counts)
+    for key, data in columns.items():
+        create_dataset(key, data)
+    del columns
+
+    for key, values in grouped.items():
+        data = numpy.asarray(values[:len(order)], dtype=numpy.float32)
+        create_dataset(key, data[order])
+        del data
+
+
+def get_template_spikes(columns, template):
+    """
+    Indices, in the time sorted columns of a columnar result, of the spikes of a given template.
+    """
+    start, stop = columns['template_offsets'][template], columns['template_offsets'][template + 1]
+    return columns['template_order'][start:stop]
+
+
+def search_sorted(values, value):
+    """
+    Leftmost insertion point of value in sorted values, which can also be an HDF5 dataset: only the O(log n)
+    elements visited by the bisection are then read.
+    """
+    if isinstance(values, numpy.ndarray):
+        return int(numpy.searchsorted(values, value))
+    low, high = 0, len(values)
+    while low < high:
+        middle = (low + high) // 2
+        if values[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def get_time_window(spike_times, t_start, t_stop):
+    """
+    Slice of the time sorted spikes of a columnar result occurring in [t_start, t_stop).
+    """
+    return slice(search_sorted(spike_times, t_start), search_sorted(spike_times, t_stop))
+
+
+def get_results_window(params, t_start, t_stop, extension=''):
+    """
+    Spike times, templates and amplitudes of a columnar result between t_start and t_stop (in time steps), without
+    reading the whole file.
+    """
+    file_out_suff = params.get('data', 'file_out_suff')
+    result = {}
+    myfile = h5py.File(file_out_suff + '.result%s.hdf5' % extension, 'r', libver='earliest')
+    if 'spike_times' not in myfile:
+        myfile.close()
+        raise Exception('Time windows can only be read from columnar results (result_layout = columnar)')
+    window = get_time_window(myfile['spike_times'], t_start, t_stop)
+    for key in ['spike_times', 'spike_templates'] + COLUMNAR_KEYS:
+        if key in myfile:
+            result[key] = myfile[key][window]
+    myfile.close()
+    return result
+
+
 def get_results(params, extension=''):
     file_out_suff = params.get('data', 'file_out_suff')
     result = {}
     myfile = h5py.File(file_out_suff + '.result%s.hdf5' % extension, 'r', libver='earliest')
+    if 'spike_times' in myfile:
+        # Columnar layout: spikes are gathered by template once, and then split with the offsets.
+        template_order = myfile['template_order'][:]
+        offsets = myfile['template_offsets'][:]
+        for key, column in [('spiketimes', 'spike_times'), ('amplitudes', 'amplitudes')]:
+            data = myfile[column][:][template_order]
+            result[key] = {}
+            for i in range(len(offsets) - 1):
+                result[key]['temp_' + str(i)] = data[offsets[i]:offsets[i + 1]]
+        myfile.close()
+        return result
     for key in ['spiketimes', 'amplitudes']:
         result[str(key)] = {}
         for temp in myfile.get(key).keys():
@@ -1823,6 +2018,350 @@ def get_garbage(params, extension=''):
     return result
 
 
+def sort_overlaps(over_x, over_y, over_data):
+    """
+    Sort the overlaps by rows (pairs of templates) and then by lags, unless they already are (files written by
+    get_overlaps are sorted). Overlaps of consecutive rows are then contiguous, and can be found with
+    get_overlaps_range in logarithmic time, instead of scanning all the overlaps.
+    """
+    if len(over_x) > 1 and (numpy.any(over_x[1:] < over_x[:-1]) or numpy.any((over_x[1:] == over_x[:-1]) & (over_y[1:] < over_y[:-1]))):
+        order = numpy.lexsort((over_y, over_x))
+        return over_x[order], over_y[order], over_data[order]
+    return over_x, over_y, over_data
+
+
+def get_overlaps_range(over_x, start, stop):
+    """
+    Returns the slice of the sorted overlaps (see sort_overlaps) whose rows are in [start, stop).
+    """
+    # The bounds must have the dtype of over_x, otherwise the whole array would be converted.
+    bounds = numpy.searchsorted(over_x, numpy.array([start, stop], dtype=over_x.dtype))
+    return slice(bounds[0], bounds[1])
+
+
+def get_overlaps_csr(over_x, over_y, over_data, start, nb_rows, nb_lags):
+    """
+    Returns, for sorted overlaps, the rows [start, start + nb_rows) of the overlaps as a CSR matrix of shape
+    (nb_rows, nb_lags). The CSR structure is directly sliced from the sorted arrays, in a single pass.
+    """
+    rows = get_overlaps_range(over_x, start, start + nb_rows)
+    indptr = numpy.searchsorted(over_x[rows], (start + numpy.arange(nb_rows + 1)).astype(over_x.dtype))
+    return scipy.sparse.csr_matrix(
+        (over_data[rows], over_y[rows].astype(numpy.int32), indptr.astype(numpy.int32)), shape=(nb_rows, nb_lags)
+    )
+
+
+def get_templates_supports(templates, N_t):
+    """
+    Returns the supports of the templates (i.e. the channels where they are not null), as a boolean CSR matrix of
+    shape (nb_templates, N_e).
+    """
+    templates = templates.tocoo()
+    supports = scipy.sparse.csr_matrix(
+        (numpy.ones(templates.nnz, dtype=bool), (templates.col, templates.row // N_t)),
+        shape=(templates.shape[1], templates.shape[0] // N_t)
+    )
+    supports.sum_duplicates()
+    return supports
+
+
+def get_banded_overlaps(templates, supports, local_idx, to_consider, N_t, N_tm, lags=None, block_size=64):
+    """
+    Returns the overlaps (over_x, over_y, over_data, in the format of get_overlaps) of the local templates with
+    the templates to consider, for all the lags at once.
+
+    The local templates are shifted by every lag, giving a banded matrix whose single sparse product with the
+    templates to consider is the overlaps. This is done by blocks of local templates, only with the templates
+    whose supports intersect the ones of the block.
+
+    Arguments:
+        templates
+            Sparse matrix (N_e * N_t, nb_templates).
+        supports
+            Supports of the templates, given by get_templates_supports.
+        local_idx, to_consider
+            Indices of the local templates, and of the templates to consider.
+        N_t
+        N_tm
+            Number of templates used to compute the indices over_x.
+        lags
+            Lags to compute (all the 2 * N_t - 1 lags by default).
+        block_size
+            Number of local templates per block.
+    """
+    duration = 2 * N_t - 1
+    if lags is None:
+        lags = numpy.arange(duration)
+    lags = numpy.asarray(lags, dtype=numpy.int64)
+    nb_lags = len(lags)
+    to_consider = numpy.asarray(to_consider)
+    over_x = [numpy.zeros(0, dtype=numpy.uint32)]
+    over_y = [numpy.zeros(0, dtype=numpy.uint32)]
+    over_data = [numpy.zeros(0, dtype=numpy.float32)]
+
+    for start in range(0, len(local_idx), block_size):
+        block_idx = local_idx[start:start + block_size]
+
+        channels = numpy.unique(supports[block_idx].indices)
+        is_intersecting = supports[to_consider][:, channels].getnnz(axis=1) > 0
+        candidates = to_consider[is_intersecting]
+        if len(candidates) == 0:
+            continue
+
+        # Row k * nb_lags + l of the band is the local template k shifted by N_t - 1 - lags[l] time steps.
+        loc_templates = templates[:, block_idx].tocoo()
+        times = (loc_templates.row % N_t)[:, numpy.newaxis] + (N_t - 1 - lags)[numpy.newaxis, :]
+        is_valid = (times >= 0) & (times < N_t)
+        band_rows = loc_templates.col[:, numpy.newaxis] * nb_lags + numpy.arange(nb_lags)[numpy.newaxis, :]
+        band_cols = (loc_templates.row - loc_templates.row % N_t)[:, numpy.newaxis] + times
+        band_data = numpy.broadcast_to(loc_templates.data[:, numpy.newaxis], times.shape)
+        band = scipy.sparse.csr_matrix(
+            (band_data[is_valid], (band_rows[is_valid], band_cols[is_valid])),
+            shape=(len(block_idx) * nb_lags, templates.shape[0])
+        )
+
+        data = band.dot(templates[:, candidates].tocsr()).tocoo()
+        is_nonzero = data.data != 0
+        dx = numpy.take(block_idx, data.row[is_nonzero] // nb_lags).astype(numpy.uint32)
+        dy = numpy.take(candidates, data.col[is_nonzero]).astype(numpy.uint32)
+        over_x.append(dx * numpy.uint32(N_tm) + dy)
+        over_y.append(lags[data.row[is_nonzero] % nb_lags].astype(numpy.uint32))
+        over_data.append(data.data[is_nonzero])
+
+    return numpy.concatenate(over_x), numpy.concatenate(over_y), numpy.concatenate(over_data)
+
+
+def get_template_overlaps(templates, supports, index, N_t):
+    """
+    Returns the overlaps of a template with all the templates, as the CSR matrix (nb_templates, 2 * N_t - 1) of
+    load_data(params, 'overlaps'), computed from the sparse templates (N_e * N_t, nb_templates) and their supports
+    (see get_templates_supports).
+    """
+    nb_templates = templates.shape[1]
+    over_x, over_y, over_data = get_banded_overlaps(
+        templates, supports, numpy.array([index]), numpy.arange(nb_templates), N_t, nb_templates
+    )
+    return scipy.sparse.csr_matrix(
+        (over_data, (over_x % numpy.uint32(nb_templates), over_y)), shape=(nb_templates, 2 * N_t - 1)
+    )
+
+
+def get_overlaps_delays(N_t, decimation=False):
+    """
+    Returns the delays (in [1, N_t]) for which get_overlaps computes the overlaps. With decimation, only one delay
+    out of three is kept, except for the shortest and longest ones.
+    """
+    all_delays = numpy.arange(1, N_t + 1)
+    if decimation:
+        nb_delays = len(all_delays) // 10
+        indices = list(range(nb_delays)) + list(range(nb_delays, len(all_delays) - nb_delays, 3)) + list(range(len(all_delays) - nb_delays, len(all_delays)))
+        all_delays = all_delays[indices]
+    return all_delays
+
+
+def get_overlaps_lags_subset(N_t, decimation=False):
+    """
+    Returns the lags (in [0, 2 * N_t - 1)) of the overlaps computed by get_overlaps.
+    """
+    all_delays = get_overlaps_delays(N_t, decimation)
+    return numpy.unique(numpy.concatenate((all_delays - 1, 2 * N_t - 1 - all_delays[all_delays < N_t])))
+
+
+def get_templates_checksums(templates):
+    """
+    Returns a checksum for each template (column of the sparse matrix), used to match templates across files.
+    """
+    templates = templates.tocsc()
+    checksums = numpy.zeros(templates.shape[1], dtype=numpy.uint64)
+    for idx in range(templates.shape[1]):
+        indices = templates.indices[templates.indptr[idx]:templates.indptr[idx+1]]
+        data = templates.data[templates.indptr[idx]:templates.indptr[idx+1]]
+        order = numpy.argsort(indices)
+        digest = hashlib.md5(indices[order].astype(numpy.int64).tobytes() + data[order].astype(numpy.float32).tobytes())
+        checksums[idx] = numpy.frombuffer(digest.digest()[:8], dtype=numpy.uint64)[0]
+    return checksums
+
+
+def get_templates_mapping(old_checksums, new_checksums):
+    """
+    Returns, for each new template, the index of the old template with the same checksum, or -1 if there is none
+    (i.e. the template is new or has been modified). An old template is matched at most once.
+    """
+    old_indices = {}
+    for idx, checksum in enumerate(old_checksums):
+        old_indices.setdefault(checksum, idx)
+    mapping = -numpy.ones(len(new_checksums), dtype=numpy.int64)
+    for idx, checksum in enumerate(new_checksums):
+        if checksum in old_indices:
+            mapping[idx] = old_indices.pop(checksum)
+    return mapping
+
+
+def update_overlaps(over_x, over_y, over_data, over_shape, templates, mapping, N_t, lags=None, nb_threads=1):
+    """
+    Updates sorted overlaps (in the format of get_overlaps) after templates have been removed, modified or added.
+
+    Arguments:
+        over_x, over_y, over_data, over_shape
+            The overlaps of the old templates.
+        templates
+            Sparse matrix (N_e * N_t, nb_templates) of the new templates.
+        mapping
+            For each new template, the index of the old one if their overlaps can be kept, -1 otherwise (see
+            get_templates_mapping). The other old templates are dropped.
+        N_t
+        lags
+            Lags of the overlaps (all the 2 * N_t - 1 lags by default, see get_overlaps_lags_subset).
+        nb_threads
+            Number of threads computing the overlaps of the new templates.
+
+    Returns the overlaps of the new templates. Only the ones of the new or modified templates are computed.
+    """
+    N_old = numpy.uint32(numpy.sqrt(over_shape[0]))
+    N_new = len(mapping)
+    duration = over_shape[1]
+    is_kept = mapping >= 0
+
+    # Overlaps between kept templates are renumbered.
+    inverse = -numpy.ones(N_old, dtype=numpy.int64)
+    inverse[mapping[is_kept]] = numpy.where(is_kept)[0]
+    rows = inverse[over_x // N_old]
+    columns = inverse[over_x % N_old]
+    is_valid = (rows >= 0) & (columns >= 0)
+    over_x = (rows[is_valid] * N_new + columns[is_valid]).astype(numpy.uint32)
+    over_y = over_y[is_valid]
+    over_data = over_data[is_valid]
+
+    # Overlaps of the other templates are computed with all the templates, and mirrored.
+    changed = numpy.where(~is_kept)[0]
+    if len(changed) > 0:
+        supports = get_templates_supports(templates, N_t)
+        all_templates = numpy.arange(N_new)
+
+        def get_changed_overlaps(local_idx):
+            return get_banded_overlaps(templates, supports, local_idx, all_templates, N_t, N_new, lags)
+
+        chunks = numpy.array_split(changed, min(nb_threads, len(changed)))
+        if len(chunks) > 1:
+            pool = ThreadPool(len(chunks))
+            results = pool.map(get_changed_overlaps, chunks)
+            pool.close()
+            pool.join()
+        else:
+            results = [get_changed_overlaps(changed)]
+
+        new_x, new_y, new_data = [numpy.concatenate(arrays) for arrays in zip(*results)]
+        new_rows, new_columns = new_x // numpy.uint32(N_new), new_x % numpy.uint32(N_new)
+        is_mirrored = is_kept[new_columns]
+        new_x = numpy.concatenate((new_x, new_columns[is_mirrored] * numpy.uint32(N_new) + new_rows[is_mirrored]))
+        new_y = numpy.concatenate((new_y, (duration - 1 - new_y[is_mirrored]).astype(numpy.uint32)))
+        new_data = numpy.concatenate((new_data, new_data[is_mirrored]))
+        new_x, new_y, new_data = sort_overlaps(new_x, new_y, new_data)
+
+        if numpy.all(numpy.diff(mapping[is_kept]) > 0):
+            # Kept overlaps are still sorted, the new ones are inserted at their positions.
+            keys = over_x.astype(numpy.uint64) * numpy.uint64(duration) + over_y
+            new_keys = new_x.astype(numpy.uint64) * numpy.uint64(duration) + new_y
+            positions = numpy.searchsorted(keys, new_keys)
+            over_x = numpy.insert(over_x, positions, new_x)
+            over_y = numpy.insert(over_y, positions, new_y)
+            over_data = numpy.insert(over_data, positions, new_data)
+        else:
+            over_x, over_y, over_data = sort_overlaps(
+                numpy.concatenate((over_x, new_x)), numpy.concatenate((over_y, new_y)),
+                numpy.concatenate((over_data, new_data))
+            )
+
+    over_shape = numpy.array([N_new**2, duration], dtype=numpy.int32)
+
+    return over_x, over_y, over_data, over_shape
+
+
+def update_maxoverlap(maxoverlap, maxlag, mapping, over_x, over_y, over_data, N_tm, N_t, norms=None):
+    """
+    Updates maxoverlap and maxlag (as computed by get_overlaps) for the N_tm // 2 new templates.
+
+    Arguments:
+        maxoverlap, maxlag
+            The ones of the old templates.
+        mapping
+            For each new template, the index of the old one if they are the same, -1 otherwise.
+        over_x, over_y, over_data
+            Sorted overlaps of the N_tm new templates.
+        N_tm, N_t
+        norms
+            If given, the recomputed maxoverlap are divided by the norms of the templates.
+    """
+    N_half = N_tm // 2
+    duration = 2 * N_t - 1
+    if numpy.any(numpy.diff(mapping[mapping >= 0]) < 0):
+        # Lags depend on the order of the templates, thus all of them are computed if it changed.
+        mapping = -numpy.ones(N_half, dtype=numpy.int64)
+    new_maxoverlap = numpy.zeros((N_half, N_half), dtype=numpy.float32)
+    new_maxlag = numpy.zeros((N_half, N_half), dtype=numpy.int32)
+    kept = numpy.where(mapping >= 0)[0]
+    new_maxoverlap[numpy.ix_(kept, kept)] = maxoverlap[numpy.ix_(mapping[kept], mapping[kept])]
+    new_maxlag[numpy.ix_(kept, kept)] = maxlag[numpy.ix_(mapping[kept], mapping[kept])]
+
+    all_templates = numpy.arange(N_half)
+    for i in numpy.where(mapping < 0)[0]:
+        idx = get_overlaps_range(over_x, i*N_tm, i*N_tm+N_half)
+        data = numpy.zeros((N_half, duration), dtype=numpy.float32)
+        data[over_x[idx] - i*N_tm, over_y[idx]] = over_data[idx]
+        values = numpy.max(data, 1)
+        if norms is not None:
+            values /= norms
+            values /= norms[i]
+        values[i] = 0
+        new_maxoverlap[i] = values
+        new_maxoverlap[:, i] = values
+        # As in get_overlaps, lags are given by the overlaps of (i, j) for i < j, i.e. mirrored ones if j < i.
+        lags = numpy.where(all_templates > i, N_t - numpy.argmax(data, 1), -(N_t - numpy.argmax(data[:, ::-1], 1)))
+        lags[i] = 0
+        new_maxlag[i] = lags
+        new_maxlag[:, i] = -lags
+
+    return new_maxoverlap, new_maxlag
+
+
+def save_overlaps(filename, over_x, over_y, over_data, over_shape, checksums, hdf5_compress=True):
+    """
+    Writes sorted overlaps in filename, with the checksums of their templates (see get_templates_checksums).
+    """
+    hfile = h5py.File(filename, 'w', libver='earliest')
+    if hdf5_compress:
+        hfile.create_dataset('over_x', data=over_x, compression='gzip')
+        hfile.create_dataset('over_y', data=over_y, compression='gzip')
+        hfile.create_dataset('over_data', data=over_data, compression='gzip')
+    else:
+        hfile.create_dataset('over_x', data=over_x)
+        hfile.create_dataset('over_y', data=over_y)
+        hfile.create_dataset('over_data', data=over_data)
+    hfile.create_dataset('over_shape', data=over_shape)
+    hfile.create_dataset('checksums', data=checksums)
+    hfile.close()
+
+
+def save_maxoverlap(filename, maxoverlap, maxlag, hdf5_compress=True):
+    """
+    Writes maxoverlap and maxlag in the templates file filename.
+    """
+    myfile2 = h5py.File(filename, 'r+', libver='earliest')
+
+    for key in ['maxoverlap', 'maxlag', 'version']:
+        if key in myfile2.keys():
+            myfile2.pop(key)
+
+    myfile2.create_dataset('version', data=numpy.array(circus.__version__.split('.'), dtype=numpy.int32))
+    if hdf5_compress:
+        myfile2.create_dataset('maxlag',  data=maxlag, compression='gzip')
+        myfile2.create_dataset('maxoverlap', data=maxoverlap, compression='gzip')
+    else:
+        myfile2.create_dataset('maxlag',  data=maxlag)
+        myfile2.create_dataset('maxoverlap', data=maxoverlap)
+    myfile2.close()
+
+
 def get_overlaps(
         params, extension='', erase=False, normalize=True, maxoverlap=True,
         verbose=True, half=False, use_gpu=False, nb_cpu=1, nb_gpu=0, decimation=False
@@ -1838,6 +2377,8 @@ def get_overlaps(
     file_out_suff = params.get('data', 'file_out_suff')
     tmp_path = os.path.join(os.path.abspath(params.get('data', 'data_file_noext')), 'tmp')
     filename = file_out_suff + '.overlap%s.hdf5' % extension
+    overlaps_engine = params.get('data', 'overlaps_engine').lower()
+    nb_threads = params.getint('data', 'overlaps_threads')
     duration = 2 * N_t - 1
     n_scalar = N_e * N_t
 
@@ -1899,7 +2440,7 @@ def get_overlaps(
     if use_gpu:
         cuda_string = 'using %d GPU...' % comm.size
 
-    all_delays = numpy.arange(1, N_t + 1)
+    all_delays = get_overlaps_delays(N_t, decimation)
 
     if half:
         upper_bounds = N_tm
@@ -1907,11 +2448,13 @@ def get_overlaps(
         upper_bounds = N_tm // 2
 
     to_explore = range(comm.rank, N_e, comm.size)
+    use_supports = (overlaps_engine == 'supports') and not use_gpu
 
     if comm.rank == 0:
         if verbose:
             print_and_log(["Pre-computing the overlaps of templates %s" % cuda_string], 'default', logger)
-        to_explore = get_tqdm_progressbar(to_explore)
+        if not use_supports:
+            to_explore = get_tqdm_progressbar(to_explore)
 
     over_x = [numpy.zeros(0, dtype=numpy.uint32)]
     over_y = [numpy.zeros(0, dtype=numpy.uint32)]
@@ -1919,28 +2462,55 @@ def get_overlaps(
     rows = numpy.arange(N_e*N_t)
     _srows = {'left': {}, 'right': {}}
 
-    if decimation:
-        nb_delays = len(all_delays) // 10
-        indices = list(range(nb_delays)) + list(range(nb_delays, len(all_delays) - nb_delays, 3)) + list(range(len(all_delays) - nb_delays, len(all_delays)))
-        all_delays = all_delays[indices]
-
     for idelay in all_delays:
         _srows['left'][idelay] = numpy.where(rows % N_t < idelay)[0]
         _srows['right'][idelay] = numpy.where(rows % N_t >= (N_t - idelay))[0]
 
-    for ielec in to_explore:
-
+    def get_local_templates(ielec):
+        # Templates of an electrode, and templates to consider for their overlaps.
         local_idx = numpy.where(best_elec == ielec)[0]
-        len_local = len(local_idx)
-
+        to_consider = numpy.arange(upper_bounds)
         if not half:
             local_idx = numpy.concatenate((local_idx, local_idx + upper_bounds))
+            to_consider = numpy.concatenate((to_consider, to_consider + upper_bounds))
+        return local_idx, to_consider
+
+    if use_supports:
+        # All the lags of the overlaps of the templates of an electrode are computed at once, only with the
+        # templates whose supports intersect theirs, and electrodes are processed by several threads.
+        supports = get_templates_supports(templates, N_t)
+        lags = get_overlaps_lags_subset(N_t, decimation)
+
+        def get_electrode_overlaps(ielec):
+            local_idx, to_consider = get_local_templates(ielec)
+            return get_banded_overlaps(templates, supports, local_idx, to_consider, N_t, N_tm, lags)
+
+        if nb_threads > 1:
+            pool = ThreadPool(nb_threads)
+            results = pool.imap_unordered(get_electrode_overlaps, to_explore)
+        else:
+            pool = None
+            results = map(get_electrode_overlaps, to_explore)
+        if comm.rank == 0:
+            results = get_tqdm_progressbar(results, total=len(to_explore))
 
-        if len_local > 0:
+        for local_x, local_y, local_data in results:
+            over_x.append(local_x)
+            over_y.append(local_y)
+            over_data.append(local_data)
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+        to_explore = []  # i.e. nothing left for the loop over delays
+
+    for ielec in to_explore:
 
-            to_consider = numpy.arange(upper_bounds)
-            if not half:
-                to_consider = numpy.concatenate((to_consider, to_consider + upper_bounds))
+        local_idx, to_consider = get_local_templates(ielec)
+        len_local = len(local_idx)
+
+        if len_local > 0:
 
             loc_templates = templates[:, local_idx].tocsr()
             loc_templates2 = templates[:, to_consider].tocsr()
@@ -1986,17 +2556,9 @@ def get_overlaps(
     over_shape = numpy.array([N_tm**2, duration], dtype=numpy.int32)
 
     if comm.rank == 0:
-        hfile = h5py.File(filename, 'w', libver='earliest')
-        if hdf5_compress:
-            hfile.create_dataset('over_x', data=over_x, compression='gzip')
-            hfile.create_dataset('over_y', data=over_y, compression='gzip')
-            hfile.create_dataset('over_data', data=over_data, compression='gzip')
-        else:
-            hfile.create_dataset('over_x', data=over_x)
-            hfile.create_dataset('over_y', data=over_y)
-            hfile.create_dataset('over_data', data=over_data)
-        hfile.create_dataset('over_shape', data=over_shape)
-        hfile.close()
+        over_x, over_y, over_data = sort_overlaps(over_x, over_y, over_data)
+        checksums = get_templates_checksums(templates[:, :N_tm])
+        save_overlaps(filename, over_x, over_y, over_data, over_shape, checksums, hdf5_compress)
 
     comm.Barrier()
 
@@ -2023,7 +2585,7 @@ def get_overlaps(
 
         for i in to_explore:
 
-            idx = numpy.where((over_x >= i*N_tm+i+1) & (over_x < (i*N_tm+N_half)))[0]
+            idx = get_overlaps_range(over_x, i*N_tm+i+1, i*N_tm+N_half)
             local_x = over_x[idx] - (i*N_tm+i+1)
             data = numpy.zeros((N_half - (i + 1), duration), dtype=numpy.float32)
             data[local_x, over_y[idx]] = over_data[idx]
@@ -2048,25 +2610,180 @@ def get_overlaps(
         # sub_comm.Free()
 
         if comm.rank == 0:
-            myfile2 = h5py.File(file_out_suff + '.templates%s.hdf5' % extension, 'r+', libver='earliest')
-
-            for key in ['maxoverlap', 'maxlag', 'version']:
-                if key in myfile2.keys():
-                    myfile2.pop(key)
-
             if not normalize:
                 maxoverlap /= norm_templates[: N_half]
                 maxoverlap /= norm_templates[: N_half][:, numpy.newaxis]
+            save_maxoverlap(file_out_suff + '.templates%s.hdf5' % extension, maxoverlap, maxlag, hdf5_compress)
 
-            myfile2.create_dataset('version', data=numpy.array(circus.__version__.split('.'), dtype=numpy.int32))
-            if hdf5_compress:
-                myfile2.create_dataset('maxlag',  data=maxlag, compression='gzip')
-                myfile2.create_dataset('maxoverlap', data=maxoverlap, compression='gzip')
+    comm.Barrier()
+
+    return h5py.File(filename, 'r')
+
+
+def update_overlaps_file(
+        params, extension='', input_extension=None, normalize=True, maxoverlap=True,
+        verbose=True, half=False, use_gpu=False, nb_cpu=1, nb_gpu=0, decimation=False
+):
+    """
+    Updates the overlaps of an existing file for the current templates, and returns them as get_overlaps does.
+
+    The templates are matched with the ones of the file (the one of input_extension, by default extension) by their
+    checksums. The overlaps of the removed templates are dropped, and only the ones of the new or modified templates
+    are computed, as well as their maxoverlap and maxlag. If the file has no checksums, or if most of the templates
+    changed, the overlaps are computed from scratch by get_overlaps.
+    """
+
+    file_out_suff = params.get('data', 'file_out_suff')
+    N_t = params.getint('detection', 'N_t')
+    hdf5_compress = params.getboolean('data', 'hdf5_compress')
+    nb_threads = params.getint('data', 'overlaps_threads')
+    if input_extension is None:
+        input_extension = extension
+    filename = file_out_suff + '.overlap%s.hdf5' % extension
+    input_filename = file_out_suff + '.overlap%s.hdf5' % input_extension
+    templates_filename = file_out_suff + '.templates%s.hdf5' % extension
+
+    is_incremental = False
+    if comm.rank == 0 and os.path.exists(input_filename):
+        if maxoverlap:
+            templates = load_data(params, 'templates', extension=extension)
+        else:
+            templates = load_data(params, 'templates')
+        norm_templates = load_data(params, 'norm-templates')
+        if normalize:
+            for idx in range(templates.shape[1]):
+                myslice = numpy.arange(templates.indptr[idx], templates.indptr[idx+1])
+                templates.data[myslice] /= norm_templates[idx]
+        if half:
+            templates = templates[:, :templates.shape[1] // 2]
+
+        hfile = h5py.File(input_filename, 'r')
+        if 'checksums' in hfile:
+            mapping = get_templates_mapping(hfile.get('checksums')[:], get_templates_checksums(templates))
+            is_incremental = 2 * numpy.sum(mapping < 0) <= len(mapping)
+        hfile.close()
+
+    is_incremental = comm.bcast(is_incremental, root=0)
+
+    if not is_incremental:
+        return get_overlaps(
+            params, extension=extension, erase=True, normalize=normalize, maxoverlap=maxoverlap, verbose=verbose,
+            half=half, use_gpu=use_gpu, nb_cpu=nb_cpu, nb_gpu=nb_gpu, decimation=decimation
+        )
+
+    if comm.rank == 0:
+        if verbose:
+            print_and_log(["Updating the overlaps of %d templates..." % numpy.sum(mapping < 0)], 'default', logger)
+        over_x, over_y, over_data, over_shape = load_data(params, 'overlaps-raw', extension=input_extension)
+        N_old = int(numpy.sqrt(over_shape[0]))
+        lags = get_overlaps_lags_subset(N_t, decimation)
+        over_x, over_y, over_data, over_shape = update_overlaps(
+            over_x, over_y, over_data, over_shape, templates, mapping, N_t, lags=lags, nb_threads=nb_threads
+        )
+        save_overlaps(
+            filename, over_x, over_y, over_data, over_shape, get_templates_checksums(templates), hdf5_compress
+        )
+
+        if maxoverlap:
+            N_tm = templates.shape[1]
+            hfile = h5py.File(templates_filename, 'r', libver='earliest')
+            if 'maxoverlap' in hfile and 'maxlag' in hfile and hfile.get('maxoverlap').shape[0] == N_old // 2:
+                old_maxoverlap = hfile.get('maxoverlap')[:]
+                old_maxlag = hfile.get('maxlag')[:]
+                half_mapping = numpy.where(mapping[:N_tm // 2] < N_old // 2, mapping[:N_tm // 2], -1)
             else:
-                myfile2.create_dataset('maxlag',  data=maxlag)
-                myfile2.create_dataset('maxoverlap', data=maxoverlap)
-            myfile2.close()
+                # The maxoverlap of the file do not match the old overlaps, they are all computed.
+                old_maxoverlap = numpy.zeros((0, 0), dtype=numpy.float32)
+                old_maxlag = numpy.zeros((0, 0), dtype=numpy.int32)
+                half_mapping = -numpy.ones(N_tm // 2, dtype=numpy.int64)
+            hfile.close()
+            norms = None if normalize else norm_templates[:N_tm // 2]
+            new_maxoverlap, new_maxlag = update_maxoverlap(
+                old_maxoverlap, old_maxlag, half_mapping, over_x, over_y, over_data, N_tm, N_t, norms=norms
+            )
+            save_maxoverlap(templates_filename, new_maxoverlap, new_maxlag, hdf5_compress)
 
     comm.Barrier()
 
     return h5py.File(filename, 'r')
+
+
+def get_overlaps_lags(params, extension=''):
+    """Get the overlaps indexed by (template, lag), building them if needed.
+
+    For template i and lag l, the nonzero overlaps with all the other templates are stored contiguously,
+    between indptr[i * S_over + l] and indptr[i * S_over + l + 1], in the rows (template indices) and data
+    arrays. The arrays are memory mapped, thus shared by all the processes of a node.
+
+    Parameters
+    ----------
+    params : CircusParser
+    extension : string, optional
+
+    Returns
+    -------
+    over_lags : tuple
+        (indptr, rows, data, over_shape)
+
+    """
+
+    file_out_suff = params.get('data', 'file_out_suff')
+    filename = file_out_suff + '.overlap%s.hdf5' % extension
+    lags_filename = file_out_suff + '.overlap-lags%s.hdf5' % extension
+
+    if comm.rank == 0:
+        if not os.path.exists(lags_filename) or os.path.getmtime(lags_filename) < os.path.getmtime(filename):
+            print_and_log(["Indexing the overlaps by lags..."], 'debug', logger)
+            over_x, over_y, over_data, over_shape = load_data(params, 'overlaps-raw', extension=extension)
+            N_over = numpy.int64(numpy.sqrt(over_shape[0]))
+            S_over = numpy.int64(over_shape[1])
+            keys = (over_x // N_over) * S_over + over_y
+            rows = (over_x % N_over).astype(numpy.int32)
+            order = numpy.lexsort((rows, keys))
+            indptr = numpy.zeros(N_over * S_over + 1, dtype=numpy.int64)
+            numpy.cumsum(numpy.bincount(keys, minlength=N_over * S_over), out=indptr[1:])
+
+            hfile = h5py.File(lags_filename, 'w', libver='earliest')
+            hfile.create_dataset('indptr', data=indptr)
+            hfile.create_dataset('rows', data=rows[order])
+            hfile.create_dataset('data', data=over_data[order].astype(numpy.float32))
+            hfile.create_dataset('over_shape', data=over_shape)
+            hfile.close()
+
+    comm.Barrier()
+
+    return load_data(params, 'overlaps-lags', extension=extension)
+
+
+def get_overlaps_block(over_lags, template, lags):
+    """Get the nonzero overlaps of a template with all the others, for several lags.
+
+    Parameters
+    ----------
+    over_lags : tuple
+        The overlaps, as returned by get_overlaps_lags.
+    template : int
+        The index of the template.
+    lags : array_like
+        The lags of interest, in [0, S_over).
+
+    Returns
+    -------
+    rows : numpy.ndarray
+        The indices of the overlapping templates.
+    positions : numpy.ndarray
+        For each value, the position of its lag in lags.
+    values : numpy.ndarray
+        The overlaps.
+
+    """
+
+    indptr, rows, data, over_shape = over_lags
+    keys = template * numpy.int64(over_shape[1]) + lags
+    starts = indptr[keys]
+    counts = indptr[keys + 1] - starts
+    positions = numpy.repeat(numpy.arange(len(keys)), counts)
+    offsets = numpy.arange(len(positions)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    indices = starts[positions] + offsets
+
+    return rows[indices], positions, data[indices]
@@ -13,6 +13,7 @@ logger = logging.getLogger(__name__)
 
 MPI_VENDOR = MPI.get_vendor()
 SHARED_MEMORY = (hasattr(MPI.Win, 'Allocate_shared') and callable(getattr(MPI.Win, 'Allocate_shared')))
+DYNAMIC_SCHEDULING = (hasattr(MPI.Win, 'Allocate') and hasattr(MPI.Win, 'Fetch_and_op'))
 
 
 def test_mpi_ring(nb_nodes):
@@ -56,16 +57,10 @@ def get_local_ring(local_only=False):
     return sub_comm, is_local
 
 
-def detect_memory(params, whitening=False, filtering=False, fitting=False):
+def get_memory_per_rank(params):
     from psutil import virtual_memory
 
-    N_e  = params.getint('data', 'N_e')
     safety_threshold = params.getfloat('data', 'memory_usage')
-    data_file = params.data_file
-    data_file.open()
-    sampling_rate  = data_file.sampling_rate
-    duation = data_file.duration
-    data_file.close()
 
     from uuid import getnode as get_mac
     myip = numpy.int64(get_mac()) % 100000
@@ -83,7 +78,19 @@ def detect_memory(params, whitening=False, filtering=False, fitting=False):
     memory = all_gather_array(res, comm, 1, 'int64')
 
     idx = numpy.where(memory > 0)
-    max_memory = numpy.min(memory[idx]) // (4 * N_e)
+    return numpy.min(memory[idx])
+
+
+def detect_memory(params, whitening=False, filtering=False, fitting=False):
+
+    N_e  = params.getint('data', 'N_e')
+    data_file = params.data_file
+    data_file.open()
+    sampling_rate  = data_file.sampling_rate
+    duation = data_file.duration
+    data_file.close()
+
+    max_memory = get_memory_per_rank(params) // (4 * N_e)
 
     if whitening or filtering:
         max_size = int(30*data_file.sampling_rate)
@@ -100,6 +107,152 @@ def detect_memory(params, whitening=False, filtering=False, fitting=False):
     return chunk_size
 
 
+def calibrate_chunk_size(params, process_chunk, chunk_size, bytes_per_peak=0, nb_tests=2,
+                         factors=(0.25, 0.5, 1, 2, 4, 8, 16)):
+    """Pick the chunk size maximizing the number of samples processed per second and per rank.
+
+    Arguments:
+        params
+        process_chunk
+            Function process_chunk(gidx, chunk_size, nb_chunks) processing one chunk, and returning the number
+            of peaks found in it. Its results are discarded.
+        chunk_size
+            Reference chunk size (in samples), scaled by the factors to get the candidate sizes.
+        bytes_per_peak
+            Memory needed by each peak of a chunk (e.g. scalar products with all the templates). Candidates
+            that would need more memory than available, given the measured peak density, are discarded.
+        nb_tests
+            Number of chunks tested by each rank, for each candidate.
+    Returns:
+        chunk_size
+            The best candidate.
+    """
+
+    import time
+
+    N_e = params.getint('data', 'N_e')
+    data_file = params.data_file
+    sampling_rate = data_file.sampling_rate
+    max_memory = get_memory_per_rank(params)
+
+    peak_density = 0
+    best_size, best_throughput = chunk_size, 0
+    nb_misses = 0
+
+    for factor in factors:
+
+        size = int(factor * chunk_size)
+        nb_chunks, _ = data_file.analyze(size)
+        memory = size * (4 * N_e + peak_density * bytes_per_peak)
+
+        if nb_chunks < 3 or memory > max_memory:
+            break
+
+        # Chunks are tested uniformly across the recording, ignoring the first and the last ones.
+        all_tests = numpy.linspace(1, nb_chunks - 2, nb_tests * comm.size).astype(numpy.int64)
+        nb_peaks = 0
+        t_start = time.time()
+        for gidx in all_tests[comm.rank::comm.size]:
+            nb_peaks += process_chunk(gidx, size, nb_chunks)
+        elapsed = time.time() - t_start
+
+        local_stats = numpy.array([len(all_tests[comm.rank::comm.size]) * size, elapsed, nb_peaks], dtype=numpy.float64)
+        stats = all_gather_array(local_stats, comm, dtype='float64').reshape(comm.size, 3)
+        stats = stats[stats[:, 1] > 0]
+        throughput = numpy.mean(stats[:, 0] / stats[:, 1])
+        peak_density = numpy.sum(stats[:, 2]) / numpy.sum(stats[:, 0])
+
+        if comm.rank == 0:
+            lines = [
+                'Chunks of %g second: %d samples/s per rank, %g peaks/s' % (
+                    size / float(sampling_rate), throughput, peak_density * sampling_rate
+                )
+            ]
+            print_and_log(lines, 'debug', logger)
+
+        if throughput > best_throughput:
+            best_size, best_throughput = size, throughput
+            nb_misses = 0
+        else:
+            nb_misses += 1
+            if nb_misses == 2:
+                break
+
+    if comm.rank == 0:
+        lines = [
+            'Chunk size set to %g second by calibration' % (best_size / float(sampling_rate)),
+            'Measured throughput: %d samples/s per rank (%.3g x real time)' % (
+                best_throughput, best_throughput / float(sampling_rate)
+            ),
+        ]
+        print_and_log(lines, 'info', logger)
+
+    return best_size
+
+
+class ChunkScheduler(object):
+    """Hand out chunk indices to the ranks.
+
+    With dynamic scheduling, every rank fetches and increments a counter held by rank 0 in an MPI window
+    (one-sided atomic operations), such that fast ranks process more chunks than the ones stuck on dense
+    parts of the recording. Otherwise (or if the MPI library does not support it), chunks are strided
+    statically across the ranks, or split in contiguous blocks if contiguous (for stages carrying a state from
+    one chunk to the next). Which rank processes which chunk is thus not deterministic with dynamic
+    scheduling, and the per-rank outputs must not depend on it.
+
+    The scheduler must be iterated until the end by all the ranks, since the window is freed collectively.
+    """
+
+    def __init__(self, nb_chunks, dynamic=True, mpi_comm=comm, contiguous=False):
+
+        self.nb_chunks = nb_chunks
+        self.mpi_comm = mpi_comm
+        self.dynamic = dynamic and DYNAMIC_SCHEDULING and (mpi_comm.size > 1)
+        self.contiguous = contiguous
+
+    def _get_static_chunks(self):
+
+        if self.contiguous:
+            return numpy.array_split(numpy.arange(self.nb_chunks), self.mpi_comm.size)[self.mpi_comm.rank]
+        else:
+            return range(self.mpi_comm.rank, self.nb_chunks, self.mpi_comm.size)
+
+    def __len__(self):
+
+        # Exact for static scheduling, expected value otherwise (used for progress bars).
+        return len(self._get_static_chunks())
+
+    def __iter__(self):
+
+        if not self.dynamic:
+            for gidx in self._get_static_chunks():
+                yield int(gidx)
+            return
+
+        itemsize = MPI.INT64_T.Get_size()
+        if self.mpi_comm.rank == 0:
+            window = MPI.Win.Allocate(itemsize, itemsize, comm=self.mpi_comm)
+            window.Lock(0)
+            window.Put(numpy.zeros(1, dtype=numpy.int64), 0)
+            window.Unlock(0)
+        else:
+            window = MPI.Win.Allocate(0, itemsize, comm=self.mpi_comm)
+        self.mpi_comm.Barrier()
+
+        one = numpy.ones(1, dtype=numpy.int64)
+        gidx = numpy.zeros(1, dtype=numpy.int64)
+
+        while True:
+            window.Lock(0, MPI.LOCK_SHARED)
+            window.Fetch_and_op(one, gidx, 0, 0, MPI.SUM)
+            window.Unlock(0)
+            if gidx[0] >= self.nb_chunks:
+                break
+            yield int(gidx[0])
+
+        window.Free()
+
+
 def gather_mpi_arguments(hostfile, params):
     print_and_log(['MPI detected: %s' % str(MPI_VENDOR)], 'debug', logger)
     if MPI_VENDOR[0] == 'Open MPI':
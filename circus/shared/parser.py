@@ -188,8 +188,21 @@ class CircusParser(object):
                         ['fitting', 'max_chunk', 'float', 'inf'],
                         ['fitting', 'chunk_size', 'int', '1'],
                         ['fitting', 'debug', 'bool', 'False'],
+                        ['fitting', 'engine', 'string', 'dense'],
+                        ['fitting', 'overlaps', 'string', 'csr'],
+                        ['fitting', 'overlaps_cache', 'float', '1000'],
+                        ['fitting', 'auto_chunk', 'bool', 'False'],
+                        ['fitting', 'resume', 'bool', 'False'],
+                        ['fitting', 'result_layout', 'string', 'groups'],
+                        ['data', 'overlaps_engine', 'string', 'delays'],
+                        ['data', 'overlaps_threads', 'int', '1'],
                         ['filtering', 'butter_order', 'int', '3'],
+                        ['filtering', 'engine', 'string', 'filtfilt'],
                         ['clustering', 'm_ratio', 'float', '0.01'],
+                        ['clustering', 'density_mode', 'string', 'matrix'],
+                        ['clustering', 'nb_workers', 'int', '1'],
+                        ['clustering', 'peak_cache', 'bool', 'False'],
+                        ['clustering', 'selection_engine', 'string', 'loop'],
                         ['clustering', 'debug', 'bool', 'False'],
                         ['clustering', 'sub_dim', 'int', '10'],
                         ['clustering', 'decimation', 'bool', 'True'],
@@ -197,9 +210,12 @@ class CircusParser(object):
                         ['clustering', 'nb_ss_bins', 'int', '200'],
                         ['clustering', 'fine_amplitude', 'bool', 'True'],
                         ['detection', 'jitter_range', 'float', '0.2'],
+                        ['detection', 'alignment_engine', 'string', 'spline'],
                         ['detection', 'smoothing_factor', 'float', '1.48'],
                         ['detection', 'rejection_threshold', 'float', '1'],
                         ['data', 'memory_usage', 'float', '0.1'],
+                        ['data', 'dynamic_scheduling', 'bool', 'False'],
+                        ['data', 'prefetch', 'int', '0'],
                         ['clustering', 'safety_time', 'string', 'auto'],
                         ['clustering', 'savgol', 'bool', 'True'],
                         ['clustering', 'savgol_time', 'float', '0.2'],
@@ -618,6 +634,86 @@ class CircusParser(object):
                 print_and_log(["min and max dispersions in [clustering] should be positive"], 'error', logger)
             sys.exit(0)
 
+        engines = ['dense', 'tree']
+        test = self.parser.get('fitting', 'engine').lower() in engines
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["engine in [fitting] should be in %s" % str(engines)], 'error', logger)
+            sys.exit(0)
+
+        overlaps_modes = ['csr', 'lags', 'lazy']
+        test = self.parser.get('fitting', 'overlaps').lower() in overlaps_modes
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["overlaps in [fitting] should be in %s" % str(overlaps_modes)], 'error', logger)
+            sys.exit(0)
+
+        test = self.parser.getfloat('fitting', 'overlaps_cache') > 0
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["overlaps_cache in [fitting] should be a positive size (in MB)"], 'error', logger)
+            sys.exit(0)
+
+        test = self.parser.getint('clustering', 'nb_workers') >= 1
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["nb_workers in [clustering] should be a positive number of processes"], 'error', logger)
+            sys.exit(0)
+
+        selection_engines = ['loop', 'batch']
+        test = self.parser.get('clustering', 'selection_engine').lower() in selection_engines
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["selection_engine in [clustering] should be in %s" % str(selection_engines)], 'error', logger)
+            sys.exit(0)
+
+        overlaps_engines = ['delays', 'supports']
+        test = self.parser.get('data', 'overlaps_engine').lower() in overlaps_engines
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["overlaps_engine in [data] should be in %s" % str(overlaps_engines)], 'error', logger)
+            sys.exit(0)
+
+        test = self.parser.getint('data', 'overlaps_threads') >= 1
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["overlaps_threads in [data] should be a positive number of threads"], 'error', logger)
+            sys.exit(0)
+
+        density_modes = ['matrix', 'knn']
+        test = self.parser.get('clustering', 'density_mode').lower() in density_modes
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["density_mode in [clustering] should be in %s" % str(density_modes)], 'error', logger)
+            sys.exit(0)
+
+        alignment_engines = ['spline', 'kernels']
+        test = self.parser.get('detection', 'alignment_engine').lower() in alignment_engines
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["alignment_engine in [detection] should be in %s" % str(alignment_engines)], 'error', logger)
+            sys.exit(0)
+
+        result_layouts = ['groups', 'columnar']
+        test = self.parser.get('fitting', 'result_layout').lower() in result_layouts
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["result_layout in [fitting] should be in %s" % str(result_layouts)], 'error', logger)
+            sys.exit(0)
+
+        filtering_engines = ['filtfilt', 'sos', 'causal']
+        test = self.parser.get('filtering', 'engine').lower() in filtering_engines
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["engine in [filtering] should be in %s" % str(filtering_engines)], 'error', logger)
+            sys.exit(0)
+
+        test = self.parser.getint('data', 'prefetch') >= 0
+        if not test:
+            if comm.rank == 0:
+                print_and_log(["prefetch in [data] should be a positive number of chunks"], 'error', logger)
+            sys.exit(0)
+
         pcs_export = ['prompt', 'none', 'all', 'some']
         test = self.parser.get('converting', 'export_pcs').lower() in pcs_export
         if not test:
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import warnings, logging
 warnings.filterwarnings("ignore")
-import os, sys, time, types, tqdm
+import os, sys, time, types, tqdm, multiprocessing
 import numpy as np
 import scipy.sparse as sp
 from math import log, sqrt
@@ -11,6 +11,7 @@ from scipy.stats import gamma
 import numpy, os, tempfile
 import scipy.linalg, scipy.optimize, cPickle, socket, tempfile, shutil, scipy.ndimage.filters, scipy.signal
 import six
+from collections import OrderedDict
 
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore",category=FutureWarning)
@@ -75,6 +76,186 @@ def indices_for_dead_times(start, end):
     return i
 
 
+def merge_intervals(intervals):
+    """Sort and merge overlapping intervals.
+
+    Arguments:
+        intervals
+            Array of shape (n, 2), with the [start, stop) of an interval per row.
+
+    Returns:
+        Array of shape (m, 2) of disjoint intervals, such that both their starts and stops are sorted.
+    """
+    intervals = np.asarray(intervals, dtype=np.int64).reshape(-1, 2)
+    intervals = intervals[intervals[:, 1] > intervals[:, 0]]
+    if len(intervals) == 0:
+        return intervals
+    intervals = intervals[np.argsort(intervals[:, 0], kind='mergesort')]
+    stops = np.maximum.accumulate(intervals[:, 1])
+    # A new interval starts when it begins after all the previous ones have ended.
+    is_new = np.concatenate(([True], intervals[1:, 0] > stops[:-1]))
+    starts = intervals[is_new, 0]
+    stops = stops[np.concatenate((is_new[1:], [True]))]
+    return np.vstack((starts, stops)).T.copy()
+
+
+def is_in_intervals(times, intervals):
+    """Test which times fall in a set of intervals, in O(len(times) * log(len(intervals))).
+
+    Arguments:
+        times
+            Array of times.
+        intervals
+            Array of shape (n, 2) of disjoint and sorted [start, stop) intervals (see merge_intervals).
+
+    Returns:
+        Boolean array, True for the times within one of the intervals.
+    """
+    times = np.asarray(times, dtype=np.int64)
+    if len(intervals) == 0:
+        return np.zeros(times.shape, dtype=bool)
+    idx = np.searchsorted(intervals[:, 0], times, 'right') - 1
+    return (idx >= 0) & (times < intervals[np.maximum(idx, 0), 1])
+
+
+def get_snippet_windows(data, width, axis=0):
+    """Sliding windows along one axis of a 2D array, without any copy.
+
+    Arguments:
+        data
+            Array of shape (n_times, n_channels) if axis is 0, or (n_channels, n_times) if axis is 1.
+        width
+            Width of the windows, in time steps.
+        axis
+            Time axis of the data.
+    Returns:
+        windows
+            Read-only view such that windows[t] is data[t:t + width] (shape (n_windows, width, n_channels))
+            if axis is 0, and windows[:, t] is data[:, t:t + width] (shape (n_channels, n_windows, width)) if
+            axis is 1.
+    """
+
+    nb_windows = max(0, data.shape[axis] - width + 1)
+    if axis == 0:
+        shape = (nb_windows, width, data.shape[1])
+        strides = (data.strides[0], data.strides[0], data.strides[1])
+    else:
+        shape = (data.shape[0], nb_windows, width)
+        strides = (data.strides[0], data.strides[1], data.strides[1])
+    windows = np.lib.stride_tricks.as_strided(data, shape=shape, strides=strides)
+    windows.flags.writeable = False
+
+    return windows
+
+
+def gather_snippets(data, times, width, offset=0, channels_first=False, out=None):
+    """Gather the snippets data[t + offset:t + offset + width] for all the times t, in a single step.
+
+    Arguments:
+        data
+            Array of shape (n_times, n_channels).
+        times
+            Times of the snippets. All the snippets must lie within data.
+        width
+            Width of the snippets, in time steps.
+        offset
+            Offset of the snippets with respect to the times (e.g. -template_shift for centered snippets).
+        channels_first
+            If True, the snippets are returned with shape (n_channels, width, len(times)), i.e. ready to be
+            reshaped as (n_channels * width, len(times)) columns. Otherwise, the shape is
+            (len(times), width, n_channels).
+        out
+            Optional array where the snippets are written, of the shape given above and of the dtype of data
+            (e.g. a view of a preallocated (n_channels * width, len(times)) matrix if channels_first).
+    Returns:
+        snippets
+    """
+
+    times = np.asarray(times, dtype=np.int64) + offset
+    if len(times) > 0 and (times.min() < 0 or times.max() > data.shape[0] - width):
+        raise IndexError("Snippets are not all within the data")
+
+    if channels_first:
+        # Gathering along the contiguous time axis is much more cache friendly than transposing afterwards, and
+        # snippets are written in their final order, one channel at a time, without any full size temporary.
+        windows = get_snippet_windows(np.ascontiguousarray(data.T), width, axis=1)
+        if out is None:
+            out = np.empty((data.shape[1], width, len(times)), dtype=data.dtype)
+        for channel in range(data.shape[1]):
+            out[channel] = windows[channel, times].T
+        return out
+    else:
+        return np.take(get_snippet_windows(data, width), times, axis=0, out=out)
+
+
+def get_alignment_kernels(xdata, cdata, xoff, over_factor, template_shift, n_t):
+    """Linear operators of the cubic interpolation used to align snippets, precomputed once for all the snippets.
+
+    An interpolating spline (k=3, s=0) is linear with respect to the interpolated values, such that evaluating it
+    at fixed points is a matrix product. Since the alignment can only shift snippets by one of the len(cdata) steps
+    of the oversampled grid, the resampling at every possible shift can be precomputed as well.
+
+    Arguments:
+        xdata
+            Time steps of the snippets (e.g. numpy.arange(-template_shift_2, template_shift_2 + 1)).
+        cdata
+            Oversampled times where the extremum of the snippets is searched.
+        xoff
+            Offset of the center of cdata, in oversampled steps.
+        over_factor
+            Oversampling factor.
+        template_shift
+            Half width of the aligned snippets.
+        n_t
+            Width of the aligned snippets.
+    Returns:
+        search_kernel
+            Array of shape (len(cdata), len(xdata)) evaluating the interpolation on cdata.
+        shift_kernels
+            Array of shape (len(cdata), n_t, len(xdata)), such that shift_kernels[i] resamples the interpolation
+            on n_t points centered on (i - xoff) / over_factor.
+    """
+
+    identity = np.eye(len(xdata))
+    splines = [scipy.interpolate.UnivariateSpline(xdata, identity[i], k=3, s=0) for i in range(len(xdata))]
+    rmins = (np.arange(len(cdata)) - xoff) / over_factor
+    ddata = np.array([np.linspace(rmin - template_shift, rmin + template_shift, n_t) for rmin in rmins])
+
+    search_kernel = np.array([spline(cdata) for spline in splines]).T.astype(np.float32)
+    shift_kernels = np.array([spline(ddata) for spline in splines]).transpose(1, 2, 0).astype(np.float32)
+
+    return search_kernel, shift_kernels
+
+
+def align_snippets(snippets, search_kernel, shift_kernels, channels, negative=True):
+    """Align a batch of snippets on the oversampled extremum of one of their channels, with matrix products.
+
+    Arguments:
+        snippets
+            Array of shape (n_snippets, len(xdata), n_channels).
+        search_kernel, shift_kernels
+            Kernels given by get_alignment_kernels.
+        channels
+            Channel (or array of one channel per snippet) where the extremum is searched.
+        negative
+            If True (or for the snippets where it is True, if it is an array), the snippets are aligned on their
+            minimum, and on their maximum otherwise.
+    Returns:
+        aligned
+            Array of shape (n_snippets, n_t, n_channels).
+    """
+
+    snippets = np.asarray(snippets, dtype=np.float32)
+    nb_snippets = len(snippets)
+    channels = np.broadcast_to(channels, (nb_snippets,))
+    negative = np.broadcast_to(negative, (nb_snippets,))
+
+    oversampled = np.dot(snippets[np.arange(nb_snippets), :, channels], search_kernel.T)
+    shifts = np.where(negative, np.argmin(oversampled, axis=1), np.argmax(oversampled, axis=1))
+
+    return np.matmul(shift_kernels[shifts], snippets)
+
+
 def apply_patch_for_similarities(params, extension):
 
     if not test_patch_for_similarities(params, extension):
@@ -225,9 +406,164 @@ def purge(file, pattern):
         print_and_log(['Removing %s for directory %s' % (pattern, dir)], 'debug', logger)
 
 
-def get_tqdm_progressbar(iterator):
+def get_tqdm_progressbar(iterator, total=None):
     sys.stderr.flush()
-    return tqdm.tqdm(iterator, bar_format='{desc}{percentage:3.0f}%|{bar}|[{elapsed}<{remaining}, {rate_fmt}]', ncols=66)
+    return tqdm.tqdm(
+        iterator, total=total, bar_format='{desc}{percentage:3.0f}%|{bar}|[{elapsed}<{remaining}, {rate_fmt}]', ncols=66
+    )
+
+
+_forked_function = None  # function called by the workers of forked_imap (inherited through the fork)
+
+
+def _call_forked_function(job):
+    return _forked_function(job)
+
+
+def forked_imap(func, jobs, nb_workers=1):
+    """Apply a function to several jobs with a pool of local worker processes.
+
+    The workers are forked once the function is known, so that it can be a closure reading all the data of the
+    calling process without any copy. Jobs are dispatched in the given order (i.e. put the longest ones first), and
+    results are yielded as soon as they are available, i.e. not necessarily in that order. Without fork, or with a
+    single worker, jobs are processed sequentially (and lazily) by the calling process.
+
+    The workers are forked after MPI_Init, and should only compute: they must not call MPI (e.g. comm, or the
+    shared memory windows, which they can still read), nor use the HDF5 files opened by the calling process, whose
+    handles are not fork safe (they should write their large outputs to their own files instead, as sending them
+    back means pickling them through a pipe). They leave with os._exit, without finalizing MPI. Some transports of
+    Open MPI (e.g. openib) do not support fork at all, hence nb_workers is 1 by default.
+
+    Arguments:
+        func
+            Function called on each job. Its result must be picklable, and it can not modify the data of the calling
+            process (apart from the sequential case).
+        jobs: list
+        nb_workers: integer
+    Return:
+        results: iterator
+            Results of the function.
+    """
+
+    global _forked_function
+
+    if nb_workers <= 1 or len(jobs) <= 1 or not hasattr(os, 'fork'):
+        return (func(job) for job in jobs)
+
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing
+    _forked_function = func
+    pool = context.Pool(min(nb_workers, len(jobs)))
+    results = pool.imap_unordered(_call_forked_function, jobs, chunksize=1)
+    pool.close()  # the workers leave once all the jobs are done
+
+    def iterate():
+        # Holds a reference to the pool until all the results are consumed.
+        for result in results:
+            yield result
+        pool.join()
+
+    return iterate()
+
+
+class ChunkCache(object):
+    """Store of the arrays computed for some chunks of data, on disk, to reuse them during the next passes.
+
+    The arrays of each chunk are saved as npy files in a temporary folder, and are loaded back as writable memory
+    maps, such that they are only read when needed, and that they can be completed (e.g. lazily computed values).
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path
+                Folder in which a temporary folder is created for the cache.
+        """
+        self.path = tempfile.mkdtemp(prefix='chunks_', dir=path)
+        self.keys = {}
+
+    def __contains__(self, index):
+        return index in self.keys
+
+    def _get_file_name(self, index, key):
+        return os.path.join(self.path, '%d_%s.npy' % (index, key))
+
+    def save(self, index, arrays):
+        """Save the arrays (dictionary) of a chunk."""
+        for key, array in arrays.items():
+            np.save(self._get_file_name(index, key), array)
+        self.keys[index] = list(arrays.keys())
+
+    def load(self, index):
+        """Load the arrays (dictionary) of a chunk, as memory maps."""
+        arrays = {}
+        for key in self.keys[index]:
+            try:
+                arrays[key] = np.load(self._get_file_name(index, key), mmap_mode='r+')
+            except ValueError:  # empty arrays can not be mapped by old versions of numpy
+                arrays[key] = np.load(self._get_file_name(index, key))
+        return arrays
+
+    def close(self):
+        """Remove all the files of the cache."""
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.keys = {}
+
+
+class LRUCache(object):
+    """Cache of values computed on demand, keeping the most recently used ones within a memory limit.
+
+    Values are computed by a function of their key on their first access, and the least recently used ones are
+    dropped once the total size of the cached values exceeds the limit. Hits and misses are counted.
+    """
+
+    def __init__(self, function, max_bytes, get_size):
+        """
+        Arguments:
+            function
+                Function computing the value of a key.
+            max_bytes
+                Memory limit of the cache, in bytes.
+            get_size
+                Function giving the size of a value, in bytes.
+        """
+        self.function = function
+        self.max_bytes = max_bytes
+        self.get_size = get_size
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.nb_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getitem__(self, key):
+        if key in self.values:
+            self.hits += 1
+            value = self.values.pop(key)
+        else:
+            self.misses += 1
+            value = self.function(key)
+            self.sizes[key] = self.get_size(value)
+            self.nb_bytes += self.sizes[key]
+            while self.nb_bytes > self.max_bytes and len(self.values) > 0:
+                old_key, _ = self.values.popitem(last=False)
+                self.nb_bytes -= self.sizes.pop(old_key)
+                self.evictions += 1
+        self.values[key] = value  # i.e. most recently used
+        return value
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def get_stats(self):
+        """Returns the numbers of hits, misses and evictions."""
+        return np.array([self.hits, self.misses, self.evictions], dtype=np.int64)
 
 
 def get_whitening_matrix(X, fudge=1e-15):
@@ -40,7 +40,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     ignore_dead_times = params.getboolean('triggers', 'ignore_times')
     inv_nodes = numpy.zeros(N_total, dtype=numpy.int32)
     inv_nodes[nodes] = numpy.arange(len(nodes))
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if use_gpu:
@@ -181,12 +181,10 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
         g_offset = t_offset + padding[0]
 
         if ignore_dead_times:
-            dead_indices = numpy.searchsorted(all_dead_times, [t_offset, t_offset + chunk_size])
-            if dead_indices[0] != dead_indices[1]:
-                is_included = numpy.in1d(local_peaktimes + g_offset, all_dead_times[dead_indices[0]:dead_indices[1]])
-                local_peaktimes = local_peaktimes[~is_included]
-                local_elecs = local_elecs[~is_included]
-                local_amps = local_amps[~is_included]
+            is_included = is_in_intervals(local_peaktimes + g_offset, all_dead_times)
+            local_peaktimes = local_peaktimes[~is_included]
+            local_elecs = local_elecs[~is_included]
+            local_amps = local_amps[~is_included]
 
         # print "Removing the useless borders..."
         local_borders = (dist_peaks, len_chunk - dist_peaks)
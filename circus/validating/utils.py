@@ -106,7 +106,7 @@ def extract_extra_thresholds(params):
     """Compute the mean and the standard deviation for each extracellular channel"""
 
     data_file = params.data_file
-    data_file.open()
+    data_file.open(persistent=True)
 
     chunk_size = params.getint('data', 'chunk_size')
     do_temporal_whitening = params.getboolean('whitening', 'temporal')
@@ -227,7 +227,7 @@ def extract_extra_spikes_(params):
     """Detect spikes from the extracellular traces"""
     
     data_file = params.data_file
-    data_file.open()
+    data_file.open(persistent=True)
     dist_peaks = params.getint('detection', 'dist_peaks')
     spike_thresh = params.getfloat('detection', 'spike_thresh')
     template_shift = params.getint('detection', 'template_shift')
@@ -422,7 +422,7 @@ def extract_extra_spikes_(params):
     channels = len(loc_all_chunks) * [None]
     values = len(loc_all_chunks) * [None]
 
-    data_file.open()
+    data_file.open(persistent=True)
     # For each chunk attributed to the current CPU.
     for (count, gidx) in enumerate(to_explore):
         gidx = all_chunks[gidx]
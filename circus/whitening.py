@@ -47,7 +47,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     use_hanning = params.getboolean('detection', 'hanning')
     rejection_threshold = params.getfloat('detection', 'rejection_threshold')
     noise_window = params.getint('detection', 'noise_time')
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if use_hanning:
@@ -309,7 +309,7 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
     ignore_dead_times = params.getboolean('triggers', 'ignore_times')
     if ignore_dead_times:
         all_dead_times = get_dead_times(params)
-    data_file.open()
+    data_file.open(persistent=True)
     #################################################################
 
     if comm.rank == 0:
@@ -413,11 +413,8 @@ def main(params, nb_cpu, nb_gpu, use_gpu):
             local_peaktimes = numpy.unique(all_peaktimes)
 
             if ignore_dead_times:
-                dead_indices = numpy.searchsorted(all_dead_times, [t_offset, t_offset + local_shape])
-                if dead_indices[0] != dead_indices[1]:
-                    is_included = numpy.in1d(local_peaktimes + t_offset, all_dead_times[dead_indices[0]:dead_indices[1]])
-                    local_peaktimes = local_peaktimes[~is_included]
-                    local_peaktimes = numpy.sort(local_peaktimes)
+                is_included = is_in_intervals(local_peaktimes + t_offset, all_dead_times)
+                local_peaktimes = local_peaktimes[~is_included]
 
             if len(local_peaktimes) > 0:
 
@@ -0,0 +1,39 @@
+import numpy, scipy.spatial.distance
+import unittest
+from circus.shared.algorithms import DistanceMatrix
+
+
+class TestDeltasAndNeighbors(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.nb_points = 200
+        self.data = numpy.random.randn(self.nb_points, 3).astype(numpy.float32)
+        self.data[-10:] = self.data[:10]  # duplicated points, at a null distance
+        self.rho = numpy.random.rand(self.nb_points).astype(numpy.float32)
+
+    def get_loop(self, dist):
+        # Point by point search, as done before the blocks.
+        indices = numpy.argsort(-self.rho)
+        nearest_higher_rho_indices = numpy.zeros(self.nb_points, dtype=numpy.int64)
+        nearest_higher_rho_distances = numpy.zeros(self.nb_points, dtype=numpy.float32)
+        for k, index in enumerate(indices):
+            higher_rho_indices = indices[0:k + 1]
+            higher_rho_distances = dist.get_row(index)[higher_rho_indices]
+            higher_rho_distances[higher_rho_distances == 0.0] = float('inf')
+            nearest_index = numpy.argmin(higher_rho_distances)
+            nearest_higher_rho_indices[index] = higher_rho_indices[nearest_index]
+            nearest_higher_rho_distances[index] = higher_rho_distances[nearest_index]
+        nearest_higher_rho_distances[indices[0]] = numpy.max(nearest_higher_rho_distances[indices[1:]])
+        return nearest_higher_rho_distances, nearest_higher_rho_indices
+
+    def test_blocks(self):
+        dist = DistanceMatrix(self.nb_points)
+        dist.initialize(self.data)
+        dense = DistanceMatrix(self.nb_points, distances=scipy.spatial.distance.squareform(dist.distances))
+        deltas, neighbors = self.get_loop(dist)
+        for distances in [dist, dense]:
+            for block_size, nb_threads in [(1, 1), (1000, 1), (1000, 3), (2**20, 1)]:
+                result = distances.get_deltas_and_neighbors(self.rho, nb_threads=nb_threads, block_size=block_size)
+                assert numpy.all(result[0] == deltas)
+                assert numpy.all(result[1] == neighbors)
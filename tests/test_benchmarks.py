@@ -0,0 +1,285 @@
+import numpy, scipy.interpolate, scipy.sparse, time, os, shutil, tempfile
+import unittest
+from circus.shared.utils import gather_snippets, get_alignment_kernels, align_snippets, LRUCache
+from circus.files.raw_binary import RawBinaryFile
+from circus.shared.algorithms import DistanceMatrix
+from circus.shared.files import sort_overlaps, get_templates_supports, get_banded_overlaps
+from circus.shared.files import get_templates_checksums, get_templates_mapping, update_overlaps
+from circus.shared.files import get_overlaps_csr, get_template_overlaps
+
+
+# Benchmarks are slow, print their timings, and are only run on demand, e.g. CIRCUS_BENCHMARKS=1 nosetests tests.
+RUN_BENCHMARKS = os.environ.get('CIRCUS_BENCHMARKS', '') not in ['', '0']
+
+
+def timeit(func, nb_repeats=5):
+    timings = []
+    for count in range(nb_repeats):
+        t_start = time.time()
+        result = func()
+        timings.append(time.time() - t_start)
+    return result, numpy.min(timings)
+
+
+@unittest.skipUnless(RUN_BENCHMARKS, "benchmarks are only run with CIRCUS_BENCHMARKS=1")
+class TestBenchmarks(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+
+    def test_gather_snippets(self):
+        n_e, n_t, len_chunk, nb_peaks = 256, 61, 2000, 20000
+        template_shift = (n_t - 1) // 2
+        local_chunk = numpy.random.randn(len_chunk, n_e).astype(numpy.float32)
+        local_peaktimes = numpy.random.randint(template_shift, len_chunk - template_shift, nb_peaks)
+        size_window = n_e * n_t
+
+        def loop():
+            raveled_chunk = local_chunk.T.ravel()
+            temp_window = numpy.arange(-template_shift, template_shift + 1)
+            slice_indices = numpy.concatenate([len_chunk * idx + temp_window for idx in range(n_e)])
+            sub_mat = numpy.zeros((size_window, nb_peaks), dtype=numpy.float32)
+            for count, idx in enumerate(local_peaktimes):
+                sub_mat[:, count] = numpy.take(raveled_chunk, slice_indices + idx)
+            return sub_mat
+
+        def gather():
+            sub_mat = gather_snippets(local_chunk, local_peaktimes, n_t, offset=-template_shift, channels_first=True)
+            return sub_mat.reshape(size_window, nb_peaks).astype(numpy.float32, copy=False)
+
+        res_loop, t_loop = timeit(loop)
+        res_gather, t_gather = timeit(gather)
+        print('Snippets: loop %.3fs, gather %.3fs (x%.1f)' % (t_loop, t_gather, t_loop / t_gather))
+        assert numpy.all(res_loop == res_gather)
+
+    def test_get_data_buffer(self):
+        nb_channels, chunk_size, nb_chunks = 64, 2000, 10
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        file_name = os.path.join(path, 'benchmark.dat')
+        raw_data = numpy.random.randint(0, 2**16, (nb_chunks * chunk_size, nb_channels), dtype=numpy.uint16)
+        raw_data.tofile(file_name)
+        data_file = RawBinaryFile(file_name, {'data_dtype': 'uint16', 'sampling_rate': 20000, 'nb_channels': nb_channels})
+        data_file.open()
+        buffer = numpy.empty((chunk_size, nb_channels), dtype=numpy.float32)
+
+        def read(out=None):
+            chunks = []
+            for gidx in range(nb_chunks):
+                local_chunk, t_offset = data_file.get_data(gidx, chunk_size, out=out)
+                if out is not None:
+                    assert numpy.shares_memory(local_chunk, out)
+                chunks.append(local_chunk[::100].copy())
+            return numpy.concatenate(chunks)
+
+        res_alloc, t_alloc = timeit(read)
+        res_buffer, t_buffer = timeit(lambda: read(buffer))
+        print('get_data: allocating %.4fs, buffer %.4fs' % (t_alloc, t_buffer))
+
+        data_file.close()
+        assert numpy.all(res_buffer == res_alloc)
+        assert numpy.all(res_buffer == raw_data[::100] - numpy.float32(data_file.dtype_offset))
+
+    def test_persistent_snippets(self):
+        # get_stas reads one snippet per spike, which used to map the file again for each of them.
+        nb_channels, nb_samples, n_t, nb_snippets = 64, 50000, 61, 5000
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        file_name = os.path.join(path, 'benchmark.dat')
+        raw_data = numpy.random.randint(0, 2**16, (nb_samples, nb_channels), dtype=numpy.uint16)
+        raw_data.tofile(file_name)
+        data_file = RawBinaryFile(file_name, {'data_dtype': 'uint16', 'sampling_rate': 20000, 'nb_channels': nb_channels})
+        times = numpy.random.randint(0, nb_samples - n_t, nb_snippets)
+        nodes = numpy.arange(0, nb_channels, 4)
+
+        def read(persistent):
+            data_file.open(persistent=persistent)
+            stas = numpy.zeros((len(nodes), n_t), dtype=numpy.float32)
+            for time in times:
+                stas += data_file.get_snippet(time, n_t, nodes=nodes).T
+            data_file.close()
+            return stas
+
+        res_transient, t_transient = timeit(lambda: read(False), nb_repeats=3)
+        res_persistent, t_persistent = timeit(lambda: read(True), nb_repeats=3)
+        print('Snippets: %d/s transient, %d/s persistent (x%.1f)'
+              % (nb_snippets / t_transient, nb_snippets / t_persistent, t_transient / t_persistent))
+
+        assert numpy.all(res_transient == res_persistent)
+
+    def test_align_snippets(self):
+        template_shift, jitter_range, over_factor, nb_channels, nb_snippets = 30, 6, 5., 8, 2000
+        template_shift_2 = template_shift + jitter_range
+        n_t = 2 * template_shift + 1
+        cdata = numpy.linspace(-jitter_range, jitter_range, int(over_factor * 2 * jitter_range))
+        xdata = numpy.arange(-template_shift_2, template_shift_2 + 1)
+        ydata = numpy.arange(nb_channels)
+        xoff = len(cdata) / 2.
+
+        # Noisy gaussian spikes, jittered around the center of the snippets.
+        jitters = numpy.random.uniform(-3, 3, (nb_snippets, 1, 1))
+        snippets = numpy.random.randn(nb_snippets, len(xdata), nb_channels) * 0.3
+        snippets -= 5 * numpy.exp(-((xdata[numpy.newaxis, :, numpy.newaxis] - jitters) / 3.) ** 2)
+        snippets = snippets.astype(numpy.float32)
+
+        def splines():
+            aligned = numpy.zeros((nb_snippets, n_t, nb_channels), dtype=numpy.float32)
+            for count, snippet in enumerate(snippets):
+                f = scipy.interpolate.UnivariateSpline(xdata, snippet[:, 0], k=3, s=0)
+                rmin = (numpy.argmin(f(cdata)) - xoff) / over_factor
+                ddata = numpy.linspace(rmin - template_shift, rmin + template_shift, n_t)
+                f = scipy.interpolate.RectBivariateSpline(xdata, ydata, snippet, s=0, kx=3, ky=1)
+                aligned[count] = f(ddata, ydata)
+            return aligned
+
+        def kernels():
+            search_kernel, shift_kernels = get_alignment_kernels(xdata, cdata, xoff, over_factor, template_shift, n_t)
+            return align_snippets(snippets, search_kernel, shift_kernels, 0, True)
+
+        res_splines, t_splines = timeit(splines, nb_repeats=1)
+        res_kernels, t_kernels = timeit(kernels)
+        print('Alignment: splines %.3fs, kernels %.3fs (x%.1f)' % (t_splines, t_kernels, t_splines / t_kernels))
+        assert numpy.allclose(res_splines, res_kernels, atol=1e-4)
+
+    def test_deltas_and_neighbors(self):
+        nb_points, nb_dimensions = 10000, 5
+        data = numpy.random.randn(nb_points, nb_dimensions).astype(numpy.float32)
+        rho = numpy.random.rand(nb_points).astype(numpy.float32)
+        dist = DistanceMatrix(nb_points)
+        dist.initialize(data)
+
+        def loop():
+            indices = numpy.argsort(-rho)
+            nearest_higher_rho_indices = numpy.zeros(nb_points, dtype=numpy.int64)
+            nearest_higher_rho_distances = numpy.zeros(nb_points, dtype=numpy.float32)
+            for k, index in enumerate(indices):
+                higher_rho_indices = indices[0:k + 1]
+                higher_rho_distances = dist.get_row(index)[higher_rho_indices]
+                higher_rho_distances[higher_rho_distances == 0.0] = float('inf')
+                nearest_index = numpy.argmin(higher_rho_distances)
+                nearest_higher_rho_indices[index] = higher_rho_indices[nearest_index]
+                nearest_higher_rho_distances[index] = higher_rho_distances[nearest_index]
+            nearest_higher_rho_distances[indices[0]] = numpy.max(nearest_higher_rho_distances[indices[1:]])
+            return nearest_higher_rho_distances, nearest_higher_rho_indices
+
+        res_loop, t_loop = timeit(loop, nb_repeats=1)
+        res_blocks, t_blocks = timeit(lambda: dist.get_deltas_and_neighbors(rho), nb_repeats=3)
+        print('Deltas: loop %.3fs, blocks %.3fs (x%.1f)' % (t_loop, t_blocks, t_loop / t_blocks))
+        assert numpy.all(res_loop[0] == res_blocks[0]) and numpy.all(res_loop[1] == res_blocks[1])
+
+    def test_banded_overlaps(self):
+        n_e, n_t, nb_templates = 64, 31, 200
+        duration = 2 * n_t - 1
+        best_elec = numpy.random.randint(0, n_e, nb_templates)
+        templates = numpy.zeros((n_e * n_t, nb_templates), dtype=numpy.float32)
+        for count, elec in enumerate(best_elec):
+            templates[max(0, elec - 2) * n_t:min(n_e, elec + 3) * n_t, count] = numpy.random.randn(
+                (min(n_e, elec + 3) - max(0, elec - 2)) * n_t)
+        templates = scipy.sparse.csc_matrix(templates)
+        to_consider = numpy.arange(nb_templates)
+        rows = numpy.arange(n_e * n_t)
+
+        def loop():
+            over_x, over_y, over_data = [], [], []
+            for ielec in range(n_e):
+                local_idx = numpy.where(best_elec == ielec)[0]
+                loc_templates = templates[:, local_idx].tocsr()
+                loc_templates2 = templates.tocsr()
+                for idelay in range(1, n_t + 1):
+                    tmp_1 = loc_templates[numpy.where(rows % n_t < idelay)[0]].T.tocsr()
+                    tmp_2 = loc_templates2[numpy.where(rows % n_t >= (n_t - idelay))[0]]
+                    data = tmp_1.dot(tmp_2)
+                    dx, dy = data.nonzero()
+                    ddx = numpy.take(local_idx, dx).astype(numpy.uint32)
+                    ddy = numpy.take(to_consider, dy).astype(numpy.uint32)
+                    ones = numpy.ones(len(dx), dtype=numpy.uint32)
+                    over_x += [ddx * nb_templates + ddy]
+                    over_y += [(idelay - 1) * ones]
+                    over_data += [data.data]
+                    if idelay < n_t:
+                        over_x += [ddy * nb_templates + ddx]
+                        over_y += [(duration - idelay) * ones]
+                        over_data += [data.data]
+            return sort_overlaps(numpy.concatenate(over_x), numpy.concatenate(over_y), numpy.concatenate(over_data))
+
+        def banded():
+            supports = get_templates_supports(templates, n_t)
+            results = [get_banded_overlaps(templates, supports, numpy.where(best_elec == ielec)[0], to_consider,
+                                           n_t, nb_templates) for ielec in range(n_e)]
+            return sort_overlaps(*[numpy.concatenate(arrays) for arrays in zip(*results)])
+
+        res_loop, t_loop = timeit(loop, nb_repeats=1)
+        res_banded, t_banded = timeit(banded, nb_repeats=3)
+        print('Overlaps: loop %.3fs, banded %.3fs (x%.1f)' % (t_loop, t_banded, t_loop / t_banded))
+        for array_loop, array_banded in zip(res_loop, res_banded):
+            assert numpy.all(array_loop == array_banded)
+
+    def test_update_overlaps(self):
+        n_e, n_t, nb_templates = 64, 31, 400
+        duration = 2 * n_t - 1
+
+        def get_templates(nb_templates):
+            templates = numpy.zeros((n_e * n_t, nb_templates), dtype=numpy.float32)
+            for count, elec in enumerate(numpy.random.randint(0, n_e, nb_templates)):
+                templates[max(0, elec - 2) * n_t:min(n_e, elec + 3) * n_t, count] = numpy.random.randn(
+                    (min(n_e, elec + 3) - max(0, elec - 2)) * n_t)
+            return templates
+
+        def get_all_overlaps(templates):
+            supports = get_templates_supports(templates, n_t)
+            all_templates = numpy.arange(templates.shape[1])
+            over_x, over_y, over_data = sort_overlaps(*get_banded_overlaps(
+                templates, supports, all_templates, all_templates, n_t, templates.shape[1]))
+            return over_x, over_y, over_data, numpy.array([templates.shape[1]**2, duration], dtype=numpy.int32)
+
+        # A few templates are removed, merged with others (i.e. modified) and added.
+        old_templates = get_templates(nb_templates)
+        new_templates = numpy.delete(old_templates, numpy.arange(0, nb_templates, 40), axis=1)
+        new_templates[:, 1::40] += new_templates[:, 2::40]
+        new_templates = numpy.hstack((new_templates, get_templates(10)))
+        old_templates = scipy.sparse.csc_matrix(old_templates)
+        new_templates = scipy.sparse.csc_matrix(new_templates)
+        old_overlaps = get_all_overlaps(old_templates)
+
+        def update():
+            old_checksums, new_checksums = get_templates_checksums(old_templates), get_templates_checksums(new_templates)
+            mapping = get_templates_mapping(old_checksums, new_checksums)
+            return update_overlaps(*(old_overlaps + (new_templates, mapping, n_t)))
+
+        res_full, t_full = timeit(lambda: get_all_overlaps(new_templates), nb_repeats=1)
+        res_update, t_update = timeit(update, nb_repeats=3)
+        print('Overlaps: full %.3fs, update %.3fs (x%.1f)' % (t_full, t_update, t_full / t_update))
+        for array_full, array_update in zip(res_full, res_update):
+            assert numpy.all(array_full == array_update)
+
+    def test_lazy_overlaps(self):
+        # Only a fraction of the templates are fitted, thus only their overlaps are needed.
+        n_e, n_t, nb_templates, nb_fitted = 64, 31, 1000, 100
+        templates = numpy.zeros((n_e * n_t, nb_templates), dtype=numpy.float32)
+        for count, elec in enumerate(numpy.random.randint(0, n_e, nb_templates)):
+            templates[max(0, elec - 2) * n_t:min(n_e, elec + 3) * n_t, count] = numpy.random.randn(
+                (min(n_e, elec + 3) - max(0, elec - 2)) * n_t)
+        templates = scipy.sparse.csc_matrix(templates)
+        supports = get_templates_supports(templates, n_t)
+        fitted = numpy.random.randint(0, nb_templates, 10 * nb_fitted) % nb_fitted
+        size = lambda value: value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+
+        def precomputed():
+            all_templates = numpy.arange(nb_templates)
+            over_x, over_y, over_data = sort_overlaps(*get_banded_overlaps(
+                templates, supports, all_templates, all_templates, n_t, nb_templates))
+            c_overs = [get_overlaps_csr(over_x, over_y, over_data, i * nb_templates, nb_templates, 2 * n_t - 1)
+                       for i in range(nb_templates)]
+            return [c_overs[i] for i in fitted]
+
+        def lazy():
+            c_overs = LRUCache(lambda index: get_template_overlaps(templates, supports, index, n_t), 2**30, size)
+            return [c_overs[i] for i in fitted], c_overs.get_stats()
+
+        res_precomputed, t_precomputed = timeit(precomputed, nb_repeats=1)
+        (res_lazy, stats), t_lazy = timeit(lazy, nb_repeats=1)
+        print('Overlaps: precomputed %.3fs, lazy %.3fs (x%.1f), %d hits, %d misses'
+              % (t_precomputed, t_lazy, t_precomputed / t_lazy, stats[0], stats[1]))
+        assert stats[1] == len(numpy.unique(fitted))
+        for over_precomputed, over_lazy in zip(res_precomputed, res_lazy):
+            assert numpy.all(over_precomputed.toarray() == over_lazy.toarray())
@@ -170,4 +170,32 @@ class TestClustering(unittest.TestCase):
         res = get_performance(self.file_name, 'cc_merge')
         if self.all_templates is None:
             self.all_templates = res[0]
-            self.all_matches   = res[1]
\ No newline at end of file
+            self.all_matches   = res[1]
+
+    def test_clustering_selection_engines(self):
+        # The batch engine selects the same peaks as the loop, and should thus give the same templates.
+        a, b           = os.path.splitext(os.path.basename(self.file_name))
+        file_name, ext = os.path.splitext(self.file_name)
+        temp_file      = os.path.join(os.path.abspath(file_name), a) + '.templates.hdf5'
+        for sign_peaks in ['negative', 'positive']:
+            self.parser.write('detection', 'peaks', sign_peaks)
+            mpi_launch('whitening', self.file_name, 2, 0, 'False')
+            for alignment_engine in ['spline', 'kernels']:
+                self.parser.write('detection', 'alignment_engine', alignment_engine)
+                for isolation in ['True', 'False']:
+                    self.parser.write('detection', 'isolation', isolation)
+                    templates = {}
+                    for selection_engine in ['loop', 'batch']:
+                        self.parser.write('clustering', 'selection_engine', selection_engine)
+                        mpi_launch('clustering', self.file_name, 2, 0, 'False')
+                        myfile = h5py.File(temp_file, 'r')
+                        templates[selection_engine] = [myfile.get(key)[:] for key in ['temp_x', 'temp_y', 'temp_data', 'temp_shape']]
+                        myfile.close()
+                    for loop, batch in zip(templates['loop'], templates['batch']):
+                        assert loop.shape == batch.shape
+                        assert numpy.allclose(loop, batch, atol=1e-5)
+        self.parser.write('clustering', 'selection_engine', 'loop')
+        self.parser.write('detection', 'isolation', 'True')
+        self.parser.write('detection', 'alignment_engine', 'spline')
+        self.parser.write('detection', 'peaks', 'negative')
+        mpi_launch('whitening', self.file_name, 2, 0, 'False')
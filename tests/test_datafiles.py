@@ -0,0 +1,67 @@
+import numpy, os, shutil, tempfile
+import unittest
+from circus.files.raw_binary import RawBinaryFile
+
+
+class TestRawBinaryFile(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.nb_channels, self.nb_samples = 8, 1000
+
+    def get_data_file(self, dtype='float32', gain=1.0):
+        file_name = os.path.join(self.path, 'data_%s_%g.dat' % (dtype, gain))
+        raw_data = numpy.random.randint(0, 100, (self.nb_samples, self.nb_channels)).astype(dtype)
+        raw_data.tofile(file_name)
+        params = {'data_dtype': dtype, 'sampling_rate': 20000, 'nb_channels': self.nb_channels, 'gain': gain}
+        if dtype == 'float32':
+            params['dtype_offset'] = 0
+        return RawBinaryFile(file_name, params), raw_data
+
+    def test_gain_does_not_modify_the_file(self):
+        # Float32 chunks are views of the file, they should be scaled into a new buffer, in any mode.
+        for mode in ['r', 'r+']:
+            data_file, raw_data = self.get_data_file(gain=2.0)
+            for nodes in [None, numpy.arange(0, self.nb_channels, 2), numpy.array([0, 1, 5])]:
+                data_file.open(mode=mode, persistent=True)
+                local_chunk, _ = data_file.get_data(0, 100, nodes=nodes)
+                data_file.close()
+                expected = raw_data[:100] if nodes is None else raw_data[:100, nodes]
+                assert numpy.all(local_chunk == 2 * expected)
+            assert numpy.all(numpy.fromfile(data_file.file_name, dtype=numpy.float32) == raw_data.ravel())
+
+    def test_gain_of_snippets(self):
+        data_file, raw_data = self.get_data_file(gain=0.5)
+        times = numpy.array([10, 50, 500])
+        data_file.open(mode='r+')
+        snippets = data_file.get_snippets(times, 20)
+        data_file.close()
+        for count, t in enumerate(times):
+            assert numpy.all(snippets[count] == 0.5 * raw_data[t:t + 20])
+        assert numpy.all(numpy.fromfile(data_file.file_name, dtype=numpy.float32) == raw_data.ravel())
+
+    def test_buffer(self):
+        data_file, raw_data = self.get_data_file(dtype='uint16')
+        buffer = numpy.empty((200, self.nb_channels), dtype=numpy.float32)
+        data_file.open()
+        for gidx in range(3):
+            local_chunk, _ = data_file.get_data(gidx, 100, out=buffer)
+            assert numpy.shares_memory(local_chunk, buffer)
+            assert numpy.all(local_chunk == raw_data[gidx * 100:(gidx + 1) * 100].astype(numpy.float32) - data_file.dtype_offset)
+        data_file.close()
+        self.assertRaises(ValueError, data_file.get_data, 0, 100, (0, 0), None, numpy.empty((50, self.nb_channels), dtype=numpy.float32))
+
+    def test_persistent_snippets(self):
+        data_file, raw_data = self.get_data_file(dtype='uint16')
+        times = numpy.random.randint(0, self.nb_samples - 20, 50)
+        nodes = numpy.arange(0, self.nb_channels, 2)
+        snippets = {}
+        for persistent in [False, True]:
+            data_file.open(persistent=persistent)
+            snippets[persistent] = [data_file.get_snippet(t, 20, nodes=nodes) for t in times]
+            data_file.close()
+        for transient, persistent, t in zip(snippets[False], snippets[True], times):
+            assert numpy.all(transient == persistent)
+            assert numpy.all(persistent == raw_data[t:t + 20, nodes].astype(numpy.float32) - data_file.dtype_offset)
@@ -0,0 +1,202 @@
+import numpy, scipy.sparse, h5py, os, shutil, tempfile
+import unittest
+from circus.shared.files import *
+
+
+class ColumnarParams(object):
+    # Only file_out_suff is read by get_results_window.
+
+    def __init__(self, file_out_suff):
+        self.file_out_suff = file_out_suff
+
+    def get(self, section, key):
+        return self.file_out_suff
+
+
+class TestColumnarResults(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.nb_templates = 5
+        self.result = {'spiketimes': {}, 'amplitudes': {}}
+        for i in range(self.nb_templates):
+            nb_spikes = 0 if i == 2 else numpy.random.randint(1, 50)
+            # Times are drawn in a small range, so that some spikes of different templates occur at the same time.
+            times = numpy.sort(numpy.random.randint(0, 200, nb_spikes)).astype(numpy.uint32)
+            self.result['spiketimes']['temp_%d' % i] = times
+            self.result['amplitudes']['temp_%d' % i] = numpy.random.randn(nb_spikes, 2).astype(numpy.float32)
+        self.columns = get_columnar_results(self.result, self.nb_templates)
+
+    def test_sorted_by_time(self):
+        spike_times = self.columns['spike_times']
+        spike_templates = self.columns['spike_templates']
+        assert len(spike_times) == sum(len(times) for times in self.result['spiketimes'].values())
+        assert numpy.all(numpy.diff(spike_times.astype(numpy.int64)) >= 0)
+        same_time = spike_times[1:] == spike_times[:-1]
+        assert numpy.all(spike_templates[1:][same_time] >= spike_templates[:-1][same_time])
+
+    def test_template_spikes(self):
+        for i in range(self.nb_templates):
+            idx = get_template_spikes(self.columns, i)
+            assert numpy.all(self.columns['spike_times'][idx] == self.result['spiketimes']['temp_%d' % i])
+            assert numpy.all(self.columns['amplitudes'][idx] == self.result['amplitudes']['temp_%d' % i])
+            assert numpy.all(self.columns['spike_templates'][idx] == i)
+
+    def test_time_window(self):
+        spike_times = self.columns['spike_times']
+        for t_start, t_stop in [(0, 200), (50, 100), (100, 100), (150, 1000), (-10, 0)]:
+            window = get_time_window(spike_times, t_start, t_stop)
+            assert numpy.all(spike_times[window] == spike_times[(spike_times >= t_start) & (spike_times < t_stop)])
+            # Datasets are bisected element by element.
+            assert get_time_window(list(spike_times), t_start, t_stop) == window
+
+    def test_save_columnar_results(self):
+        # The columns saved from the values grouped by template (in memory or in a file) are the same as the ones
+        # computed in memory.
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        file_name = os.path.join(path, 'data.result.hdf5')
+        grouped_name = os.path.join(path, 'data.result-grouped.hdf5')
+        names = ['temp_%d' % i for i in range(self.nb_templates)]
+        for hdf5_compress in [False, True]:
+            for in_file in [False, True]:
+                grouped_times = numpy.concatenate([self.result['spiketimes'][name] for name in names])
+                counts = numpy.array([len(self.result['spiketimes'][name]) for name in names])
+                amplitudes = numpy.concatenate([self.result['amplitudes'][name] for name in names])
+                with h5py.File(grouped_name, 'w') as grouped_file:
+                    # Extra rows, as allocated by collect_data before the refractory period is applied, are ignored.
+                    extra = numpy.zeros((3, 2), dtype=numpy.float32)
+                    grouped = {'amplitudes': numpy.concatenate((amplitudes, extra))}
+                    if in_file:
+                        grouped['amplitudes'] = grouped_file.create_dataset('amplitudes', data=grouped['amplitudes'])
+                    with h5py.File(file_name, 'w') as myfile:
+                        save_columnar_results(myfile, grouped_times, counts, grouped, hdf5_compress=hdf5_compress)
+
+                with h5py.File(file_name, 'r') as myfile:
+                    assert 'spiketimes' not in myfile
+                    for key, data in self.columns.items():
+                        assert myfile[key].dtype == data.dtype
+                        assert numpy.all(myfile[key][:] == data)
+
+    def test_results_window(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        file_out_suff = os.path.join(path, 'data')
+        with h5py.File(file_out_suff + '.result.hdf5', 'w') as myfile:
+            for key, data in self.columns.items():
+                myfile.create_dataset(key, data=data)
+
+        params = ColumnarParams(file_out_suff)
+        window = get_results_window(params, 50, 100)
+        mask = (self.columns['spike_times'] >= 50) & (self.columns['spike_times'] < 100)
+        for key in ['spike_times', 'spike_templates', 'amplitudes']:
+            assert numpy.all(window[key] == self.columns[key][mask])
+
+        results = get_results(params)
+        for i in range(self.nb_templates):
+            for key in ['spiketimes', 'amplitudes']:
+                assert numpy.all(results[key]['temp_%d' % i] == self.result[key]['temp_%d' % i])
+
+
+def get_random_templates(n_e, n_t, nb_templates):
+    # Templates spread over 5 electrodes around a random one.
+    templates = numpy.zeros((n_e * n_t, nb_templates), dtype=numpy.float32)
+    for count, elec in enumerate(numpy.random.randint(0, n_e, nb_templates)):
+        templates[max(0, elec - 2) * n_t:min(n_e, elec + 3) * n_t, count] = numpy.random.randn(
+            (min(n_e, elec + 3) - max(0, elec - 2)) * n_t)
+    return scipy.sparse.csc_matrix(templates)
+
+
+class TestOverlaps(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.n_e, self.n_t, self.nb_templates = 16, 11, 30
+        self.templates = get_random_templates(self.n_e, self.n_t, self.nb_templates)
+        self.supports = get_templates_supports(self.templates, self.n_t)
+
+    def get_overlaps(self, templates):
+        nb_templates = templates.shape[1]
+        all_templates = numpy.arange(nb_templates)
+        supports = get_templates_supports(templates, self.n_t)
+        return sort_overlaps(*get_banded_overlaps(templates, supports, all_templates, all_templates, self.n_t, nb_templates))
+
+    def test_banded_overlaps(self):
+        # Overlaps computed delay by delay, as done before the banded products.
+        n_t, nb_templates, duration = self.n_t, self.nb_templates, 2 * self.n_t - 1
+        rows = numpy.arange(self.n_e * n_t)
+        templates = self.templates.tocsr()
+        over_x, over_y, over_data = [], [], []
+        for idelay in range(1, n_t + 1):
+            tmp_1 = templates[numpy.where(rows % n_t < idelay)[0]].T.tocsr()
+            tmp_2 = templates[numpy.where(rows % n_t >= (n_t - idelay))[0]]
+            data = tmp_1.dot(tmp_2)
+            dx, dy = data.nonzero()
+            ones = numpy.ones(len(dx), dtype=numpy.uint32)
+            over_x += [(dx * nb_templates + dy).astype(numpy.uint32)]
+            over_y += [(idelay - 1) * ones]
+            over_data += [numpy.asarray(data[dx, dy]).ravel()]
+            if idelay < n_t:
+                over_x += [(dy * nb_templates + dx).astype(numpy.uint32)]
+                over_y += [(duration - idelay) * ones]
+                over_data += [numpy.asarray(data[dx, dy]).ravel()]
+        expected = sort_overlaps(numpy.concatenate(over_x), numpy.concatenate(over_y), numpy.concatenate(over_data))
+
+        # Templates are split over electrodes, as in get_overlaps.
+        best_elec = numpy.random.randint(0, 4, nb_templates)
+        all_templates = numpy.arange(nb_templates)
+        results = [get_banded_overlaps(self.templates, self.supports, numpy.where(best_elec == ielec)[0], all_templates,
+                                       n_t, nb_templates, block_size=4) for ielec in range(4)]
+        result = sort_overlaps(*[numpy.concatenate(arrays) for arrays in zip(*results)])
+        assert numpy.all(result[0] == expected[0]) and numpy.all(result[1] == expected[1])
+        assert numpy.allclose(result[2], expected[2], atol=1e-5)
+
+        # Only some lags.
+        lags = numpy.array([0, 3, n_t - 1, duration - 1])
+        x, y, data = sort_overlaps(*get_banded_overlaps(self.templates, self.supports, all_templates, all_templates,
+                                                        n_t, nb_templates, lags=lags))
+        mask = numpy.in1d(expected[1], lags)
+        assert numpy.all(x == expected[0][mask]) and numpy.all(y == expected[1][mask])
+        assert numpy.allclose(data, expected[2][mask], atol=1e-5)
+
+    def test_update_overlaps(self):
+        # Both halves of the templates (first and second components) lose a template and gain a new one, and one
+        # template is modified.
+        n_half = self.nb_templates // 2
+        first, second = self.templates[:, :n_half], self.templates[:, n_half:]
+        new_first = get_random_templates(self.n_e, self.n_t, n_half).toarray()
+        new_first[:, :-1] = numpy.delete(first.toarray(), 3, axis=1)
+        new_first[:, 5] *= 2
+        new_second = get_random_templates(self.n_e, self.n_t, n_half).toarray()
+        new_second[:, :-1] = numpy.delete(second.toarray(), 3, axis=1)
+        new_templates = scipy.sparse.csc_matrix(numpy.hstack((new_first, new_second)))
+        mapping = get_templates_mapping(get_templates_checksums(self.templates), get_templates_checksums(new_templates))
+        assert numpy.sum(mapping < 0) == 3
+
+        duration = 2 * self.n_t - 1
+        old_overlaps = self.get_overlaps(self.templates)
+        old_shape = numpy.array([self.nb_templates**2, duration], dtype=numpy.int32)
+        expected = self.get_overlaps(new_templates)
+        for nb_threads in [1, 2]:
+            result = update_overlaps(*(old_overlaps + (old_shape, new_templates, mapping, self.n_t)), nb_threads=nb_threads)
+            for array_expected, array_result in zip(expected, result):
+                assert numpy.all(array_expected == array_result)
+            assert numpy.all(result[3] == [new_templates.shape[1]**2, duration])
+
+        # The maximal overlaps of the kept templates are kept, and the other ones recomputed.
+        empty = numpy.zeros((n_half, n_half), dtype=numpy.float32), numpy.zeros((n_half, n_half), dtype=numpy.int32)
+        recomputed = -numpy.ones(n_half, dtype=numpy.int64)
+        old_max = update_maxoverlap(*(empty + (recomputed,) + old_overlaps + (self.nb_templates, self.n_t)))
+        new_max = update_maxoverlap(*(empty + (recomputed,) + expected + (new_templates.shape[1], self.n_t)))
+        result = update_maxoverlap(*(old_max + (mapping[:n_half],) + expected + (new_templates.shape[1], self.n_t)))
+        assert numpy.all(result[0] == new_max[0]) and numpy.all(result[1] == new_max[1])
+
+    def test_template_overlaps(self):
+        # Overlaps computed on demand for one template are its rows of the precomputed overlaps.
+        duration = 2 * self.n_t - 1
+        over_x, over_y, over_data = self.get_overlaps(self.templates)
+        for index in [0, 7, self.nb_templates - 1]:
+            expected = get_overlaps_csr(over_x, over_y, over_data, index * self.nb_templates, self.nb_templates, duration)
+            result = get_template_overlaps(self.templates, self.supports, index, self.n_t)
+            assert result.shape == (self.nb_templates, duration)
+            assert numpy.allclose(result.toarray(), expected.toarray(), atol=1e-5)
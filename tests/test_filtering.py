@@ -0,0 +1,58 @@
+import numpy
+import unittest
+from scipy import signal
+from circus.filtering import sos_filter_chunk
+
+
+class TestFilteringEngines(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.rate, self.chunk_size, self.duration = 20000., 5000, 2000
+        self.data = numpy.cumsum(numpy.random.randn(6 * self.chunk_size + 1234, 4), 0)
+        cut_off = numpy.array([300., 0.95 * (self.rate / 2.)]) / (self.rate / 2.)
+        self.b, self.a = signal.butter(3, cut_off, 'pass')
+        self.sos = signal.butter(3, cut_off, 'pass', output='sos')
+        self.sos_zi = signal.sosfilt_zi(self.sos)[:, :, numpy.newaxis]
+
+    def filter(self, engine):
+        # Filters the data chunk by chunk, as in filtering.main, with the same paddings.
+        results, zi = [], None
+        for t_start in range(0, len(self.data), self.chunk_size):
+            t_stop = min(t_start + self.chunk_size, len(self.data))
+            left = min(t_start, self.duration)
+            right = 0 if engine == 'causal' else min(len(self.data) - t_stop, self.duration)
+            local_chunk = self.data[t_start - left:t_stop + right]
+            if engine == 'filtfilt':
+                results.append(signal.filtfilt(self.b, self.a, local_chunk, axis=0)[left:left + t_stop - t_start])
+            else:
+                local_chunk, zi = sos_filter_chunk(self.sos, self.sos_zi, local_chunk, left, t_stop - t_start, zi,
+                                                   causal=(engine == 'causal'))
+                results.append(local_chunk)
+        return numpy.concatenate(results)
+
+    def test_causal(self):
+        # The state of the filter is carried over, so filtering by chunks is the same as filtering at once.
+        expected, _ = signal.sosfilt(self.sos, self.data, axis=0, zi=self.sos_zi * self.data[0])
+        result = self.filter('causal')
+        assert result.shape == self.data.shape
+        assert numpy.allclose(result, expected)
+
+    def test_sos_and_filtfilt(self):
+        # Away from the edges of the data, both engines should match a zero-phase filtering of the whole data.
+        expected = signal.filtfilt(self.b, self.a, self.data, axis=0)
+        inside = slice(self.duration, -self.duration)
+        for engine in ['filtfilt', 'sos']:
+            result = self.filter(engine)
+            assert result.shape == self.data.shape
+            error = numpy.abs(result[inside] - expected[inside]).max()
+            assert error < 1e-6 * numpy.std(expected), engine
+
+    def test_restart(self):
+        # Without the state of the previous chunk, the filter is warmed up on the left padding.
+        left, len_chunk = self.duration, self.chunk_size
+        local_chunk = self.data[:left + len_chunk + self.duration]
+        _, zi = sos_filter_chunk(self.sos, self.sos_zi, self.data[:left], 0, left)
+        with_state, _ = sos_filter_chunk(self.sos, self.sos_zi, local_chunk[left:], 0, len_chunk, zi)
+        restarted, _ = sos_filter_chunk(self.sos, self.sos_zi, local_chunk, left, len_chunk)
+        assert numpy.allclose(with_state, restarted)
@@ -1,8 +1,10 @@
-import numpy, h5py, pylab, cPickle
+import numpy, h5py, pylab, cPickle, shutil, tempfile
 import unittest
 from . import mpi_launch, get_dataset
 from circus.shared.utils import *
 from circus.shared.parser import CircusParser
+import circus.shared.files as io
+from circus.fitting import get_output_names, restore_journal
 
 def get_performance(file_name, name):
 
@@ -20,13 +22,10 @@ def get_performance(file_name, name):
     thresh          = int(sampling*2*1e-3)
     truncate        = True
 
-    result          = h5py.File(file_out + '.result.hdf5')
-    fitted_spikes   = {}
-    fitted_amps     = {}
-    for key in result.get('spiketimes').keys():
-        fitted_spikes[key] = result.get('spiketimes/%s' %key)[:]
-    for key in result.get('amplitudes').keys():
-        fitted_amps[key]   = result.get('amplitudes/%s' %key)[:]
+    # The fitted results are read with get_results, whatever their layout.
+    result          = io.get_results(CircusParser(file_name + ext))
+    fitted_spikes   = result['spiketimes']
+    fitted_amps     = result['amplitudes']
 
     templates       = h5py.File(file_out + '.templates.hdf5').get('temp_shape')[:]
     
@@ -177,4 +176,77 @@ class TestFitting(unittest.TestCase):
         res = get_performance(self.file_name, 'large_chunks')
         if self.all_spikes is None:
             self.all_spikes = res
-        assert numpy.all(self.all_spikes == res)
\ No newline at end of file
+        assert numpy.all(self.all_spikes == res)
+
+    def test_fitting_tree_engine(self):
+        # The shared parameters are restored even if a run fails.
+        self.addCleanup(self.parser.write, 'fitting', 'max_chunk', 'inf')
+        self.addCleanup(self.parser.write, 'fitting', 'engine', 'dense')
+        self.parser.write('fitting', 'max_chunk', self.max_chunk)
+        mpi_launch('fitting', self.file_name, 2, 0, 'False')
+        dense_result = io.get_results(self.parser)
+        self.parser.write('fitting', 'engine', 'tree')
+        mpi_launch('fitting', self.file_name, 2, 0, 'False')
+        tree_result = io.get_results(self.parser)
+        for key in dense_result['spiketimes'].keys():
+            assert numpy.all(dense_result['spiketimes'][key] == tree_result['spiketimes'][key])
+            assert numpy.all(dense_result['amplitudes'][key] == tree_result['amplitudes'][key])
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.file_out_suff = os.path.join(self.path, 'data')
+        self.names = get_output_names(self.file_out_suff, 0)
+        self.journal_name = self.file_out_suff + '.journal-0.data'
+
+    def write_chunks(self, chunks, nb_values=10):
+        # Each chunk writes nb_values values in each output file, and is then recorded in the journal.
+        outputs = [open(name, 'ab') for name in self.names]
+        journal = open(self.journal_name, 'ab')
+        for gidx in chunks:
+            for output in outputs:
+                output.write(numpy.arange(nb_values, dtype=numpy.uint32).tostring())
+                output.flush()
+            journal.write(numpy.array([gidx] + [output.tell() for output in outputs], dtype=numpy.int64).tostring())
+        for f in outputs + [journal]:
+            f.close()
+
+    def test_complete_journal(self):
+        self.write_chunks([3, 1, 4])
+        assert numpy.all(restore_journal(self.file_out_suff, 0) == [3, 1, 4])
+        for name in self.names:
+            assert os.path.getsize(name) == 3 * 10 * 4
+
+    def test_partial_chunk(self):
+        # The last chunk was only partially written (and never recorded), it is discarded.
+        self.write_chunks([3, 1])
+        with open(self.names[0], 'ab') as f:
+            f.write(numpy.arange(5, dtype=numpy.uint32).tostring())
+        assert numpy.all(restore_journal(self.file_out_suff, 0) == [3, 1])
+        for name in self.names:
+            assert os.path.getsize(name) == 2 * 10 * 4
+
+    def test_record_beyond_files(self):
+        # A record pointing beyond the end of the files (e.g. lost writes) is dropped, with the next ones.
+        self.write_chunks([3, 1, 4])
+        with open(self.names[1], 'r+b') as f:
+            f.truncate(2 * 10 * 4 + 8)
+        assert numpy.all(restore_journal(self.file_out_suff, 0) == [3, 1])
+        for name in self.names:
+            assert os.path.getsize(name) == 2 * 10 * 4
+        assert os.path.getsize(self.journal_name) == 2 * 4 * 8
+
+    def test_torn_record(self):
+        self.write_chunks([3, 1])
+        with open(self.journal_name, 'ab') as f:
+            f.write(numpy.array([4, 120], dtype=numpy.int64).tostring())
+        assert numpy.all(restore_journal(self.file_out_suff, 0) == [3, 1])
+        assert os.path.getsize(self.journal_name) == 2 * 4 * 8
+
+    def test_no_journal(self):
+        assert len(restore_journal(self.file_out_suff, 0)) == 0
+        for name in self.names + [self.journal_name]:
+            assert os.path.exists(name) and os.path.getsize(name) == 0
@@ -0,0 +1,159 @@
+import numpy, scipy.interpolate
+import unittest
+from circus.shared.utils import gather_snippets, merge_intervals, is_in_intervals, get_alignment_kernels, align_snippets, LRUCache
+
+
+class TestGatherSnippets(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.n_e, self.n_t, self.len_chunk = 8, 11, 200
+        self.template_shift = (self.n_t - 1) // 2
+        self.chunk = numpy.random.randn(self.len_chunk, self.n_e).astype(numpy.float32)
+        self.times = numpy.array([self.template_shift, 50, 50, 120, self.len_chunk - self.template_shift - 1])
+
+    def test_channels_first(self):
+        snippets = gather_snippets(self.chunk, self.times, self.n_t, offset=-self.template_shift, channels_first=True)
+        assert snippets.shape == (self.n_e, self.n_t, len(self.times))
+        for count, t in enumerate(self.times):
+            snippet = self.chunk[t - self.template_shift:t + self.template_shift + 1]
+            assert numpy.all(snippets[:, :, count] == snippet.T)
+
+    def test_times_first(self):
+        snippets = gather_snippets(self.chunk, self.times, self.n_t, offset=-self.template_shift)
+        assert snippets.shape == (len(self.times), self.n_t, self.n_e)
+        for count, t in enumerate(self.times):
+            assert numpy.all(snippets[count] == self.chunk[t - self.template_shift:t + self.template_shift + 1])
+
+    def test_out(self):
+        sub_mat = numpy.zeros((self.n_e * self.n_t, len(self.times)), dtype=numpy.float32)
+        result = gather_snippets(
+            self.chunk, self.times, self.n_t, offset=-self.template_shift, channels_first=True,
+            out=sub_mat.reshape(self.n_e, self.n_t, len(self.times))
+        )
+        assert numpy.shares_memory(result, sub_mat)
+        expected = gather_snippets(self.chunk, self.times, self.n_t, offset=-self.template_shift, channels_first=True)
+        assert numpy.all(sub_mat == expected.reshape(self.n_e * self.n_t, len(self.times)))
+
+    def test_no_snippets(self):
+        snippets = gather_snippets(self.chunk, [], self.n_t, channels_first=True)
+        assert snippets.shape == (self.n_e, self.n_t, 0)
+
+    def test_out_of_bounds(self):
+        self.assertRaises(IndexError, gather_snippets, self.chunk, [self.template_shift - 1], self.n_t,
+                          -self.template_shift)
+        self.assertRaises(IndexError, gather_snippets, self.chunk, [self.len_chunk - self.template_shift], self.n_t,
+                          -self.template_shift)
+
+
+class TestIntervals(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        starts = numpy.random.randint(0, 1000, 50)
+        self.intervals = numpy.vstack((starts, starts + numpy.random.randint(-5, 50, 50))).T
+        self.times = numpy.arange(-10, 1100)
+
+    def get_mask(self, intervals):
+        mask = numpy.zeros(len(self.times), dtype=bool)
+        for start, stop in intervals:
+            mask |= (self.times >= start) & (self.times < stop)
+        return mask
+
+    def test_merge_intervals(self):
+        merged = merge_intervals(self.intervals)
+        assert numpy.all(merged[:, 1] > merged[:, 0])
+        assert numpy.all(merged[1:, 0] > merged[:-1, 1])
+        assert numpy.all(self.get_mask(merged) == self.get_mask(self.intervals))
+
+    def test_merge_nested_intervals(self):
+        merged = merge_intervals([[10, 20], [0, 100], [50, 60], [100, 110], [120, 130], [200, 200], [300, 250]])
+        assert numpy.all(merged == [[0, 110], [120, 130]])
+
+    def test_is_in_intervals(self):
+        merged = merge_intervals(self.intervals)
+        assert numpy.all(is_in_intervals(self.times, merged) == self.get_mask(self.intervals))
+
+    def test_no_intervals(self):
+        merged = merge_intervals(numpy.zeros((0, 2)))
+        assert merged.shape == (0, 2)
+        assert not numpy.any(is_in_intervals(self.times, merged))
+
+
+class TestAlignSnippets(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(42)
+        self.template_shift, jitter_range, self.over_factor, self.nb_channels = 10, 3, 5., 4
+        template_shift_2 = self.template_shift + jitter_range
+        self.n_t = 2 * self.template_shift + 1
+        self.cdata = numpy.linspace(-jitter_range, jitter_range, int(self.over_factor * 2 * jitter_range))
+        self.xdata = numpy.arange(-template_shift_2, template_shift_2 + 1)
+        self.xoff = len(self.cdata) / 2.
+
+        # Noisy gaussian spikes of both signs, jittered around the center of the snippets.
+        nb_snippets = 20
+        self.negative = numpy.arange(nb_snippets) % 2 == 0
+        self.channels = numpy.arange(nb_snippets) % self.nb_channels
+        jitters = numpy.random.uniform(-2, 2, (nb_snippets, 1, 1))
+        signs = numpy.where(self.negative, -1, 1)[:, numpy.newaxis, numpy.newaxis]
+        self.snippets = numpy.random.randn(nb_snippets, len(self.xdata), self.nb_channels) * 0.3
+        self.snippets += signs * 5 * numpy.exp(-((self.xdata[numpy.newaxis, :, numpy.newaxis] - jitters) / 2.) ** 2)
+        self.snippets = self.snippets.astype(numpy.float32)
+
+    def align_with_splines(self, snippet, channel, negative):
+        f = scipy.interpolate.UnivariateSpline(self.xdata, snippet[:, channel], k=3, s=0)
+        if negative:
+            rmin = (numpy.argmin(f(self.cdata)) - self.xoff) / self.over_factor
+        else:
+            rmin = (numpy.argmax(f(self.cdata)) - self.xoff) / self.over_factor
+        ddata = numpy.linspace(rmin - self.template_shift, rmin + self.template_shift, self.n_t)
+        ydata = numpy.arange(self.nb_channels)
+        f = scipy.interpolate.RectBivariateSpline(self.xdata, ydata, snippet, s=0, kx=3, ky=1)
+        return f(ddata, ydata)
+
+    def test_kernels_and_splines(self):
+        search_kernel, shift_kernels = get_alignment_kernels(
+            self.xdata, self.cdata, self.xoff, self.over_factor, self.template_shift, self.n_t
+        )
+        aligned = align_snippets(self.snippets, search_kernel, shift_kernels, self.channels, self.negative)
+        assert aligned.shape == (len(self.snippets), self.n_t, self.nb_channels)
+        for count, snippet in enumerate(self.snippets):
+            expected = self.align_with_splines(snippet, self.channels[count], self.negative[count])
+            assert numpy.allclose(aligned[count], expected, atol=1e-4)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def setUp(self):
+        self.computed = []
+
+    def compute(self, key):
+        self.computed.append(key)
+        return numpy.zeros(key, dtype=numpy.uint8)
+
+    def test_hits_and_misses(self):
+        cache = LRUCache(self.compute, 100, lambda value: value.nbytes)
+        for key in [10, 20, 10, 30, 20, 10]:
+            assert len(cache[key]) == key
+        assert self.computed == [10, 20, 30]
+        assert numpy.all(cache.get_stats() == [3, 3, 0])
+        assert len(cache) == 3 and 30 in cache
+
+    def test_evictions(self):
+        # The least recently used values are dropped first, once the limit is exceeded.
+        cache = LRUCache(self.compute, 50, lambda value: value.nbytes)
+        for key in [10, 20, 10, 30]:
+            cache[key]
+        assert 20 not in cache and 10 in cache and 30 in cache
+        cache[20]
+        assert self.computed == [10, 20, 30, 20]
+        assert numpy.all(cache.get_stats() == [1, 4, 2])
+
+    def test_larger_than_limit(self):
+        # A value larger than the limit is still returned, and only kept until the next one.
+        cache = LRUCache(self.compute, 50, lambda value: value.nbytes)
+        assert len(cache[100]) == 100
+        assert 100 in cache
+        cache[10]
+        assert 100 not in cache and 10 in cache